@@ -0,0 +1,197 @@
+"""
+Hourly and daily rollups of payment, entitlement and report activity.
+
+Rollups are updated incrementally: record_event() is called on the same
+connection, and inside the same transaction, as the change it counts.
+
+Metrics (dimension in brackets):
+- payments_initiated  [bundle_name]  count, amount requested
+- payments_completed  [bundle_name]  count, revenue
+- payments_failed     [bundle_name]  count, amount
+- payments_expired    [bundle_name]  count, amount
+- entitlements_granted [package_type] count, revenue
+- reports_generated                  count
+- requests_throttled  [route class:key kind] count (not rebuildable)
+
+Rebuild from the source tables (e.g. after a backfill) with:
+    python analytics.py rebuild [--since YYYY-MM-DD]
+"""
+import sys
+import argparse
+from datetime import datetime, timezone
+
+from database import init_db
+from sharding import init_shards, shard_connections
+from archive import PAYMENT_COLUMNS, REPORT_COLUMNS, ACCESS_COLUMNS, attach_archive
+
+GRANULARITIES = ('hour', 'day')
+
+METRICS = (
+    'payments_initiated',
+    'payments_completed',
+    'payments_failed',
+    'payments_expired',
+    'entitlements_granted',
+    'reports_generated',
+    'requests_throttled'
+)
+
+UPSERT_ROLLUP = '''
+    INSERT INTO analytics_rollups (granularity, bucket, metric, dimension, count, amount)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (granularity, bucket, metric, dimension)
+    DO UPDATE SET count = count + excluded.count, amount = amount + excluded.amount
+'''
+
+
+def buckets(at):
+    """(hour_bucket, day_bucket) for a datetime, e.g. ('2024-12-03 14', '2024-12-03')"""
+    return at.strftime('%Y-%m-%d %H'), at.strftime('%Y-%m-%d')
+
+
+def record_event(conn, metric, dimension='', amount=0, count=1, at=None):
+    """Add one event to the hour and day rollups; the caller commits"""
+    # UTC, like the CURRENT_TIMESTAMP defaults rebuild_rollups() buckets by
+    hour, day = buckets(at or datetime.now(timezone.utc))
+    conn.executemany(UPSERT_ROLLUP, [
+        ('hour', hour, metric, dimension or '', count, amount or 0),
+        ('day', day, metric, dimension or '', count, amount or 0)
+    ])
+
+
+def query_rollups(conn, granularity='day', date_from=None, date_to=None, metric=None):
+    clauses = ['granularity = ?']
+    params = [granularity]
+    if date_from:
+        clauses.append('bucket >= ?')
+        params.append(date_from)
+    if date_to:
+        # Day buckets compare equal to the date; hour buckets sort after it
+        clauses.append('bucket <= ?')
+        params.append(date_to + ' 99' if granularity == 'hour' and len(date_to) == 10 else date_to)
+    if metric:
+        clauses.append('metric = ?')
+        params.append(metric)
+
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT bucket, metric, dimension, count, amount
+        FROM analytics_rollups
+        WHERE {' AND '.join(clauses)}
+        ORDER BY bucket, metric, dimension
+    ''', params)
+    return cursor.fetchall()
+
+
+def counter_for_days(conn, metric, days):
+    """Sum of a metric over a handful of day buckets (at most one row per day per dimension)"""
+    placeholders = ','.join('?' * len(days))
+    cursor = conn.cursor()
+    cursor.execute(f'''
+        SELECT COALESCE(SUM(count), 0) FROM analytics_rollups
+        WHERE granularity = 'day' AND metric = ? AND bucket IN ({placeholders})
+    ''', [metric] + list(days))
+    return cursor.fetchone()[0]
+
+
+# Transitions used to write updated_at as local ISO time ('T' separated);
+# convert those rows to UTC so they land in the same buckets as live events
+UTC_UPDATED_AT = "(CASE WHEN updated_at LIKE '%T%' THEN datetime(updated_at, 'utc') ELSE updated_at END)"
+
+# (metric, SQL returning ts, dim, amt rows to bucket); {payments},
+# {crb_reports} and {user_access} also cover archived rows when an archive exists
+REBUILD_SOURCES = (
+    ('payments_initiated', '''
+        SELECT replace(created_at, 'T', ' ') AS ts, bundle_name AS dim, amount AS amt FROM {payments}
+        WHERE created_at >= ?
+    '''),
+    ('payments_completed', '''
+        SELECT {utc_updated_at} AS ts, bundle_name AS dim, amount AS amt FROM {payments}
+        WHERE status = 'completed' AND {utc_updated_at} >= ?
+    '''),
+    ('payments_failed', '''
+        SELECT {utc_updated_at} AS ts, bundle_name AS dim, amount AS amt FROM {payments}
+        WHERE status = 'failed' AND {utc_updated_at} >= ?
+    '''),
+    ('payments_expired', '''
+        SELECT {utc_updated_at} AS ts, bundle_name AS dim, amount AS amt FROM {payments}
+        WHERE status = 'expired' AND {utc_updated_at} >= ?
+    '''),
+    ('entitlements_granted', '''
+        SELECT replace(ua.created_at, 'T', ' ') AS ts, ua.package_type AS dim, COALESCE(p.amount, 0) AS amt
+        FROM {user_access} ua LEFT JOIN {payments} p ON p.id = ua.payment_id
+        WHERE ua.created_at >= ?
+    '''),
+    ('reports_generated', '''
+        SELECT replace(created_at, 'T', ' ') AS ts, '' AS dim, 0 AS amt FROM {crb_reports}
+        WHERE created_at >= ?
+    ''')
+)
+
+
+def rebuild_rollups(conn, since=None, include_archive=True):
+    """
+    Recompute rollups from the source tables, from `since` (YYYY-MM-DD)
+    onwards. When sharded, only one shard should include the shared archive.
+    """
+    since = since or '0000-00-00'
+    tables = {'payments': 'main.payments', 'crb_reports': 'main.crb_reports', 'user_access': 'main.user_access'}
+    archived = include_archive and attach_archive(conn)
+    if archived:
+        tables = {
+            'payments': f'(SELECT {PAYMENT_COLUMNS} FROM main.payments UNION ALL '
+                        f'SELECT {PAYMENT_COLUMNS} FROM archive.payments)',
+            'crb_reports': f'(SELECT {REPORT_COLUMNS} FROM main.crb_reports UNION ALL '
+                           f'SELECT {REPORT_COLUMNS} FROM archive.crb_reports)',
+            'user_access': f'(SELECT {ACCESS_COLUMNS} FROM main.user_access UNION ALL '
+                           f'SELECT {ACCESS_COLUMNS} FROM archive.user_access)'
+        }
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        rebuilt = [metric for metric, _ in REBUILD_SOURCES]
+        cursor.execute(f'''
+            DELETE FROM analytics_rollups
+            WHERE bucket >= ? AND metric IN ({','.join('?' * len(rebuilt))})
+        ''', [since] + rebuilt)
+        for metric, source_sql in REBUILD_SOURCES:
+            for granularity, width in (('hour', 13), ('day', 10)):
+                cursor.execute(f'''
+                    INSERT INTO analytics_rollups (granularity, bucket, metric, dimension, count, amount)
+                    SELECT ?, substr(ts, 1, {width}), ?, COALESCE(dim, ''), COUNT(*), COALESCE(SUM(amt), 0)
+                    FROM ({source_sql.format(utc_updated_at=UTC_UPDATED_AT, **tables)})
+                    GROUP BY substr(ts, 1, {width}), COALESCE(dim, '')
+                ''', (granularity, metric, since))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if archived:
+            conn.execute('DETACH DATABASE archive')
+    cursor.execute('SELECT COUNT(*) FROM analytics_rollups WHERE bucket >= ?', (since,))
+    return cursor.fetchone()[0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Analytics rollup tools')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    rebuild = subparsers.add_parser('rebuild', help='Recompute rollups from payments, user_access and crb_reports')
+    rebuild.add_argument('--since', help='Only rebuild buckets from this date (YYYY-MM-DD)')
+
+    args = parser.parse_args(argv)
+    if args.command == 'rebuild':
+        init_db()
+        init_shards()
+        rows = 0
+        # Each shard holds the rollups of its own rows; the archive is counted once
+        for n, conn in enumerate(shard_connections()):
+            try:
+                rows += rebuild_rollups(conn, args.since, include_archive=(n == 0))
+            finally:
+                conn.close()
+        print(f"Rebuilt {rows} rollup rows", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+"""
+Hot/cold split for payments and CRB reports.
+
+archive_old_rows() moves rows out of the live database (every shard, when
+sharded) into a separate archive database (ARCHIVE_DATABASE_PATH):
+- payments in a terminal state (completed/failed/expired) created more than
+  PAYMENT_RETENTION_DAYS ago, together with their payment_events
+- CRB reports superseded by a newer report for the same phone
+- entitlements deactivated by the expiry sweeper whose expiry is past the
+  same retention window
+
+Rows move in batches of ARCHIVE_BATCH_SIZE, with one short write transaction
+per batch, so payment writes are never held up for long. Afterwards the live
+database is compacted with an incremental vacuum and a WAL checkpoint.
+
+Archived payments stay reachable: find_archived_payment() and
+match_archived_payments() are the fall-through for the check-status and
+batch status lookups in server.py.
+
+Run it from cron with:
+    python archive.py run [--retention-days N]
+or in-process every ARCHIVE_INTERVAL_SECONDS (see server.start_background_jobs).
+
+A database created before incremental vacuum was enabled needs one full
+VACUUM to switch over:
+    python archive.py compact
+"""
+import os
+import sys
+import sqlite3
+import argparse
+from datetime import datetime, timedelta, timezone
+
+import database
+from sharding import SHARD_COUNT, layout_paths
+
+# Next to the live database unless set, whatever the working directory
+ARCHIVE_DATABASE_PATH = os.environ.get('ARCHIVE_DATABASE_PATH', os.path.join(
+    os.path.dirname(os.path.abspath(database.DATABASE_PATH)), 'payments_archive.db'))
+PAYMENT_RETENTION_DAYS = int(os.environ.get('PAYMENT_RETENTION_DAYS', '90'))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', '500'))
+# Pages released per incremental_vacuum call (4 KiB each by default)
+VACUUM_PAGES = int(os.environ.get('ARCHIVE_VACUUM_PAGES', '2000'))
+
+PAYMENT_COLUMNS = ('id, phone_number, amount, bundle_name, checkout_request_id, merchant_request_id, '
+                   'transaction_id, mpesa_receipt_number, status, result_code, result_description, '
+                   'created_at, updated_at')
+REPORT_COLUMNS = ('id, phone_number, credit_score, crb_status, loan_eligibility, credit_history, '
+                  'detailed_analysis, lender_recommendations, created_at')
+ACCESS_COLUMNS = 'id, phone_number, package_type, payment_id, is_active, expires_at, created_at'
+EVENT_COLUMNS = 'id, payment_id, from_status, to_status, source, created_at'
+
+TERMINAL_STATUSES = ('completed', 'failed', 'expired')
+
+
+def create_archive_schema(conn, schema='archive'):
+    """
+    Archive tables mirror the live ones, keyed by the original ids. Payment ids
+    are global; report, entitlement and payment event ids are per shard, so
+    those are keyed by (shard, id).
+    """
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.payments (
+            id INTEGER PRIMARY KEY,
+            phone_number TEXT NOT NULL,
+            amount REAL NOT NULL,
+            bundle_name TEXT NOT NULL,
+            checkout_request_id TEXT,
+            merchant_request_id TEXT,
+            transaction_id TEXT,
+            mpesa_receipt_number TEXT,
+            status TEXT,
+            result_code INTEGER,
+            result_description TEXT,
+            created_at TIMESTAMP,
+            updated_at TIMESTAMP,
+            archived_at TIMESTAMP
+        )
+    ''')
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.crb_reports (
+            shard INTEGER NOT NULL DEFAULT 0,
+            id INTEGER NOT NULL,
+            phone_number TEXT NOT NULL,
+            credit_score INTEGER,
+            crb_status TEXT,
+            loan_eligibility TEXT,
+            credit_history BLOB,
+            detailed_analysis BLOB,
+            lender_recommendations BLOB,
+            created_at TIMESTAMP,
+            archived_at TIMESTAMP,
+            PRIMARY KEY (shard, id)
+        )
+    ''')
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.user_access (
+            shard INTEGER NOT NULL DEFAULT 0,
+            id INTEGER NOT NULL,
+            phone_number TEXT NOT NULL,
+            package_type TEXT NOT NULL,
+            payment_id INTEGER,
+            is_active INTEGER,
+            expires_at TIMESTAMP,
+            created_at TIMESTAMP,
+            archived_at TIMESTAMP,
+            PRIMARY KEY (shard, id)
+        )
+    ''')
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS {schema}.payment_events (
+            shard INTEGER NOT NULL DEFAULT 0,
+            id INTEGER NOT NULL,
+            payment_id INTEGER NOT NULL,
+            from_status TEXT,
+            to_status TEXT NOT NULL,
+            source TEXT,
+            created_at TIMESTAMP,
+            archived_at TIMESTAMP,
+            PRIMARY KEY (shard, id)
+        )
+    ''')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_archive_payments_checkout ON payments (checkout_request_id)')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_archive_payments_transaction ON payments (transaction_id)')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_archive_payments_phone ON payments (phone_number, created_at)')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_archive_reports_phone ON crb_reports (phone_number, created_at)')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_archive_payment_events_payment ON payment_events (payment_id, id)')
+
+
+def attach_archive(conn, create=False):
+    """ATTACH the archive as schema 'archive'. Returns False if there is none and create is False."""
+    if not create and not os.path.exists(ARCHIVE_DATABASE_PATH):
+        return False
+    conn.execute('ATTACH DATABASE ? AS archive', (ARCHIVE_DATABASE_PATH,))
+    # Also brings an archive from an older release up to the current tables
+    create_archive_schema(conn)
+    return True
+
+
+def get_archive_connection():
+    """Read-only connection to the archive, or None if nothing was ever archived"""
+    if not os.path.exists(ARCHIVE_DATABASE_PATH):
+        return None
+    conn = sqlite3.connect(f'file:{ARCHIVE_DATABASE_PATH}?mode=ro', uri=True)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def find_archived_payment(payment_id=None, checkout_id=None, transaction_id=None, phone=None):
+    """Archived Payment by the first identifier that matches, in check-status order"""
+    conn = get_archive_connection()
+    if conn is None:
+        return None
+    # records imports payment_states, which imports analytics, which imports this module
+    from records import PAYMENT_ROW
+    try:
+        cursor = conn.cursor()
+        cursor.row_factory = PAYMENT_ROW
+        lookups = (
+            ('SELECT * FROM payments WHERE id = ?', payment_id),
+            ('SELECT * FROM payments WHERE checkout_request_id = ?', checkout_id),
+            ('SELECT * FROM payments WHERE transaction_id = ?', transaction_id),
+            ('SELECT * FROM payments WHERE phone_number = ? ORDER BY created_at DESC LIMIT 1', phone)
+        )
+        for sql, value in lookups:
+            if value:
+                cursor.execute(sql, (value,))
+                row = cursor.fetchone()
+                if row:
+                    return row
+        return None
+    finally:
+        conn.close()
+
+
+def match_archived_payments(ids, match):
+    """
+    Run match(cursor, ids) -> {id: row} against the archive, for ids the live
+    database did not resolve
+    """
+    if not ids:
+        return {}
+    conn = get_archive_connection()
+    if conn is None:
+        return {}
+    try:
+        return match(conn.cursor(), ids)
+    finally:
+        conn.close()
+
+
+def _move_rows(cursor, table, columns, key, ids, extra):
+    placeholders = ','.join('?' * len(ids))
+    extra_columns = ''.join(f', {name}' for name in extra)
+    # OR REPLACE: a batch interrupted between the two databases is simply redone
+    cursor.execute(f'''
+        INSERT OR REPLACE INTO archive.{table} ({columns}{extra_columns})
+        SELECT {columns}{', ?' * len(extra)} FROM main.{table} WHERE {key} IN ({placeholders})
+    ''', list(extra.values()) + ids)
+    cursor.execute(f'DELETE FROM main.{table} WHERE {key} IN ({placeholders})', ids)
+
+
+def _move_batch(conn, table, columns, select_ids_sql, params, extra, children=()):
+    """
+    Copy one batch of rows into the archive and delete them from the live
+    table, with the rows of each (table, columns, key column, extra) child
+    that refer to them
+    """
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        cursor.execute(select_ids_sql, params + (ARCHIVE_BATCH_SIZE,))
+        ids = [row[0] for row in cursor.fetchall()]
+        if ids:
+            archived_at = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+            for child, child_columns, key, child_extra in children:
+                _move_rows(cursor, child, child_columns, key, ids, dict(child_extra, archived_at=archived_at))
+            _move_rows(cursor, table, columns, 'id', ids, dict(extra, archived_at=archived_at))
+        conn.commit()
+        return len(ids)
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def _move_all(conn, table, columns, select_ids_sql, params, extra=None, children=()):
+    moved = 0
+    while True:
+        count = _move_batch(conn, table, columns, select_ids_sql, params, extra or {}, children)
+        moved += count
+        if count < ARCHIVE_BATCH_SIZE:
+            return moved
+
+
+def compact(conn):
+    """Give freed pages back to the filesystem and truncate the WAL"""
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+        conn.execute(f'PRAGMA incremental_vacuum({VACUUM_PAGES})').fetchall()
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+
+
+def archive_database(path, shard, cutoff):
+    """Archive one live database (the main one, or a shard). Returns (payments, reports, entitlements)."""
+    # Autocommit mode: each batch manages its own BEGIN IMMEDIATE / COMMIT
+    conn = sqlite3.connect(path, isolation_level=None, timeout=30)
+    try:
+        attach_archive(conn, create=True)
+        # Events left behind by payments archived before events moved with them
+        _move_all(conn, 'payment_events', EVENT_COLUMNS, '''
+            SELECT e.id FROM main.payment_events e
+            WHERE NOT EXISTS (SELECT 1 FROM main.payments p WHERE p.id = e.payment_id)
+            LIMIT ?
+        ''', (), {'shard': shard})
+        payments = _move_all(conn, 'payments', PAYMENT_COLUMNS, f'''
+            SELECT id FROM main.payments
+            WHERE status IN ({','.join('?' * len(TERMINAL_STATUSES))}) AND created_at < ?
+            LIMIT ?
+        ''', TERMINAL_STATUSES + (cutoff,),
+            children=(('payment_events', EVENT_COLUMNS, 'payment_id', {'shard': shard}),))
+        reports = _move_all(conn, 'crb_reports', REPORT_COLUMNS, '''
+            SELECT r.id FROM main.crb_reports r
+            WHERE EXISTS (
+                SELECT 1 FROM main.crb_reports n
+                WHERE n.phone_number = r.phone_number
+                  AND (n.created_at > r.created_at OR (n.created_at = r.created_at AND n.id > r.id))
+            )
+            LIMIT ?
+        ''', (), {'shard': shard})
+        entitlements = _move_all(conn, 'user_access', ACCESS_COLUMNS, '''
+            SELECT id FROM main.user_access
+            WHERE is_active = 0 AND expires_at < ?
+            LIMIT ?
+        ''', (cutoff,), {'shard': shard})
+        compact(conn)
+    finally:
+        conn.close()
+    return payments, reports, entitlements
+
+
+def archive_old_rows(retention_days=None):
+    """Move old terminal payments, superseded reports and expired entitlements to the archive, from every shard. Returns counts."""
+    retention_days = PAYMENT_RETENTION_DAYS if retention_days is None else retention_days
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=retention_days)).strftime('%Y-%m-%d %H:%M:%S')
+
+    payments = reports = entitlements = 0
+    for shard, path in enumerate(layout_paths(SHARD_COUNT)):
+        moved_payments, moved_reports, moved_entitlements = archive_database(path, shard, cutoff)
+        payments += moved_payments
+        reports += moved_reports
+        entitlements += moved_entitlements
+
+    if payments or reports or entitlements:
+        print(f"Archived {payments} payments, {reports} superseded reports and {entitlements} expired "
+              f"entitlements (cutoff {cutoff})", file=sys.stderr)
+    return {'payments': payments, 'reports': reports, 'entitlements': entitlements, 'cutoff': cutoff}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Archive old payments and superseded reports')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run = subparsers.add_parser('run', help='Move terminal payments and expired entitlements past the retention window, and superseded reports')
+    run.add_argument('--retention-days', type=int, help=f'Default PAYMENT_RETENTION_DAYS ({PAYMENT_RETENTION_DAYS})')
+    subparsers.add_parser('compact', help='Full VACUUM; switches an existing database to incremental vacuum')
+
+    args = parser.parse_args(argv)
+    database.init_db()
+    if args.command == 'run':
+        result = archive_old_rows(args.retention_days)
+        print(f"Archived {result['payments']} payments, {result['reports']} reports, "
+              f"{result['entitlements']} entitlements", file=sys.stderr)
+    elif args.command == 'compact':
+        conn = sqlite3.connect(database.DATABASE_PATH, isolation_level=None)
+        try:
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            conn.execute('VACUUM')
+        finally:
+            conn.close()
+        print(f"Compacted {database.DATABASE_PATH}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+ASGI entry point with async payment routes.
+
+The payment surface (initiate, check-status, callback, upgrade) runs natively
+on the event loop. Lipana calls go through a pooled httpx.AsyncClient, and
+SQLite work runs in the thread pool so it never blocks the loop. Each
+in-flight checkout therefore costs a coroutine rather than a worker thread.
+Every other path is handed to the existing Flask app, so the API stays the
+same.
+
+Initiation runs the same payment_service pipelines as server.py, and
+check-status and the callback reuse its helpers, so the JSON contracts match
+the Flask routes exactly.
+
+Run with:
+    uvicorn asgi:app --host 0.0.0.0 --port 5000 --workers 4
+or  gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+
+Requires the optional "asgi" dependencies (starlette, httpx, a2wsgi, uvicorn).
+"""
+import json
+import sys
+import contextlib
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+
+import server
+from background import stop_all
+from sharding import connect_phone
+from lipana_gateway import create_async_lipana_client
+
+
+def json_response(request, body, status=200, headers=None):
+    return JSONResponse(body, status_code=status, headers=dict(server.default_headers(request.url.path), **(headers or {})))
+
+
+async def read_json(request):
+    body = await request.body()
+    if not body:
+        return None
+    try:
+        return json.loads(body)
+    except ValueError:
+        return None
+
+
+async def throttle(request, route_class, data):
+    """429 response if the request is over its route-class budget (see server.rate_limited), else None"""
+    throttled = await run_in_threadpool(server.throttle_request, route_class, data,
+                                        request.headers.get('x-forwarded-for'),
+                                        request.client.host if request.client else None)
+    if not throttled:
+        return None
+    body, retry_after = throttled
+    return json_response(request, body, 429, {'Retry-After': str(retry_after)})
+
+
+async def run_pipeline(request, pipeline, error_prefix, generic_error=None):
+    if request.method == 'OPTIONS':
+        return json_response(request, {})
+    try:
+        data = await read_json(request)
+        throttled = await throttle(request, 'initiate', data)
+        if throttled:
+            return throttled
+        body, status = await server.payments.initiate_async(
+            pipeline, data, request.app.state.lipana, run_in_threadpool
+        )
+        return json_response(request, body, status)
+    except Exception as e:
+        print(f"{error_prefix}: {str(e)}", file=sys.stderr)
+        return json_response(request, {'success': False, 'error': generic_error or str(e)}, 500)
+
+
+async def initiate_payment(request):
+    return await run_pipeline(request, server.PAYMENT_PIPELINE, 'Payment error',
+                              'An error occurred. Please try again.')
+
+
+async def supabase_compat_initiate_payment(request):
+    return await run_pipeline(request, server.COMPAT_PAYMENT_PIPELINE, 'Payment error',
+                              'An error occurred. Please try again.')
+
+
+def _find_status_payment(checkout_id, transaction_id, phone, payment_id):
+    payment = server.recent_status_payment(checkout_id, transaction_id, phone, payment_id)
+    if payment:
+        return payment
+    conn = server.connect_for_status(checkout_id, transaction_id, phone, payment_id)
+    try:
+        return server.find_status_payment(conn.cursor(), checkout_id, transaction_id, phone, payment_id)
+    finally:
+        conn.close()
+
+
+def _complete_status_check(payment, new_status, mpesa_receipt):
+    conn = connect_phone(payment.phone_number)
+    try:
+        return server.complete_status_check(conn, payment, new_status, mpesa_receipt)
+    finally:
+        conn.close()
+
+
+async def check_payment_status(request):
+    if request.method == 'OPTIONS':
+        return json_response(request, {})
+    try:
+        data = await read_json(request) or {}
+        throttled = await throttle(request, 'status', data)
+        if throttled:
+            return throttled
+        identifiers = server.extract_status_identifiers(data)
+
+        payment = await run_in_threadpool(_find_status_payment, *identifiers)
+        if not payment:
+            return json_response(request, {'success': False, 'error': 'Payment not found'}, 404)
+
+        new_status = None
+        mpesa_receipt = None
+        lipana = request.app.state.lipana
+        if lipana and server.needs_lipana_check(payment):
+            new_status, mpesa_receipt = await lipana.query_transaction_status(payment.transaction_id)
+
+        result = await run_in_threadpool(_complete_status_check, payment, new_status, mpesa_receipt)
+        return json_response(request, result)
+
+    except Exception as e:
+        print(f"Check status error: {str(e)}", file=sys.stderr)
+        return json_response(request, {'success': False, 'error': str(e)}, 500)
+
+
+async def payment_callback(request):
+    try:
+        raw_payload = await request.body()
+        signature = request.headers.get('X-Lipana-Signature', '')
+
+        if not server.verify_lipana_signature(raw_payload, signature):
+            print("Webhook signature verification failed")
+            return json_response(request, {'status': 'error', 'message': 'Invalid signature'}, 401)
+
+        data = json.loads(raw_payload) if raw_payload else None
+        result, status = await run_in_threadpool(server.process_payment_callback, data)
+        return json_response(request, result, status)
+
+    except Exception as e:
+        print(f"Callback error: {str(e)}")
+        return json_response(request, {'status': 'error', 'message': str(e)}, 500)
+
+
+async def initiate_upgrade(request):
+    return await run_pipeline(request, server.UPGRADE_PIPELINE, 'Upgrade error')
+
+
+@contextlib.asynccontextmanager
+async def lifespan(asgi_app):
+    asgi_app.state.lipana = create_async_lipana_client()
+    server.start_background_jobs()
+    try:
+        yield
+    finally:
+        stop_all()
+        if asgi_app.state.lipana:
+            await asgi_app.state.lipana.aclose()
+
+
+routes = [
+    Route('/api/payment/initiate', initiate_payment, methods=['POST', 'OPTIONS']),
+    Route('/functions/v1/initiate-payment', supabase_compat_initiate_payment, methods=['POST', 'OPTIONS']),
+    Route('/functions/v1/check-payment-status', check_payment_status, methods=['POST', 'OPTIONS']),
+    Route('/api/payment/callback', payment_callback, methods=['POST']),
+    Route('/api/upgrade/initiate', initiate_upgrade, methods=['POST', 'OPTIONS']),
+    Mount('/', app=WSGIMiddleware(server.app))
+]
+
+app = Starlette(routes=routes, lifespan=lifespan)
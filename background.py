@@ -0,0 +1,139 @@
+"""
+Periodic background workers.
+
+Workers started with start_periodic() run in daemon threads and are tracked
+here, so /healthz can report whether each one is alive and still ticking.
+A worker in the middle of a run counts as fresh however long the run takes.
+None of them serve requests, so they do not affect readiness.
+
+Every serving process starts the same workers, but each job runs in one
+process at a time: before a run the worker takes or renews the job's lease
+in the job_leases table of the main database, and skips the run if another
+process holds it. A lease lasts max(2 x interval, BACKGROUND_LEASE_SECONDS)
+and is released when the process stops its workers (gunicorn's worker_exit),
+so a recycled or crashed holder is replaced at the latest when it lapses.
+"""
+import os
+import sys
+import time
+import socket
+import threading
+
+import database
+
+BACKGROUND_LEASE_SECONDS = float(os.environ.get('BACKGROUND_LEASE_SECONDS', '120'))
+
+_lock = threading.Lock()
+_workers = {}
+
+
+def lease_holder():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def take_lease(name, seconds, now=None):
+    """Take or renew the job's lease for this process. True if this process holds it."""
+    now = time.time() if now is None else now
+    holder = lease_holder()
+    conn = database.get_db_connection()
+    try:
+        row = conn.execute('''
+            INSERT INTO job_leases (name, holder, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at
+            WHERE job_leases.holder = excluded.holder OR job_leases.expires_at < ?
+            RETURNING holder
+        ''', (name, holder, now + seconds, now)).fetchone()
+        conn.commit()
+        return row is not None
+    finally:
+        conn.close()
+
+
+def release_leases():
+    """Give up every lease this process holds, so another process takes over at its next tick"""
+    conn = database.get_db_connection()
+    try:
+        conn.execute('DELETE FROM job_leases WHERE holder = ?', (lease_holder(),))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def start_periodic(name, func, interval):
+    """Run func() every interval seconds in a daemon thread, in whichever process holds the job's lease"""
+    with _lock:
+        existing = _workers.get(name)
+        if existing and existing['thread'].is_alive() and existing['pid'] == os.getpid():
+            return existing['thread']
+
+        stop = threading.Event()
+        state = {
+            'interval': interval,
+            'last_beat': time.monotonic(),
+            'last_error': None,
+            'runs': 0,
+            'running': False,
+            'holding': False,
+            'pid': os.getpid(),
+            'stop': stop
+        }
+
+        def run():
+            while not stop.wait(interval):
+                state['running'] = True
+                try:
+                    state['holding'] = take_lease(name, max(interval * 2, BACKGROUND_LEASE_SECONDS))
+                    if state['holding']:
+                        func()
+                        state['runs'] += 1
+                    state['last_error'] = None
+                except Exception as e:
+                    state['last_error'] = str(e)
+                    print(f"Background worker {name} error: {str(e)}", file=sys.stderr)
+                state['running'] = False
+                state['last_beat'] = time.monotonic()
+
+        thread = threading.Thread(target=run, name=f'bg-{name}', daemon=True)
+        state['thread'] = thread
+        _workers[name] = state
+        thread.start()
+        return thread
+
+
+def stop_worker(name):
+    with _lock:
+        state = _workers.pop(name, None)
+    if state:
+        state['stop'].set()
+
+
+def stop_all():
+    """Stop this process's workers and release their leases"""
+    with _lock:
+        names = list(_workers)
+    for name in names:
+        stop_worker(name)
+    try:
+        release_leases()
+    except Exception as e:
+        print(f"Could not release background leases: {str(e)}", file=sys.stderr)
+
+
+def worker_status():
+    """Liveness of every registered worker in this process"""
+    now = time.monotonic()
+    status = {}
+    with _lock:
+        workers = list(_workers.items())
+    for name, state in workers:
+        alive = state['thread'].is_alive() and state['pid'] == os.getpid()
+        stale = not state['running'] and now - state['last_beat'] > state['interval'] * 3
+        status[name] = {
+            'alive': alive and not stale,
+            'running': state['running'],
+            'holdsLease': state['holding'],
+            'runs': state['runs'],
+            'secondsSinceBeat': round(now - state['last_beat'], 1),
+            'lastError': state['last_error']
+        }
+    return status
@@ -0,0 +1,182 @@
+"""
+Request capture for load replay (replay.py).
+
+Set CAPTURE_REQUESTS=1 to record a sample of live API traffic; init_capture()
+then adds a before/after_request pair to the Flask app. Left unset, the app
+is built without those hooks.
+
+Requests under CAPTURE_PREFIXES (default /api/ and /functions/) are picked by
+CAPTURE_SAMPLE_RATE (0.0 - 1.0) and appended to CAPTURE_PATH as one JSON line
+each:
+    {"at": 1760861234.123, "gap_ms": 41.7, "pid": 12, "method": "POST",
+     "path": "/api/crb/report", "route": "/api/crb/report", "query": {},
+     "body": {...}, "status": 200, "duration_ms": 12.4}
+at is the arrival time, gap_ms the time since the previous captured request
+in the same worker, duration_ms the time spent in the app up to the response
+(a streamed export's body is not included). Every worker appends to the same
+file; lines are written whole, so they do not interleave.
+
+Bodies and query strings are redacted before they are written:
+- values under REDACTED_KEYS (receipts, secrets, tokens) become "[redacted]"
+- anything that reads as a Kenyan mobile number is replaced by a pseudonym
+  (2547 + 8 digits from an HMAC of the number under CAPTURE_SECRET), so one
+  phone keeps one pseudonym across the capture and replayed requests still
+  pass validation. Without CAPTURE_SECRET a random key is made at startup;
+  under gunicorn's preload it is shared by the workers.
+Headers are never captured, and bodies over CAPTURE_MAX_BODY_BYTES are
+dropped (body_truncated). Only the Flask app is hooked: under asgi.py the
+async payment routes are not captured.
+
+Play a capture back with `python replay.py run`.
+"""
+import os
+import re
+import sys
+import hmac
+import json
+import time
+import random
+import hashlib
+import threading
+
+from settings import env_float, env_int, env_flag
+
+# Keys compared lower-cased with '_' removed
+REDACTED_KEYS = {'mpesareceiptnumber', 'receipt', 'receiptnumber', 'password', 'secret', 'token',
+                 'apikey', 'authorization', 'signature', 'pin'}
+REDACTED = '[redacted]'
+PHONE_VALUE = re.compile(r'^(?:\+?254|0)?[17]\d{8}$')
+# One log shared by every worker, under the code directory by default
+CAPTURE_PATH = os.environ.get('CAPTURE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                          'captures', 'requests.jsonl'))
+
+
+def capture_enabled():
+    return env_flag('CAPTURE_REQUESTS')
+
+
+class Redactor:
+    """Scrubs captured bodies and query strings"""
+
+    def __init__(self, secret):
+        self.key = secret.encode('utf-8')
+
+    def pseudonym(self, phone):
+        digits = re.sub(r'\D', '', phone)
+        digest = hmac.new(self.key, digits[-9:].encode('utf-8'), hashlib.sha256).hexdigest()
+        return f'2547{int(digest[:12], 16) % 10 ** 8:08d}'
+
+    def redact(self, value, key=None):
+        if key is not None and key.replace('_', '').lower() in REDACTED_KEYS:
+            return REDACTED
+        if isinstance(value, dict):
+            return {k: self.redact(v, k) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.redact(v) for v in value]
+        if isinstance(value, str) and PHONE_VALUE.match(value.replace(' ', '')):
+            return self.pseudonym(value)
+        return value
+
+
+class TrafficCapture:
+    """Decides which requests to capture and appends them to the log"""
+
+    def __init__(self, path, sample_rate=0.1, prefixes=('/api/', '/functions/'), secret=None,
+                 max_body=16384):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.prefixes = tuple(prefixes)
+        self.redactor = Redactor(secret or os.urandom(16).hex())
+        self.max_body = max_body
+        self._lock = threading.Lock()
+        self._state = {'pid': None, 'file': None, 'last': None}
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_env(cls):
+        prefixes = [p.strip() for p in os.environ.get('CAPTURE_PREFIXES', '/api/,/functions/').split(',')]
+        return cls(
+            path=CAPTURE_PATH,
+            sample_rate=env_float('CAPTURE_SAMPLE_RATE', 0.1),
+            prefixes=[p for p in prefixes if p],
+            secret=os.environ.get('CAPTURE_SECRET'),
+            max_body=env_int('CAPTURE_MAX_BODY_BYTES', 16384)
+        )
+
+    def should_capture(self, method, path):
+        return (method != 'OPTIONS' and path.startswith(self.prefixes)
+                and self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    def entry(self, at, method, path, route, query, body, status, duration_ms):
+        entry = {
+            'at': round(at, 6),
+            'gap_ms': None,
+            'pid': os.getpid(),
+            'method': method,
+            'path': '/'.join(self.redactor.redact(part) for part in path.split('/')),
+            'route': route or path,
+            'query': self.redactor.redact(query),
+            'body': None,
+            'status': status,
+            'duration_ms': round(duration_ms, 3)
+        }
+        if body is not None:
+            if len(body) > self.max_body:
+                entry['body_truncated'] = True
+            else:
+                try:
+                    entry['body'] = self.redactor.redact(json.loads(body))
+                except ValueError:
+                    entry['body_truncated'] = True
+        return entry
+
+    def write(self, entry):
+        """Append one entry; the file is reopened after fork"""
+        with self._lock:
+            if self._state['pid'] != os.getpid():
+                self._state.update(pid=os.getpid(), file=open(self.path, 'a', encoding='utf-8'), last=None)
+            last = self._state['last']
+            entry['gap_ms'] = round((entry['at'] - last) * 1000, 3) if last is not None else None
+            self._state['last'] = entry['at']
+            f = self._state['file']
+            f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            f.flush()
+
+
+def init_capture(app):
+    """Install capture hooks on a Flask app if CAPTURE_REQUESTS is set"""
+    if not capture_enabled():
+        return None
+
+    from flask import g, request
+
+    traffic_capture = TrafficCapture.from_env()
+    print(f"Traffic capture enabled: sample_rate={traffic_capture.sample_rate}, "
+          f"path={traffic_capture.path}", file=sys.stderr)
+
+    @app.before_request
+    def _start_capture():
+        if traffic_capture.should_capture(request.method, request.path):
+            g._capture_at = time.time()
+            g._capture_started = time.perf_counter()
+
+    @app.after_request
+    def _finish_capture(response):
+        started = g.pop('_capture_started', None)
+        if started is None:
+            return response
+        duration_ms = (time.perf_counter() - started) * 1000
+        try:
+            body = request.get_data(cache=True) if request.is_json else None
+            traffic_capture.write(traffic_capture.entry(
+                g.pop('_capture_at'), request.method, request.path,
+                request.url_rule.rule if request.url_rule else None,
+                request.args.to_dict(), body, response.status_code, duration_ms
+            ))
+        except Exception as e:
+            print(f"Capture write error: {str(e)}", file=sys.stderr)
+        return response
+
+    return traffic_capture
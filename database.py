@@ -0,0 +1,347 @@
+"""
+SQLite schema and connection helpers.
+
+init_db() is the migration phase: it is idempotent and meant to run once per
+deployment (the gunicorn master, see gunicorn.conf.py). get_db_connection()
+opens a fresh connection per call, so no connection is ever shared across a
+fork.
+
+Heavy read-only work (listings, exports, analytics) uses get_read_connection()
+instead. When SNAPSHOT_DATABASE_PATH is set, that is a read-only copy of the
+live database refreshed by refresh_snapshot() with the online backup API, so
+long scans never compete with payment writes. A snapshot older than
+SNAPSHOT_MAX_STALENESS_SECONDS is not used; reads go to the live database until
+it is refreshed.
+
+Every connection is opened by the storage engine selected with STORAGE_ENGINE:
+- sqlite (default): the database files on disk
+- memory: shared-cache in-memory SQLite, one named database per path, for
+  tests and benchmarks. It lives as long as the process (or until
+  engine.reset()), so it suits single-process runs only. The snapshot and the
+  archive are file features and are not used with it.
+"""
+import os
+import time
+import sqlite3
+import threading
+
+from report_codec import convert_legacy_reports
+
+DATABASE_PATH = os.environ.get('DATABASE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'payments.db'))
+STORAGE_ENGINE = os.environ.get('STORAGE_ENGINE', 'sqlite')
+
+SNAPSHOT_PATH = os.environ.get('SNAPSHOT_DATABASE_PATH', '')
+SNAPSHOT_MAX_STALENESS = float(os.environ.get('SNAPSHOT_MAX_STALENESS_SECONDS', '60'))
+
+# Bump when init_db() changes the schema; stored in PRAGMA user_version
+SCHEMA_VERSION = 15
+
+
+class FileEngine:
+    """SQLite database files"""
+    name = 'sqlite'
+
+    def connect(self, path, check_same_thread=True, **kwargs):
+        return sqlite3.connect(path, check_same_thread=check_same_thread, **kwargs)
+
+    def reset(self):
+        pass
+
+
+class MemoryEngine:
+    """
+    Shared-cache in-memory SQLite. Connections to the same path share one
+    database, kept alive by a connection the engine holds open.
+    """
+    name = 'memory'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keepalive = {}
+
+    def uri(self, path):
+        return f'file:{os.path.basename(path)}-{id(self)}?mode=memory&cache=shared'
+
+    def connect(self, path, check_same_thread=True, **kwargs):
+        uri = self.uri(path)
+        with self._lock:
+            if uri not in self._keepalive:
+                self._keepalive[uri] = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        return sqlite3.connect(uri, uri=True, check_same_thread=check_same_thread, **kwargs)
+
+    def reset(self):
+        """Drop every in-memory database"""
+        with self._lock:
+            for conn in self._keepalive.values():
+                conn.close()
+            self._keepalive.clear()
+
+
+ENGINES = {'sqlite': FileEngine, 'memory': MemoryEngine}
+_engine = None
+
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        if STORAGE_ENGINE not in ENGINES:
+            raise ValueError(f"Unknown STORAGE_ENGINE {STORAGE_ENGINE!r}; expected one of: {', '.join(ENGINES)}")
+        _engine = ENGINES[STORAGE_ENGINE]()
+    return _engine
+
+
+def set_engine(engine):
+    """Swap the storage engine, e.g. MemoryEngine() for a benchmark run. Returns the previous one."""
+    global _engine
+    previous, _engine = _engine, engine
+    return previous
+
+
+def connect(path=None, check_same_thread=True, **kwargs):
+    """Raw connection through the storage engine"""
+    return get_engine().connect(path or DATABASE_PATH, check_same_thread, **kwargs)
+
+
+def add_column(cursor, table, column, declaration):
+    """ALTER TABLE ... ADD COLUMN unless the column already exists. Returns True if it was added."""
+    existing = [row[1] for row in cursor.execute(f'PRAGMA table_info({table})')]
+    if column in existing:
+        return False
+    cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {declaration}')
+    return True
+
+
+def init_db(path=None):
+    conn = connect(path)
+    # Lets archive.py hand freed pages back without a full VACUUM. Only takes
+    # effect on a new database; `python archive.py compact` converts an old one.
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    # WAL lets readers proceed while a payment update is being written
+    conn.execute('PRAGMA journal_mode=WAL')
+    cursor = conn.cursor()
+    version = cursor.execute('PRAGMA user_version').fetchone()[0]
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            phone_number TEXT NOT NULL,
+            amount REAL NOT NULL,
+            bundle_name TEXT NOT NULL,
+            checkout_request_id TEXT,
+            merchant_request_id TEXT,
+            transaction_id TEXT,
+            mpesa_receipt_number TEXT,
+            status TEXT DEFAULT 'pending',
+            result_code INTEGER,
+            result_description TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_access (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            phone_number TEXT NOT NULL,
+            package_type TEXT NOT NULL,
+            payment_id INTEGER,
+            is_active INTEGER DEFAULT 1,
+            expires_at TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (payment_id) REFERENCES payments(id)
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS crb_reports (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            phone_number TEXT NOT NULL,
+            credit_score INTEGER,
+            crb_status TEXT,
+            loan_eligibility TEXT,
+            credit_history BLOB,
+            detailed_analysis BLOB,
+            lender_recommendations BLOB,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Report sections are packed BLOBs since version 12, see report_codec.py
+    if version < 12:
+        convert_legacy_reports(cursor)
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS lender_connections (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            phone_number TEXT NOT NULL,
+            lender_id TEXT NOT NULL,
+            lender_name TEXT NOT NULL,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # Lead delivery queue, see leads.py. Leads queued before it existed are due now.
+    if add_column(cursor, 'lender_connections', 'next_attempt_at', 'TIMESTAMP'):
+        cursor.execute('UPDATE lender_connections SET next_attempt_at = created_at')
+    add_column(cursor, 'lender_connections', 'attempts', 'INTEGER NOT NULL DEFAULT 0')
+    add_column(cursor, 'lender_connections', 'last_error', 'TEXT')
+    add_column(cursor, 'lender_connections', 'delivered_at', 'TIMESTAMP')
+    # One lead per (phone, lender): fold repeat clicks recorded before the unique index
+    if not cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'idx_lender_connections_lead'").fetchone():
+        cursor.execute('''
+            DELETE FROM lender_connections WHERE id NOT IN (
+                SELECT MIN(id) FROM lender_connections GROUP BY phone_number, lender_id
+            )
+        ''')
+        cursor.execute('CREATE UNIQUE INDEX idx_lender_connections_lead ON lender_connections (phone_number, lender_id)')
+
+    # Who made the latest status change; copied into payment_events by the triggers below
+    add_column(cursor, 'payments', 'status_source', 'TEXT')
+
+    # Append-only transition log, see payment_states.py
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS payment_events (
+            id INTEGER PRIMARY KEY,
+            payment_id INTEGER NOT NULL,
+            from_status TEXT,
+            to_status TEXT NOT NULL,
+            source TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS payments_insert_event AFTER INSERT ON payments
+        BEGIN
+            INSERT INTO payment_events (payment_id, from_status, to_status, source)
+            VALUES (NEW.id, NULL, NEW.status, NEW.status_source);
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS payments_status_event AFTER UPDATE OF status ON payments
+        WHEN OLD.status IS NOT NEW.status
+        BEGIN
+            INSERT INTO payment_events (payment_id, from_status, to_status, source)
+            VALUES (NEW.id, OLD.status, NEW.status, NEW.status_source);
+        END
+    ''')
+
+    # Phones waiting for their first CRB report, made by reports.prepare_requested_reports
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS report_requests (
+            phone_number TEXT PRIMARY KEY,
+            requested_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+    ''')
+
+    # Which process runs each periodic job, see background.py
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS job_leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+    ''')
+
+    # Incrementally maintained hour/day counters, see analytics.py
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS analytics_rollups (
+            granularity TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            dimension TEXT NOT NULL DEFAULT '',
+            count INTEGER NOT NULL DEFAULT 0,
+            amount REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (granularity, bucket, metric, dimension)
+        )
+    ''')
+
+    # Token buckets shared by every worker, see ratelimit.py
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            allowed INTEGER NOT NULL DEFAULT 1
+        ) WITHOUT ROWID
+    ''')
+
+    # Lookup paths: status polling, callbacks and batch status resolve by these
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_payments_checkout_request_id ON payments (checkout_request_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_payments_transaction_id ON payments (transaction_id)')
+    # /api/payments listing: keyset order plus the supported filters
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_payments_created ON payments (created_at, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_payments_status_created ON payments (status, created_at, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_payments_phone_created ON payments (phone_number, created_at, id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_payments_bundle_created ON payments (bundle_name, created_at, id)')
+    # Entitlement lookups: latest active package per phone
+    # Latest report per phone, and superseded reports for archive.py
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_crb_reports_phone_created ON crb_reports (phone_number, created_at)')
+    # Stale reports for the refresh job (reports.py)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_crb_reports_created ON crb_reports (created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_access_phone ON user_access (phone_number, is_active, created_at)')
+    # Expiry sweep (sweeper.expire_entitlements): only active rows are indexed
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_access_expiry ON user_access (expires_at) WHERE is_active = 1')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_payment_events_payment ON payment_events (payment_id, id)')
+    # Due leads for the dispatcher
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_lender_connections_due ON lender_connections (status, next_attempt_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_rate_limit_buckets_updated ON rate_limit_buckets (updated_at)')
+
+    cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    conn.commit()
+    conn.close()
+
+
+def get_db_connection(check_same_thread=True, path=None):
+    conn = connect(path, check_same_thread)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def snapshot_age():
+    """Seconds since the snapshot was last refreshed, or None if there is none"""
+    if not SNAPSHOT_PATH:
+        return None
+    try:
+        return time.time() - os.path.getmtime(SNAPSHOT_PATH)
+    except OSError:
+        return None
+
+
+def refresh_snapshot(min_age=0):
+    """
+    Copy the live database to SNAPSHOT_PATH. The copy is written to a temp file
+    and renamed into place, so open snapshot readers keep the old file. Skipped
+    if the snapshot is younger than min_age, which lets every worker schedule
+    refreshes without all of them doing the copy.
+    """
+    if not SNAPSHOT_PATH:
+        return False
+    age = snapshot_age()
+    if age is not None and age < min_age:
+        return False
+
+    tmp_path = f'{SNAPSHOT_PATH}.{os.getpid()}.tmp'
+    source = sqlite3.connect(DATABASE_PATH, timeout=30)
+    target = sqlite3.connect(tmp_path)
+    try:
+        # One step: a consistent read of the WAL, which never blocks writers
+        source.backup(target)
+        # Standalone rollback-journal file, so readers need no -wal/-shm
+        target.execute('PRAGMA journal_mode=DELETE')
+    finally:
+        target.close()
+        source.close()
+    os.replace(tmp_path, SNAPSHOT_PATH)
+    return True
+
+
+def get_read_connection(max_staleness=None):
+    """Read-only connection for heavy queries: the snapshot when fresh enough, else the live database"""
+    bound = SNAPSHOT_MAX_STALENESS if max_staleness is None else max_staleness
+    age = snapshot_age()
+    if age is not None and age <= bound:
+        # immutable: the file is replaced, never modified, so no locking is needed
+        conn = sqlite3.connect(f'file:{SNAPSHOT_PATH}?mode=ro&immutable=1', uri=True)
+        conn.row_factory = sqlite3.Row
+        return conn
+    return get_db_connection()
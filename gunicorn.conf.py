@@ -0,0 +1,71 @@
+"""
+Gunicorn settings for the MetroCheck API.
+
+Run with:  gunicorn server:app      (this file is picked up automatically)
+
+The app is I/O bound: nearly every request waits on Lipana or SQLite. So the
+default is a few processes, each running many threads (gthread). Set
+GUNICORN_WORKER_CLASS=gevent to use greenlets instead (needs the gevent
+package); preloading is turned off in that case so monkey patching happens
+before `requests` and `ssl` are imported.
+
+Startup:
+- The schema migration (database.init_db) runs once in the master. With
+  preload it runs when the master imports server.py; without preload it runs
+  in on_starting, and SKIP_MIGRATIONS=1 stops workers from repeating it.
+- Workers fork from the preloaded master. The Lipana client, HTTP session and
+  SQLite connections are created lazily after fork, so a worker only has to
+  bind and accept before it can serve traffic.
+- Periodic maintenance workers (server.start_background_jobs) start in each
+  worker once it is initialized, but a lease in the main database lets only
+  one worker run each job at a time (see background.py). A worker releases
+  its leases when it exits.
+"""
+import os
+import multiprocessing
+
+bind = os.environ.get('GUNICORN_BIND', f"0.0.0.0:{os.environ.get('PORT', '5000')}")
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count() * 2, 8)))
+threads = int(os.environ.get('GUNICORN_THREADS', 16))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+# STK push calls can take up to the SDK's 30s timeout
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = 30
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+# Recycle workers periodically; jitter stops them all restarting at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 2000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 200))
+
+preload_app = worker_class != 'gevent'
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG', '-')
+errorlog = '-'
+
+
+def on_starting(server):
+    if not server.cfg.preload_app:
+        import database
+        import sharding
+        database.init_db()
+        sharding.init_shards()
+        os.environ['SKIP_MIGRATIONS'] = '1'
+
+
+def post_fork(server, worker):
+    import lipana_gateway
+    lipana_gateway.reset_clients()
+
+
+def post_worker_init(worker):
+    # After init_process, so gevent has already monkey patched threading
+    import server as app_module
+    app_module.start_background_jobs()
+
+
+def worker_exit(server, worker):
+    import background
+    background.stop_all()
@@ -0,0 +1,98 @@
+"""
+Readiness probe.
+
+check_readiness() looks at the dependencies a payment request needs: SQLite
+writability, journal mode and schema version of the main database and of
+every shard file, and whether Lipana is configured. Background workers do not
+serve requests, so a slow or stuck one never takes the instance out of
+rotation; /healthz reports them instead. The result is cached for
+READINESS_CACHE_SECONDS, and only one thread refreshes it at a time, so
+aggressive load-balancer probing never turns into database load.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+import database
+from lipana_gateway import get_api_key
+from sharding import SHARD_COUNT, sharding_enabled, layout_paths
+
+READINESS_CACHE_SECONDS = float(os.environ.get('READINESS_CACHE_SECONDS', '2'))
+
+_lock = threading.Lock()
+_cache = {'expires': 0.0, 'result': None}
+
+
+def _check_file(path=None):
+    result = {'ok': False}
+    try:
+        conn = database.connect(path, timeout=1)
+        try:
+            result['journalMode'] = conn.execute('PRAGMA journal_mode').fetchone()[0]
+            result['schemaVersion'] = conn.execute('PRAGMA user_version').fetchone()[0]
+            # Taking the write lock and rolling back proves writability without writing
+            conn.execute('BEGIN IMMEDIATE')
+            conn.rollback()
+            result['writable'] = True
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        result['writable'] = False
+        result['error'] = str(e)
+        return result
+
+    result['wal'] = result['journalMode'] == 'wal'
+    result['schemaCurrent'] = result['schemaVersion'] >= database.SCHEMA_VERSION
+    result['ok'] = result['writable'] and result['schemaCurrent']
+    return result
+
+
+def _check_database():
+    """The main database, plus each shard file when sharded (payments live there)"""
+    result = _check_file()
+    if sharding_enabled():
+        result['shards'] = [_check_file(path) for path in layout_paths(SHARD_COUNT)]
+        result['ok'] = result['ok'] and all(shard['ok'] for shard in result['shards'])
+    return result
+
+
+def _check_snapshot():
+    age = database.snapshot_age()
+    return {
+        'enabled': bool(database.SNAPSHOT_PATH),
+        'ageSeconds': round(age, 1) if age is not None else None,
+        'fresh': age is not None and age <= database.SNAPSHOT_MAX_STALENESS
+    }
+
+
+def _run_checks():
+    db = _check_database()
+
+    return {
+        'ready': db['ok'],
+        'checks': {
+            'database': db,
+            # No circuit breaker wraps Lipana; report whether it is usable at all
+            'lipana': {'configured': bool(get_api_key())},
+            # Informational: a stale snapshot only sends reads back to the live database
+            'snapshot': _check_snapshot()
+        }
+    }
+
+
+def check_readiness():
+    """Cached readiness result; at most one probe per interval touches the DB"""
+    now = time.monotonic()
+    cached = _cache['result']
+    if cached is not None and now < _cache['expires']:
+        return cached
+
+    with _lock:
+        if _cache['result'] is not None and time.monotonic() < _cache['expires']:
+            return _cache['result']
+        result = _run_checks()
+        result['checkedAt'] = time.time()
+        _cache['result'] = result
+        _cache['expires'] = time.monotonic() + READINESS_CACHE_SECONDS
+        return result
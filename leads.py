@@ -0,0 +1,184 @@
+"""
+Lender lead delivery.
+
+/api/lender/connect only queues a lead in lender_connections (one per phone
+and lender) and returns. dispatch_leads() runs in the background: it claims
+due leads, groups them per lender into batches of LEAD_BATCH_SIZE and hands
+each batch to the configured sink. Delivered leads are marked delivered. A
+batch that fails is retried with exponential backoff (LEAD_RETRY_SECONDS
+doubling up to LEAD_RETRY_MAX_SECONDS) and marked failed after
+LEAD_MAX_ATTEMPTS. A slow lender therefore only ever slows the dispatcher.
+A run stops starting batches after LEAD_DISPATCH_MAX_SECONDS (so it ends
+within that plus one LEAD_HTTP_TIMEOUT_SECONDS) and hands the leads it
+claimed but did not send back to the queue for the next run.
+
+Sinks (LEAD_SINK):
+- file (default): appends one JSON line per lead to
+  LEAD_DROP_DIR/<lender_id>.ndjson
+- http: POSTs {"lenderId": ..., "leads": [...]} to LEAD_HTTP_URL, which may
+  contain {lender_id}; any non-2xx response is a failed attempt.
+  `python leads.py stub [--port 8081]` runs a local stand-in lender endpoint
+  that logs and accepts every batch.
+
+Run it in-process every LEAD_DISPATCH_INTERVAL_SECONDS (see
+server.start_background_jobs), or from cron with:
+    python leads.py dispatch
+"""
+import os
+import sys
+import json
+import argparse
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from itertools import groupby
+
+import requests
+
+import database
+from storage import store
+
+LEAD_SINK = os.environ.get('LEAD_SINK', 'file')
+LEAD_DROP_DIR = os.environ.get('LEAD_DROP_DIR', os.path.join(os.path.dirname(database.DATABASE_PATH), 'leads'))
+LEAD_HTTP_URL = os.environ.get('LEAD_HTTP_URL', '')
+LEAD_HTTP_TIMEOUT = float(os.environ.get('LEAD_HTTP_TIMEOUT_SECONDS', '10'))
+LEAD_BATCH_SIZE = int(os.environ.get('LEAD_BATCH_SIZE', '50'))
+LEAD_MAX_ATTEMPTS = int(os.environ.get('LEAD_MAX_ATTEMPTS', '6'))
+LEAD_RETRY_SECONDS = int(os.environ.get('LEAD_RETRY_SECONDS', '30'))
+LEAD_RETRY_MAX_SECONDS = int(os.environ.get('LEAD_RETRY_MAX_SECONDS', '3600'))
+# Leads claimed per dispatch run, and how long a claim lasts before another run may retake it
+LEAD_CLAIM_LIMIT = int(os.environ.get('LEAD_CLAIM_LIMIT', '500'))
+LEAD_CLAIM_SECONDS = int(os.environ.get('LEAD_CLAIM_SECONDS', '300'))
+# Wall time after which an in-process run stops starting batches (0: no limit)
+LEAD_DISPATCH_MAX_SECONDS = float(os.environ.get('LEAD_DISPATCH_MAX_SECONDS', '15'))
+
+
+def lead_payload(row):
+    return {
+        'leadId': row['id'],
+        'phone': row['phone_number'],
+        'lenderId': row['lender_id'],
+        'lenderName': row['lender_name'],
+        'requestedAt': row['created_at']
+    }
+
+
+class FileSink:
+    """One NDJSON drop file per lender"""
+    name = 'file'
+
+    def __init__(self, directory=None):
+        self.directory = directory or LEAD_DROP_DIR
+        self._lock = threading.Lock()
+
+    def deliver(self, lender_id, leads):
+        os.makedirs(self.directory, exist_ok=True)
+        lines = ''.join(json.dumps(lead) + '\n' for lead in leads)
+        with self._lock, open(os.path.join(self.directory, f'{lender_id}.ndjson'), 'a') as f:
+            f.write(lines)
+
+
+class HttpSink:
+    """POST each batch to the lender's endpoint"""
+    name = 'http'
+
+    def __init__(self, url=None, timeout=None):
+        self.url = url or LEAD_HTTP_URL
+        self.timeout = timeout or LEAD_HTTP_TIMEOUT
+        if not self.url:
+            raise ValueError('LEAD_HTTP_URL is required for the http lead sink')
+        self.session = requests.Session()
+
+    def deliver(self, lender_id, leads):
+        response = self.session.post(self.url.format(lender_id=lender_id),
+                                     json={'lenderId': lender_id, 'leads': leads}, timeout=self.timeout)
+        response.raise_for_status()
+
+
+SINKS = {sink.name: sink for sink in (FileSink, HttpSink)}
+
+_sink = {'pid': None, 'sink': None}
+
+
+def get_sink():
+    """This process's configured sink, created on first use"""
+    if _sink['pid'] != os.getpid():
+        _sink.update(pid=os.getpid(), sink=SINKS[LEAD_SINK]())
+    return _sink['sink']
+
+
+def dispatch_leads(sink=None, max_seconds=None):
+    """
+    Deliver the leads that are due, starting batches for at most max_seconds
+    (default LEAD_DISPATCH_MAX_SECONDS, 0: no limit). Returns
+    {'delivered': n, 'retried': n, 'released': n}.
+    """
+    sink = sink or get_sink()
+    max_seconds = LEAD_DISPATCH_MAX_SECONDS if max_seconds is None else max_seconds
+    deadline = time.monotonic() + max_seconds if max_seconds else None
+    counts = {'delivered': 0, 'retried': 0, 'released': 0}
+    due = store.lender_connections.claim_due(LEAD_CLAIM_LIMIT, LEAD_CLAIM_SECONDS)
+    unsent = []
+    for lender_id, rows in groupby(sorted(due, key=lambda r: r['lender_id']), key=lambda r: r['lender_id']):
+        rows = list(rows)
+        for n in range(0, len(rows), LEAD_BATCH_SIZE):
+            batch = rows[n:n + LEAD_BATCH_SIZE]
+            ids = [row['id'] for row in batch]
+            if deadline is not None and time.monotonic() >= deadline:
+                unsent.extend(ids)
+                continue
+            try:
+                sink.deliver(lender_id, [lead_payload(row) for row in batch])
+            except Exception as e:
+                print(f"Lead delivery to {lender_id} failed ({len(batch)} leads): {str(e)}", file=sys.stderr)
+                store.lender_connections.mark_attempt_failed(
+                    ids, e, LEAD_MAX_ATTEMPTS, LEAD_RETRY_SECONDS, LEAD_RETRY_MAX_SECONDS)
+                counts['retried'] += len(batch)
+                continue
+            store.lender_connections.mark_delivered(ids)
+            counts['delivered'] += len(batch)
+    if unsent:
+        counts['released'] = store.lender_connections.release(unsent)
+    if due:
+        print(f"Lead dispatch: {counts['delivered']} delivered, {counts['retried']} to retry, "
+              f"{counts['released']} left for the next run", file=sys.stderr)
+    return counts
+
+
+class StubLenderHandler(BaseHTTPRequestHandler):
+    """Accepts any lead batch, for trying the http sink locally"""
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        print(f"Stub lender {self.path}: {len(body.get('leads', []))} leads for {body.get('lenderId')}", file=sys.stderr)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(b'{"accepted": true}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Lender lead delivery')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('dispatch', help='Deliver every lead that is due now')
+    stub = subparsers.add_parser('stub', help='Serve a stand-in lender endpoint for the http sink')
+    stub.add_argument('--port', type=int, default=8081)
+
+    args = parser.parse_args(argv)
+    if args.command == 'stub':
+        print(f"Stub lender listening on http://127.0.0.1:{args.port}/", file=sys.stderr)
+        HTTPServer(('127.0.0.1', args.port), StubLenderHandler).serve_forever()
+        return
+    database.init_db()
+    if args.command == 'dispatch':
+        total = {'delivered': 0, 'retried': 0}
+        while True:
+            counts = dispatch_leads(max_seconds=0)
+            total = {key: total[key] + counts[key] for key in total}
+            if sum(counts.values()) < LEAD_CLAIM_LIMIT:
+                break
+        print(f"Delivered {total['delivered']} leads, {total['retried']} to retry", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
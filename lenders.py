@@ -0,0 +1,207 @@
+"""
+Lender matching.
+
+The partners (DIRECT_LENDERS, plus any from LENDERS_FILE) are indexed once
+per load. For each eligibility band there is a list of the lenders that
+accept that band, sorted by max_amount. match_lenders(score, amount, k)
+bisects the band cut-offs to find the score's band, then bisects that band's
+amounts for the first lender lending at least amount, and takes the k largest
+from there. A lookup is O(log n + k) however many partners are listed.
+
+LENDERS_FILE is a JSON object {lender_id: {name, type, max_amount, min_score,
+interest_rate, ...}} merged over the built-in partners. It is re-read when
+its mtime changes, checked at most every LENDERS_RELOAD_SECONDS, so partners
+can be added without a restart. The new index replaces the old one in a
+single assignment. A file that fails to load leaves the current index in
+place.
+"""
+import os
+import sys
+import json
+import time
+import threading
+from bisect import bisect_left, bisect_right
+
+LENDERS_FILE = os.environ.get('LENDERS_FILE', '')
+LENDERS_RELOAD_SECONDS = float(os.environ.get('LENDERS_RELOAD_SECONDS', '30'))
+
+# Score cut-offs of the eligibility bands, and the most a band may borrow
+# (the same bands reports.standing words as loan_eligibility)
+BAND_FLOORS = (400, 550, 700)
+BAND_LIMITS = (0, 50000, 200000, 500000)
+
+DIRECT_LENDERS = {
+    'mshwari': {
+        'name': 'M-Shwari',
+        'type': 'Instant Mobile Loans',
+        'max_amount': 50000,
+        'min_score': 400,
+        'interest_rate': '7.5% per month',
+        'contact': '+254700000001',
+        'badge': 'Pre-approved',
+        'color': 'green'
+    },
+    'tala': {
+        'name': 'Tala Kenya',
+        'type': 'Fast Approval Loans',
+        'max_amount': 50000,
+        'min_score': 400,
+        'interest_rate': '15% per month',
+        'contact': '+254700000002',
+        'badge': 'Verified Partner',
+        'color': 'blue'
+    },
+    'branch': {
+        'name': 'Branch Kenya',
+        'type': 'Flexible Repayment',
+        'max_amount': 70000,
+        'min_score': 400,
+        'interest_rate': '1-3% per day',
+        'contact': '+254700000003',
+        'badge': 'Trusted',
+        'color': 'purple'
+    },
+    'kcb': {
+        'name': 'KCB M-Pesa',
+        'type': 'Bank-backed Loans',
+        'max_amount': 1000000,
+        'min_score': 550,
+        'interest_rate': '1.083% per month',
+        'contact': '+254700000004',
+        'badge': 'Official Bank',
+        'color': 'orange'
+    },
+    'zenka': {
+        'name': 'Zenka Finance',
+        'type': 'Quick Cash Loans',
+        'max_amount': 30000,
+        'min_score': 400,
+        'interest_rate': '9% per month',
+        'contact': '+254700000005',
+        'badge': 'Fast Approval',
+        'color': 'teal'
+    },
+    'opesa': {
+        'name': 'OPesa Loans',
+        'type': 'Emergency Loans',
+        'max_amount': 25000,
+        'min_score': 400,
+        'interest_rate': '8% per month',
+        'contact': '+254700000006',
+        'badge': 'Quick Access',
+        'color': 'cyan'
+    },
+    'fuliza': {
+        'name': 'Fuliza by Safaricom',
+        'type': 'Overdraft Facility',
+        'max_amount': 100000,
+        'min_score': 550,
+        'interest_rate': '1% per day',
+        'contact': '+254700000007',
+        'badge': 'Official M-Pesa',
+        'color': 'green'
+    },
+    'equity': {
+        'name': 'Equity Bank EazzyLoan',
+        'type': 'Bank Loans',
+        'max_amount': 500000,
+        'min_score': 700,
+        'interest_rate': '1.25% per month',
+        'contact': '+254700000008',
+        'badge': 'Premium Bank',
+        'color': 'red'
+    }
+}
+
+
+def band_for(score):
+    """Eligibility band of a credit score: 0 (not eligible) to len(BAND_FLOORS)"""
+    return bisect_right(BAND_FLOORS, score)
+
+
+class LenderIndex:
+    """Lenders per eligibility band, sorted by max_amount, with a parallel list of amounts to bisect"""
+
+    def __init__(self, lenders):
+        self.by_id = lenders
+        ordered = sorted(({'id': lender_id, **lender} for lender_id, lender in lenders.items()),
+                         key=lambda lender: (lender['max_amount'], lender['id']))
+        self.bands = []
+        for band in range(len(BAND_LIMITS)):
+            eligible = [lender for lender in ordered if band > 0 and band_for(lender.get('min_score', 0)) <= band]
+            self.bands.append((eligible, [lender['max_amount'] for lender in eligible]))
+
+    def match(self, score, amount=0, k=5):
+        band = band_for(score)
+        if amount > BAND_LIMITS[band]:
+            return []
+        lenders, amounts = self.bands[band]
+        start = max(bisect_left(amounts, amount), len(lenders) - k)
+        return [recommendation(lender, BAND_LIMITS[band]) for lender in reversed(lenders[start:])]
+
+
+def recommendation(lender, limit):
+    """The shape shown in the report and PDF; crb_reports keeps only the lender ids"""
+    return {
+        'id': lender['id'],
+        'name': lender['name'],
+        'type': lender.get('type', ''),
+        'max_loan': min(lender['max_amount'], limit),
+        'rate': lender.get('interest_rate', '')
+    }
+
+
+def load_lenders(path):
+    """DIRECT_LENDERS merged with the partners in path; raises ValueError on a malformed file"""
+    lenders = dict(DIRECT_LENDERS)
+    if path:
+        with open(path) as f:
+            extra = json.load(f)
+        if not isinstance(extra, dict):
+            raise ValueError('LENDERS_FILE must hold an object keyed by lender id')
+        for lender_id, lender in extra.items():
+            if not isinstance(lender, dict) or not lender.get('name') or not isinstance(lender.get('max_amount'), (int, float)):
+                raise ValueError(f'Lender {lender_id} needs a name and a numeric max_amount')
+            lenders[lender_id] = lender
+    return lenders
+
+
+_lock = threading.Lock()
+_state = {'index': LenderIndex(DIRECT_LENDERS), 'mtime': None, 'checked': 0.0}
+
+
+def reload_lenders(force=False):
+    """Rebuild the index if LENDERS_FILE changed (or force). Returns True if it was rebuilt."""
+    with _lock:
+        _state['checked'] = time.monotonic()
+        try:
+            mtime = os.path.getmtime(LENDERS_FILE) if LENDERS_FILE else None
+        except OSError:
+            mtime = None
+        if mtime == _state['mtime'] and not force:
+            return False
+        try:
+            index = LenderIndex(load_lenders(LENDERS_FILE if mtime else None))
+        except (OSError, ValueError) as e:
+            print(f"Keeping current lenders, could not load {LENDERS_FILE}: {str(e)}", file=sys.stderr)
+            _state['mtime'] = mtime
+            return False
+        _state.update(index=index, mtime=mtime)
+        print(f"Loaded {len(index.by_id)} lenders", file=sys.stderr)
+        return True
+
+
+def get_lender_index():
+    if LENDERS_FILE and time.monotonic() - _state['checked'] >= LENDERS_RELOAD_SECONDS:
+        reload_lenders()
+    return _state['index']
+
+
+def find_lender(lender_id):
+    """A partner by id, or None"""
+    return get_lender_index().by_id.get(lender_id)
+
+
+def match_lenders(score, amount=0, k=5):
+    """Up to k lenders for this score that lend at least amount, largest first"""
+    return get_lender_index().match(score, amount, k)
@@ -0,0 +1,258 @@
+"""
+Lazily created, per-process Lipana clients.
+
+Nothing here runs at import time. The Lipana SDK client and the plain HTTP
+session used for direct API calls are built on first use and remembered for
+the current PID, so a gunicorn worker never reuses sockets created in the
+master before fork.
+
+AsyncLipanaClient is the non-blocking counterpart used by asgi.py. It needs
+the optional httpx dependency.
+"""
+import os
+import sys
+import threading
+import requests
+from lipana import Lipana, LipanaError
+
+# LIPANA_BASE_URL points every client at a stand-in, e.g. `python replay.py fake-lipana`
+LIPANA_BASE_URL = os.environ.get('LIPANA_BASE_URL', '').rstrip('/')
+LIPANA_API_URL = LIPANA_BASE_URL or 'https://api.lipana.dev/v1'
+LIPANA_SANDBOX_URL = LIPANA_BASE_URL or 'https://api-sandbox.lipana.dev/v1'
+
+_lock = threading.Lock()
+_state = {'pid': None, 'client': None, 'client_ready': False, 'session': None}
+
+
+def get_api_key():
+    return os.environ.get('LIPANA_API_KEY', '')
+
+
+def get_lipana_environment(api_key):
+    # Determine environment based on key prefix
+    if api_key.startswith('lip_sk_test_') or api_key.startswith('lip_pk_test_'):
+        return 'sandbox'
+    return 'production'  # Default to production (sandbox not always available)
+
+
+def _check_pid():
+    pid = os.getpid()
+    if _state['pid'] != pid:
+        _state.update(pid=pid, client=None, client_ready=False, session=None)
+
+
+def get_lipana_client():
+    """Return this process's Lipana client, or None if no API key is configured"""
+    with _lock:
+        _check_pid()
+        if _state['client_ready']:
+            return _state['client']
+
+        api_key = get_api_key()
+        client = None
+        if api_key:
+            lipana_env = get_lipana_environment(api_key)
+            try:
+                client = Lipana(api_key=api_key, environment=lipana_env, base_url=LIPANA_BASE_URL or None)
+                print(f"Lipana SDK initialized ({lipana_env}) in pid {os.getpid()}", file=sys.stderr)
+            except Exception as e:
+                print(f"Failed to initialize Lipana SDK: {str(e)}", file=sys.stderr)
+        else:
+            print("LIPANA_API_KEY not configured; payments are disabled", file=sys.stderr)
+
+        _state['client'] = client
+        _state['client_ready'] = True
+        return client
+
+
+def get_http_session():
+    """Keep-alive HTTP session for direct Lipana API calls"""
+    with _lock:
+        _check_pid()
+        if _state['session'] is None:
+            session = requests.Session()
+            session.headers.update({
+                'x-api-key': get_api_key(),
+                'Content-Type': 'application/json'
+            })
+            _state['session'] = session
+        return _state['session']
+
+
+def reset_clients():
+    """Drop cached clients, e.g. in a gunicorn post_fork hook"""
+    with _lock:
+        _state.update(pid=os.getpid(), client=None, client_ready=False, session=None)
+
+
+def lipana_status_to_db(lipana_status):
+    """Map a Lipana transaction status to ours: 'completed', 'failed' or None"""
+    lipana_status = (lipana_status or '').lower()
+    if lipana_status == 'success' or lipana_status == 'completed':
+        return 'completed'
+    elif lipana_status == 'failed' or lipana_status == 'cancelled':
+        return 'failed'
+    return None
+
+
+def parse_retrieved_transaction(status_response):
+    """(status, mpesa_receipt) from a transactions.retrieve() response"""
+    mpesa_receipt = status_response.get('mpesaReceiptNumber') or status_response.get('receipt')
+    return lipana_status_to_db(status_response.get('status', '')), mpesa_receipt
+
+
+def parse_listed_status(txn):
+    """(status, mpesa_receipt) from one entry of a /transactions listing"""
+    metadata = txn.get('metadata', {})
+    mpesa_receipt = metadata.get('mpesaReceiptNumber') or txn.get('mpesaReceiptNumber')
+    return lipana_status_to_db(txn.get('status', '')), mpesa_receipt
+
+
+def parse_listed_transaction(api_response, transaction_id):
+    """(status, mpesa_receipt) for transaction_id in a /transactions listing, or None if absent"""
+    for txn in api_response.get('data', []):
+        if txn.get('transactionId') == transaction_id:
+            print(f"Found transaction in list: {txn}", file=sys.stderr)
+            return parse_listed_status(txn)
+    return None
+
+
+LIPANA_LIST_PAGE_SIZE = int(os.environ.get('LIPANA_LIST_PAGE_SIZE', '100'))
+LIPANA_LIST_MAX_PAGES = int(os.environ.get('LIPANA_LIST_MAX_PAGES', '50'))
+
+
+def list_transaction_statuses(transaction_ids, start_date=None, end_date=None):
+    """
+    Statuses of many transactions from the /transactions listing, paged
+    through the start_date..end_date window (YYYY-MM-DD) until every id is
+    found, a short page ends the listing, or LIPANA_LIST_MAX_PAGES is
+    reached: {transaction_id: (status, mpesa_receipt)} for the ids Lipana
+    lists (status None: not final). Ids it does not list are left out.
+    Raises if a page cannot be fetched.
+    """
+    wanted = set(transaction_ids)
+    found = {}
+    params = {'limit': LIPANA_LIST_PAGE_SIZE}
+    if start_date:
+        params['startDate'] = start_date
+    if end_date:
+        params['endDate'] = end_date
+    for page in range(1, LIPANA_LIST_MAX_PAGES + 1):
+        response = get_http_session().get(f"{LIPANA_API_URL}/transactions", params=dict(params, page=page), timeout=15)
+        response.raise_for_status()
+        listed = response.json().get('data', [])
+        for txn in listed:
+            if txn.get('transactionId') in wanted:
+                found[txn['transactionId']] = parse_listed_status(txn)
+        if len(found) == len(wanted) or len(listed) < LIPANA_LIST_PAGE_SIZE:
+            break
+    return found
+
+
+def query_transaction_status(transaction_id):
+    """
+    Ask Lipana for a transaction's status: the SDK first, then the
+    transactions list. Returns (status, mpesa_receipt); status is None when
+    Lipana has no final answer yet.
+    """
+    new_status = None
+    mpesa_receipt = None
+
+    lipana_client = get_lipana_client()
+    if lipana_client:
+        try:
+            print(f"Querying Lipana SDK for transaction status: {transaction_id}", file=sys.stderr)
+            status_response = lipana_client.transactions.retrieve(transaction_id)
+            print(f"Lipana SDK response: {status_response}", file=sys.stderr)
+            new_status, mpesa_receipt = parse_retrieved_transaction(status_response)
+        except Exception as sdk_error:
+            print(f"SDK error, trying direct API: {str(sdk_error)}", file=sys.stderr)
+
+    if not new_status and get_api_key():
+        try:
+            print(f"Querying Lipana transactions list for: {transaction_id}", file=sys.stderr)
+            response = get_http_session().get(f"{LIPANA_API_URL}/transactions", timeout=15)
+            print(f"Lipana API response status: {response.status_code}", file=sys.stderr)
+
+            if response.status_code == 200:
+                listed = parse_listed_transaction(response.json(), transaction_id)
+                if listed:
+                    new_status, mpesa_receipt = listed
+        except Exception as api_error:
+            print(f"Direct API error: {str(api_error)}", file=sys.stderr)
+
+    return new_status, mpesa_receipt
+
+
+class AsyncLipanaClient:
+    """Non-blocking Lipana client on a pooled httpx.AsyncClient"""
+
+    def __init__(self, api_key, environment='production', timeout=30, max_connections=500):
+        import httpx
+
+        self.api_key = api_key
+        base_url = LIPANA_SANDBOX_URL if environment == 'sandbox' else LIPANA_API_URL
+        self.http = httpx.AsyncClient(
+            base_url=base_url,
+            headers={
+                'Content-Type': 'application/json',
+                'User-Agent': 'MetroCheck-Async/1.0',
+                'x-api-key': api_key
+            },
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=100)
+        )
+        # The transactions list fallback always hits production, like the sync path
+        self.list_url = f"{LIPANA_API_URL}/transactions"
+
+    async def _request(self, method, path, **kwargs):
+        response = await self.http.request(method, path, **kwargs)
+        try:
+            data = response.json()
+        except ValueError:
+            data = {}
+        if not response.is_success:
+            message = data.get('message', response.reason_phrase or 'An error occurred')
+            raise LipanaError(message, response.status_code, data.get('code'), data.get('errors', {}))
+        return data.get('data', data)
+
+    async def initiate_stk_push(self, phone, amount):
+        return await self._request('POST', '/transactions/push-stk', json={'phone': phone, 'amount': amount})
+
+    async def retrieve(self, transaction_id):
+        return await self._request('GET', f'/transactions/{transaction_id}')
+
+    async def query_transaction_status(self, transaction_id):
+        """Async twin of query_transaction_status()"""
+        new_status = None
+        mpesa_receipt = None
+
+        try:
+            status_response = await self.retrieve(transaction_id)
+            new_status, mpesa_receipt = parse_retrieved_transaction(status_response)
+        except Exception as sdk_error:
+            print(f"Async retrieve error, trying transactions list: {str(sdk_error)}", file=sys.stderr)
+
+        if not new_status:
+            try:
+                response = await self.http.get(self.list_url, timeout=15)
+                if response.status_code == 200:
+                    listed = parse_listed_transaction(response.json(), transaction_id)
+                    if listed:
+                        new_status, mpesa_receipt = listed
+            except Exception as api_error:
+                print(f"Direct API error: {str(api_error)}", file=sys.stderr)
+
+        return new_status, mpesa_receipt
+
+    async def aclose(self):
+        await self.http.aclose()
+
+
+def create_async_lipana_client():
+    """AsyncLipanaClient for the configured key, or None if no key is set"""
+    api_key = get_api_key()
+    if not api_key:
+        print("LIPANA_API_KEY not configured; payments are disabled", file=sys.stderr)
+        return None
+    return AsyncLipanaClient(api_key, environment=get_lipana_environment(api_key))
@@ -0,0 +1,196 @@
+"""
+Payment initiation pipeline.
+
+The three initiation endpoints (/api/payment/initiate,
+/functions/v1/initiate-payment and /api/upgrade/initiate) all run the same
+stages:
+
+    validate -> price -> reserve -> dispatch -> record -> respond
+
+validate, price and respond are route specific and come from a
+PaymentPipeline. reserve, dispatch and record are shared here. A request
+uses a single SQLite connection, opened only once validation has passed. It
+commits twice: the pending row before the STK push, so a crash mid-push
+still leaves a trace, and the outcome after it. No transaction is open while
+waiting on Lipana.
+"""
+import sys
+
+from analytics import record_event
+from payment_states import transition, RETURNING
+from sharding import NEXT_PAYMENT_ID
+
+
+class PaymentError(Exception):
+    """Raised by a stage to stop the pipeline and send (body, status)"""
+
+    def __init__(self, body, status=400):
+        super().__init__(body.get('error'))
+        self.body = body
+        self.status = status
+
+
+class PaymentContext:
+    """State carried through the stages of one initiation request"""
+
+    def __init__(self, data, connect):
+        self.data = data
+        self.phone = None
+        self.amount = None
+        self.bundle_name = None
+        self.target_package = None
+        self.payment_id = None
+        self.checkout_id = None
+        self.transaction_id = None
+        self.record = None
+        self.error = None
+        self._connect = connect
+        self._conn = None
+
+    @property
+    def conn(self):
+        # Opened after validation, so a sharded store can route by phone
+        if self._conn is None:
+            self._conn = self._connect(self.phone)
+        return self._conn
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class PaymentPipeline:
+    """The route-specific stages of an initiation endpoint"""
+
+    def __init__(self, name, validate, price, respond, unconfigured_message):
+        self.name = name
+        self.validate = validate
+        self.price = price
+        self.respond = respond
+        self.unconfigured_message = unconfigured_message
+
+
+def parse_stk_response(stk_response):
+    """(checkout_id, transaction_id) from an STK push response, top level or under 'data'"""
+    checkout_id = stk_response.get('checkoutRequestID') or stk_response.get('checkoutRequestId')
+    transaction_id = stk_response.get('transactionId')
+
+    data_obj = stk_response.get('data')
+    if isinstance(data_obj, dict):
+        checkout_id = checkout_id or data_obj.get('checkoutRequestID') or data_obj.get('checkoutRequestId')
+        transaction_id = transaction_id or data_obj.get('transactionId')
+
+    return checkout_id, transaction_id
+
+
+def reserve_payment(ctx, shard=None):
+    """Insert the pending row; shard is encoded in its id when the store is sharded"""
+    ctx.record = ctx.conn.execute(f'''
+        INSERT INTO payments (id, phone_number, amount, bundle_name, status, status_source)
+        VALUES ({NEXT_PAYMENT_ID}, ?, ?, ?, 'pending', 'initiate')
+        RETURNING {RETURNING}
+    ''', (shard, ctx.phone, ctx.amount, ctx.bundle_name)).fetchall()[0]
+    ctx.payment_id = ctx.record['id']
+    record_event(ctx.conn, 'payments_initiated', ctx.bundle_name, ctx.amount)
+    ctx.conn.commit()
+
+
+def dispatch_stk_push(ctx, client):
+    phone_with_plus = f'+{ctx.phone}'
+    print(f"Initiating STK push via SDK for {phone_with_plus}, amount: {int(ctx.amount)}", file=sys.stderr)
+    try:
+        stk_response = client.transactions.initiate_stk_push(
+            phone=phone_with_plus,
+            amount=int(ctx.amount)
+        )
+        print(f"SDK STK push response: {stk_response}", file=sys.stderr)
+        ctx.checkout_id, ctx.transaction_id = parse_stk_response(stk_response)
+    except Exception as sdk_error:
+        ctx.error = str(sdk_error)
+        print(f"SDK STK push error: {ctx.error}", file=sys.stderr)
+
+
+async def dispatch_stk_push_async(ctx, client):
+    phone_with_plus = f'+{ctx.phone}'
+    try:
+        stk_response = await client.initiate_stk_push(phone_with_plus, int(ctx.amount))
+        ctx.checkout_id, ctx.transaction_id = parse_stk_response(stk_response)
+    except Exception as sdk_error:
+        ctx.error = str(sdk_error)
+        print(f"Async STK push error: {ctx.error}", file=sys.stderr)
+
+
+def record_dispatch(ctx):
+    if ctx.error:
+        rows = transition(ctx.conn, 'failed', 'initiate', 'id', ctx.payment_id, expected='pending',
+                          result_description=ctx.error)
+    else:
+        rows = transition(ctx.conn, 'processing', 'initiate', 'id', ctx.payment_id, expected='pending',
+                          checkout_request_id=ctx.checkout_id, transaction_id=ctx.transaction_id)
+    ctx.conn.commit()
+    ctx.record = rows[0] if rows else ctx.record
+
+
+class PaymentService:
+    """
+    Runs initiation pipelines against a connection factory and Lipana client.
+
+    connect(phone) opens the database holding that phone's rows. The optional
+    id_shard(phone) hook lets a sharded store encode the shard in each new
+    payment id. remember_payment(row), if given, is called with the payment
+    row after each commit (see recent_payments.py).
+    """
+
+    def __init__(self, connect, get_client, id_shard=None, remember_payment=None):
+        self.connect = connect
+        self.get_client = get_client
+        self.id_shard = id_shard
+        self.remember_payment = remember_payment
+
+    def _remember(self, ctx):
+        if self.remember_payment and ctx.record is not None:
+            self.remember_payment(ctx.record)
+
+    def _prepare(self, pipeline, ctx, client):
+        pipeline.validate(ctx)
+        pipeline.price(ctx)
+        if not client:
+            raise PaymentError({'success': False, 'error': pipeline.unconfigured_message}, 500)
+        reserve_payment(ctx, self.id_shard(ctx.phone) if self.id_shard else None)
+        self._remember(ctx)
+
+    def _finish(self, pipeline, ctx):
+        record_dispatch(ctx)
+        self._remember(ctx)
+        if ctx.error:
+            return {'success': False, 'error': ctx.error}, 400
+        return pipeline.respond(ctx), 200
+
+    def initiate(self, pipeline, data):
+        """Run a pipeline synchronously. Returns (body, status)."""
+        ctx = PaymentContext(data, self.connect)
+        try:
+            client = self.get_client()
+            self._prepare(pipeline, ctx, client)
+            dispatch_stk_push(ctx, client)
+            return self._finish(pipeline, ctx)
+        except PaymentError as e:
+            return e.body, e.status
+        finally:
+            ctx.close()
+
+    async def initiate_async(self, pipeline, data, client, run_sync):
+        """
+        Run a pipeline on an event loop: DB stages go through run_sync (a
+        thread pool runner) and the STK push is awaited on an async client.
+        """
+        ctx = PaymentContext(data, self.connect)
+        try:
+            await run_sync(self._prepare, pipeline, ctx, client)
+            await dispatch_stk_push_async(ctx, client)
+            return await run_sync(self._finish, pipeline, ctx)
+        except PaymentError as e:
+            return e.body, e.status
+        finally:
+            await run_sync(ctx.close)
@@ -0,0 +1,106 @@
+"""
+Payment state machine.
+
+    pending -> processing -> completed
+       |           |            ^
+       |           +-> failed --+   (a late success confirmation still counts)
+       |           +-> expired -+
+       +-> completed / failed / expired
+
+completed is terminal. expired is set by the stuck-payment sweeper
+(sweeper.py) once the STK prompt has timed out. Every status change goes through transition(): one
+conditional UPDATE ... WHERE status IN (<states allowed to reach the target>)
+RETURNING the changed rows. A stale or out-of-order event (say a late
+"pending" webhook for a completed payment) matches no row. It is rejected
+without a read, and the caller learns whether the change applied from the
+returned rows.
+
+Triggers on payments (see database.init_db) append every insert and status
+change to payment_events (payment_id, from_status, to_status, source,
+created_at), tagged with the status_source the statement set. That gives an
+audit trail in the same transaction as the change.
+"""
+from datetime import datetime, timezone
+
+from analytics import record_event
+
+STATES = ('pending', 'processing', 'completed', 'failed', 'expired')
+
+TRANSITIONS = {
+    'pending': ('processing', 'completed', 'failed', 'expired'),
+    'processing': ('completed', 'failed', 'expired'),
+    'failed': ('completed',),
+    'expired': ('completed',),
+    'completed': ()
+}
+
+# Payments still waiting on Lipana: the only ones polled or swept
+ACTIVE_STATES = ('pending', 'processing')
+# The payment widgets stop polling on completed/failed only
+CLIENT_STATUSES = {'expired': 'failed'}
+
+# Columns a transition may set alongside the status
+TRANSITION_FIELDS = ('checkout_request_id', 'transaction_id', 'mpesa_receipt_number', 'result_description')
+MATCH_COLUMNS = ('id', 'checkout_request_id', 'transaction_id')
+RETURNING = '''id, phone_number, amount, bundle_name, status, checkout_request_id, transaction_id,
+               mpesa_receipt_number, result_description, created_at'''
+
+
+def can_transition(from_status, to_status):
+    return to_status in TRANSITIONS.get(from_status, ())
+
+
+def client_status(status):
+    """Status as reported to the check-status pollers"""
+    return CLIENT_STATUSES.get(status, status)
+
+
+def sources_for(to_status):
+    """States a payment may be in to move to to_status"""
+    return tuple(state for state, targets in TRANSITIONS.items() if to_status in targets)
+
+
+def transition(conn, to_status, source, match_column, match_value, expected=None, **fields):
+    """
+    Move the payments matching match_column = match_value (or any of a list of
+    values) to to_status, if their current status allows it. With expected,
+    only from that status (compare-and-set). Returns the changed rows; [] means
+    it was rejected or nothing matched. Counts terminal transitions; the
+    caller commits.
+    """
+    if match_column not in MATCH_COLUMNS:
+        raise ValueError(f'Cannot match payments on {match_column}')
+    unknown = set(fields) - set(TRANSITION_FIELDS)
+    if unknown:
+        raise ValueError(f"Cannot set {', '.join(sorted(unknown))} in a transition")
+
+    from_states = sources_for(to_status)
+    if expected is not None:
+        from_states = (expected,) if expected in from_states else ()
+    values = list(match_value) if isinstance(match_value, (list, tuple)) else [match_value]
+    if not from_states or not values:
+        return []
+
+    assignments = ['status = ?', 'status_source = ?', 'updated_at = ?'] + [f'{name} = ?' for name in fields]
+    # UTC in the CURRENT_TIMESTAMP format, like created_at and the live rollups
+    updated_at = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    params = [to_status, source, updated_at] + list(fields.values())
+    rows = conn.execute(f'''
+        UPDATE payments SET {', '.join(assignments)}
+        WHERE {match_column} IN ({','.join('?' * len(values))})
+          AND status IN ({','.join('?' * len(from_states))})
+        RETURNING {RETURNING}
+    ''', params + values + list(from_states)).fetchall()
+
+    if to_status in ('completed', 'failed', 'expired'):
+        for row in rows:
+            record_event(conn, f'payments_{to_status}', row['bundle_name'], row['amount'])
+    return rows
+
+
+def payment_history(conn, payment_id):
+    """A payment's transitions, oldest first"""
+    return conn.execute('''
+        SELECT from_status, to_status, source, created_at FROM payment_events
+        WHERE payment_id = ? ORDER BY id
+    ''', (payment_id,)).fetchall()
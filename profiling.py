@@ -0,0 +1,314 @@
+"""
+Opt-in per-request profiling.
+
+Profiling is off unless PROFILE_REQUESTS=1, in which case init_profiling()
+registers request hooks on the app. When it is off no hooks are installed, so
+requests pay nothing for it.
+
+A request is profiled when either:
+- it is picked by PROFILE_SAMPLE_RATE (0.0 - 1.0), or
+- it carries an X-Profile-Timestamp header (Unix seconds) and an
+  X-Profile-Signature header equal to
+  hex(HMAC-SHA256(PROFILE_SECRET, "<timestamp> <METHOD> <path>")).
+  Signatures more than PROFILE_SIGNATURE_MAX_AGE seconds (default 300) from
+  the server clock are ignored, so a captured one cannot be replayed later.
+
+PROFILE_MODE selects the profiler:
+- cprofile (default): deterministic, dumps a pstats file (<name>.prof). Only one
+  request per process is profiled at a time; a request picked while another
+  is being profiled runs unprofiled
+- sample: a background thread samples the request thread's stack every
+  PROFILE_INTERVAL_MS and dumps collapsed stacks (<name>.collapsed) that can be
+  fed straight to flamegraph.pl / speedscope.
+
+Dumps are written to PROFILE_DIR as <endpoint>--<timestamp>-<pid>.<ext>, and only
+the newest PROFILE_MAX_FILES are kept.
+
+Aggregate dumps per endpoint with:
+    python profiling.py aggregate [--dir PROFILE_DIR] [--endpoint NAME] [--top 25]
+"""
+import os
+import sys
+import hmac
+import time
+import random
+import hashlib
+import argparse
+import threading
+from collections import Counter
+from datetime import datetime
+
+from settings import env_float, env_int, env_flag
+
+PROFILE_HEADER = 'X-Profile-Signature'
+PROFILE_TIMESTAMP_HEADER = 'X-Profile-Timestamp'
+PROFILE_EXTENSIONS = ('.prof', '.collapsed')
+# Default under the code directory, so the dump location does not depend on the cwd
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles'))
+
+
+def profiling_enabled():
+    return env_flag('PROFILE_REQUESTS')
+
+
+def sign_request(secret, method, path, timestamp):
+    """Signature a client sends in X-Profile-Signature, with timestamp in X-Profile-Timestamp, to force profiling"""
+    message = f'{int(timestamp)} {method.upper()} {path}'.encode('utf-8')
+    return hmac.new(secret.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+
+class StackSampler:
+    """Samples one thread's stack at a fixed interval into collapsed stacks"""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}:{code.co_firstlineno}')
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+    def dump(self, path):
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+
+class RequestProfiler:
+    """Decides which requests to profile and writes their dumps"""
+
+    def __init__(self, directory, mode='cprofile', sample_rate=0.0, secret='',
+                 max_files=200, interval=0.005, max_age=300):
+        self.directory = directory
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.secret = secret
+        self.max_files = max_files
+        self.interval = interval
+        self.max_age = max_age
+        self._prune_lock = threading.Lock()
+        # One cProfile at a time: from Python 3.12 enabling a second one raises
+        self._cprofile_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_env(cls):
+        mode = os.environ.get('PROFILE_MODE', 'cprofile').lower()
+        if mode not in ('cprofile', 'sample'):
+            mode = 'cprofile'
+        return cls(
+            directory=PROFILE_DIR,
+            mode=mode,
+            sample_rate=env_float('PROFILE_SAMPLE_RATE', 0.0),
+            secret=os.environ.get('PROFILE_SECRET', ''),
+            max_files=env_int('PROFILE_MAX_FILES', 200),
+            interval=env_int('PROFILE_INTERVAL_MS', 5) / 1000.0,
+            max_age=env_int('PROFILE_SIGNATURE_MAX_AGE', 300)
+        )
+
+    def signature_valid(self, method, path, signature, timestamp, now=None):
+        if not (signature and timestamp and self.secret):
+            return False
+        try:
+            timestamp = int(timestamp)
+        except (TypeError, ValueError):
+            return False
+        now = time.time() if now is None else now
+        if abs(now - timestamp) > self.max_age:
+            return False
+        return hmac.compare_digest(sign_request(self.secret, method, path, timestamp), signature)
+
+    def should_profile(self, method, path, signature, timestamp=None):
+        if self.signature_valid(method, path, signature, timestamp):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def start(self):
+        """A running profiler for the current request, or None if cProfile is busy in another thread"""
+        if self.mode == 'sample':
+            sampler = StackSampler(threading.get_ident(), self.interval)
+            sampler.start()
+            return sampler
+
+        if not self._cprofile_lock.acquire(blocking=False):
+            return None
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another tool's profiler is active
+            self._cprofile_lock.release()
+            return None
+        return profiler
+
+    def finish(self, profiler, endpoint):
+        timestamp = datetime.now().strftime('%Y%m%dT%H%M%S%f')
+        name = f"{endpoint or 'unknown'}--{timestamp}-{os.getpid()}"
+
+        if isinstance(profiler, StackSampler):
+            profiler.stop()
+            path = os.path.join(self.directory, name + '.collapsed')
+            profiler.dump(path)
+        else:
+            try:
+                profiler.disable()
+            finally:
+                self._cprofile_lock.release()
+            path = os.path.join(self.directory, name + '.prof')
+            profiler.dump_stats(path)
+
+        self._prune()
+        return path
+
+    def _prune(self):
+        """Keep only the newest max_files dumps"""
+        if self.max_files <= 0:
+            return
+        with self._prune_lock:
+            try:
+                entries = [
+                    os.path.join(self.directory, f) for f in os.listdir(self.directory)
+                    if f.endswith(PROFILE_EXTENSIONS)
+                ]
+                if len(entries) <= self.max_files:
+                    return
+                entries.sort(key=os.path.getmtime)
+                for path in entries[:len(entries) - self.max_files]:
+                    os.remove(path)
+            except OSError as e:
+                print(f"Profile retention error: {str(e)}", file=sys.stderr)
+
+
+def init_profiling(app):
+    """Install profiling hooks on a Flask app if PROFILE_REQUESTS is set"""
+    if not profiling_enabled():
+        return None
+
+    from flask import g, request
+
+    request_profiler = RequestProfiler.from_env()
+    print(f"Request profiling enabled: mode={request_profiler.mode}, "
+          f"sample_rate={request_profiler.sample_rate}, dir={request_profiler.directory}", file=sys.stderr)
+
+    @app.before_request
+    def _start_profile():
+        signature = request.headers.get(PROFILE_HEADER, '')
+        timestamp = request.headers.get(PROFILE_TIMESTAMP_HEADER)
+        if not request_profiler.should_profile(request.method, request.path, signature, timestamp):
+            return
+        try:
+            profiler = request_profiler.start()
+        except Exception as e:
+            print(f"Profile start error: {str(e)}", file=sys.stderr)
+            return
+        if profiler is not None:
+            g._profiler = profiler
+            g._profile_started = time.perf_counter()
+
+    @app.teardown_request
+    def _finish_profile(exc):
+        profiler = g.pop('_profiler', None)
+        if profiler is None:
+            return
+        elapsed_ms = (time.perf_counter() - g.pop('_profile_started')) * 1000
+        try:
+            path = request_profiler.finish(profiler, request.endpoint)
+            print(f"Profiled {request.method} {request.path} ({elapsed_ms:.1f}ms) -> {path}", file=sys.stderr)
+        except Exception as e:
+            print(f"Profile dump error: {str(e)}", file=sys.stderr)
+
+    return request_profiler
+
+
+def _group_dumps(directory, endpoint=None):
+    groups = {}
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(PROFILE_EXTENSIONS):
+            continue
+        name = filename.split('--', 1)[0]
+        if endpoint and name != endpoint:
+            continue
+        groups.setdefault(name, []).append(os.path.join(directory, filename))
+    return groups
+
+
+def aggregate(directory, endpoint=None, top=25, out=None):
+    """Merge dumps per endpoint: pstats summaries and combined collapsed stacks"""
+    import pstats
+
+    groups = _group_dumps(directory, endpoint)
+    if not groups:
+        print(f"No profile dumps found in {directory}")
+        return {}
+
+    summary = {}
+    for name, paths in groups.items():
+        prof_files = [p for p in paths if p.endswith('.prof')]
+        collapsed_files = [p for p in paths if p.endswith('.collapsed')]
+        summary[name] = {'prof': len(prof_files), 'collapsed': len(collapsed_files)}
+
+        print(f"=== {name}: {len(prof_files)} pstats dumps, {len(collapsed_files)} collapsed dumps ===")
+
+        if prof_files:
+            stats = pstats.Stats(*prof_files, stream=sys.stdout)
+            stats.strip_dirs().sort_stats('cumulative').print_stats(top)
+
+        if collapsed_files:
+            merged = Counter()
+            for path in collapsed_files:
+                with open(path) as f:
+                    for line in f:
+                        stack, _, count = line.rstrip('\n').rpartition(' ')
+                        if stack and count.isdigit():
+                            merged[stack] += int(count)
+            if out:
+                os.makedirs(out, exist_ok=True)
+                merged_path = os.path.join(out, f'{name}.collapsed')
+                with open(merged_path, 'w') as f:
+                    for stack, count in merged.most_common():
+                        f.write(f'{stack} {count}\n')
+                print(f"Merged collapsed stacks written to {merged_path}")
+            total = sum(merged.values())
+            for stack, count in merged.most_common(top):
+                leaf = stack.rsplit(';', 1)[-1]
+                print(f"{count:8d} {100.0 * count / total:5.1f}%  {leaf}")
+
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Request profile tools')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    agg = subparsers.add_parser('aggregate', help='Aggregate profile dumps per endpoint')
+    agg.add_argument('--dir', default=PROFILE_DIR)
+    agg.add_argument('--endpoint', help='Only aggregate this endpoint')
+    agg.add_argument('--top', type=int, default=25, help='Rows to print per endpoint')
+    agg.add_argument('--out', help='Write merged collapsed stacks per endpoint to this directory')
+
+    args = parser.parse_args(argv)
+    if args.command == 'aggregate':
+        aggregate(args.dir, endpoint=args.endpoint, top=args.top, out=args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""
+Token-bucket rate limiting for the payment routes.
+
+Each route class has one budget per normalized phone and one per client IP,
+written capacity/seconds. A bucket holds up to capacity tokens and refills
+at capacity/seconds tokens per second, and each request takes one token.
+Buckets live in the rate_limit_buckets table of the main database, so every
+gunicorn worker draws from the same budget. Taking a token is a single
+UPSERT ... RETURNING.
+
+Override a budget with RATE_LIMIT_<CLASS>_<KIND>, e.g.
+RATE_LIMIT_INITIATE_PHONE=3/600. RATE_LIMITING=0 turns limiting off.
+Throttled requests are counted in the requests_throttled rollup
+(/api/admin/analytics) by route class and key kind.
+"""
+import os
+import sys
+import math
+import time
+import sqlite3
+
+import database
+from analytics import record_event
+
+RATE_LIMITING = os.environ.get('RATE_LIMITING', '1') != '0'
+# Proxies in front of the app that append to X-Forwarded-For. Must match the
+# real proxy chain (1 behind Replit's router): with more hops than proxies the
+# client picks its own address. 0 uses the socket peer and ignores the header.
+PROXY_HOPS = int(os.environ.get('RATE_LIMIT_PROXY_HOPS') or '0')
+
+DEFAULT_BUDGETS = {
+    # Every initiation sends an STK push and writes a payment
+    'initiate': {'ip': '30/600', 'phone': '5/600'},
+    # The payment widget polls check-status every 5 seconds
+    'status': {'ip': '120/60', 'phone': '30/60'}
+}
+
+TAKE_TOKEN = '''
+    INSERT INTO rate_limit_buckets (key, tokens, updated_at, allowed)
+    VALUES (:key, :capacity - 1, :now, 1)
+    ON CONFLICT (key) DO UPDATE SET
+        tokens = CASE WHEN MIN(:capacity, tokens + MAX(0, :now - updated_at) * :rate) >= 1
+                      THEN MIN(:capacity, tokens + MAX(0, :now - updated_at) * :rate) - 1
+                      ELSE MIN(:capacity, tokens + MAX(0, :now - updated_at) * :rate) END,
+        allowed = MIN(:capacity, tokens + MAX(0, :now - updated_at) * :rate) >= 1,
+        updated_at = :now
+    RETURNING tokens, allowed
+'''
+
+
+def parse_budget(spec):
+    """'capacity/seconds' -> (capacity, tokens per second)"""
+    capacity, seconds = (float(part) for part in spec.split('/'))
+    if capacity < 1 or seconds <= 0:
+        raise ValueError(f'Invalid rate limit budget: {spec}')
+    return capacity, capacity / seconds
+
+
+def load_budgets():
+    return {
+        route_class: {
+            kind: parse_budget(os.environ.get(f'RATE_LIMIT_{route_class.upper()}_{kind.upper()}', spec))
+            for kind, spec in kinds.items()
+        }
+        for route_class, kinds in DEFAULT_BUDGETS.items()
+    }
+
+
+BUDGETS = load_budgets()
+
+
+def client_ip(forwarded_for, remote_addr):
+    """
+    The client address: the socket peer when PROXY_HOPS is 0, else the
+    X-Forwarded-For entry added by the outermost of PROXY_HOPS trusted proxies
+    """
+    if not PROXY_HOPS:
+        return remote_addr or 'unknown'
+    hops = [hop.strip() for hop in (forwarded_for or '').split(',') if hop.strip()]
+    if len(hops) >= PROXY_HOPS:
+        return hops[-PROXY_HOPS]
+    return remote_addr or 'unknown'
+
+
+def take_token(conn, key, capacity, rate, now):
+    """Take a token from key's bucket. Returns 0, or the seconds until a token is available."""
+    tokens, allowed = conn.execute(TAKE_TOKEN, {
+        'key': key, 'capacity': capacity, 'rate': rate, 'now': now
+    }).fetchone()
+    if allowed:
+        return 0
+    return max(1, math.ceil((1 - tokens) / rate))
+
+
+def check_rate_limit(route_class, ip=None, phone=None):
+    """
+    Take a token from the caller's IP bucket, then phone bucket, for
+    route_class. Returns None if allowed, else the Retry-After in seconds.
+    Fails open if the bucket store is unavailable.
+    """
+    if not RATE_LIMITING:
+        return None
+    budgets = BUDGETS[route_class]
+    now = time.time()
+    try:
+        conn = database.get_db_connection()
+        try:
+            for kind, value in (('ip', ip), ('phone', phone)):
+                if not value:
+                    continue
+                retry_after = take_token(conn, f'{route_class}:{kind}:{value}', *budgets[kind], now)
+                if retry_after:
+                    record_event(conn, 'requests_throttled', f'{route_class}:{kind}')
+                    conn.commit()
+                    return retry_after
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"Rate limiter unavailable, allowing request: {str(e)}", file=sys.stderr)
+    return None
+
+
+def prune_buckets():
+    """Delete buckets idle long enough to have refilled completely; they start full anyway"""
+    longest = max(capacity / rate for kinds in BUDGETS.values() for capacity, rate in kinds.values())
+    conn = database.get_db_connection()
+    try:
+        deleted = conn.execute('DELETE FROM rate_limit_buckets WHERE updated_at < ?',
+                               (time.time() - longest,)).rowcount
+        conn.commit()
+        return deleted
+    finally:
+        conn.close()
@@ -0,0 +1,139 @@
+"""
+In-process index of recent payments for check-status.
+
+Check-status may try up to four SELECTs (payment id, checkout id,
+transaction id, phone) before it finds a row, and nearly every check is for
+a payment created in the last few minutes. RecentPayments keeps those
+payments in memory under all four keys. The initiation pipeline, the
+callback and check-status itself store each row after they commit a change,
+and a check-status that had to go to SQLite stores what it found.
+
+An entry lives until RECENT_PAYMENTS_TTL_SECONDS after the payment was
+created (below STK_TIMEOUT_SECONDS, so the sweeper never changes a payment
+that is still indexed), and at most RECENT_PAYMENTS_SIZE payments are kept,
+oldest dropped first.
+
+Each gunicorn worker has its own index, so another worker may have moved a
+payment on. A hit is therefore only served when that cannot matter:
+completed payments (terminal), and active payments with a transaction id,
+which check-status confirms with Lipana anyway; a stale active entry is
+corrected by the compare-and-set transition once Lipana has a final answer.
+A phone only knows the newest payment this worker saw, so a phone-only hit
+is served for active payments alone, and anything else falls through to
+SQLite.
+
+Amounts are stored as floats: an INSERT ... RETURNING row carries the value
+before the column's REAL affinity is applied (299, not 299.0).
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from records import Payment, from_mapping
+
+RECENT_PAYMENTS_TTL_SECONDS = float(os.environ.get('RECENT_PAYMENTS_TTL_SECONDS', '300'))
+RECENT_PAYMENTS_SIZE = int(os.environ.get('RECENT_PAYMENTS_SIZE', '10000'))
+
+
+def created_epoch(created_at):
+    """Seconds since the epoch for a CURRENT_TIMESTAMP value; now if it cannot be read"""
+    try:
+        return datetime.strptime(str(created_at)[:19], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return time.time()
+
+
+class RecentPayments:
+    def __init__(self, ttl=None, size=None):
+        self.ttl = RECENT_PAYMENTS_TTL_SECONDS if ttl is None else ttl
+        self.size = RECENT_PAYMENTS_SIZE if size is None else size
+        self._lock = threading.Lock()
+        # payment id -> (expires, payment), least recently stored first
+        self._payments = OrderedDict()
+        # ('checkout'|'transaction'|'phone', value) -> payment id
+        self._keys = {}
+
+    def _keys_for(self, payment):
+        keys = []
+        if payment.checkout_request_id:
+            keys.append(('checkout', payment.checkout_request_id))
+        if payment.transaction_id:
+            keys.append(('transaction', payment.transaction_id))
+        if payment.phone_number:
+            keys.append(('phone', payment.phone_number))
+        return keys
+
+    def _drop(self, payment_id):
+        _, payment = self._payments.pop(payment_id)
+        for key in self._keys_for(payment):
+            if self._keys.get(key) == payment_id:
+                del self._keys[key]
+
+    def _evict(self, now):
+        while self._payments:
+            payment_id, (expires, _) = next(iter(self._payments.items()))
+            if expires > now and len(self._payments) <= self.size:
+                break
+            self._drop(payment_id)
+
+    def remember(self, row):
+        """Store a payment (a Payment or a payments row); fields it lacks keep their indexed value"""
+        if not self.size or row is None:
+            return
+        payment = row if isinstance(row, Payment) else from_mapping(Payment, row)
+        if payment.id is None:
+            return
+        now = time.time()
+        with self._lock:
+            existing = self._payments.get(payment.id)
+            if existing:
+                payment = Payment(*(new if new is not None else old for new, old in zip(payment, existing[1])))
+            if payment.amount is not None:
+                payment = payment._replace(amount=float(payment.amount))
+            expires = created_epoch(payment.created_at) + self.ttl
+            if expires <= now:
+                if existing:
+                    self._drop(payment.id)
+                return
+            if existing:
+                self._drop(payment.id)
+            self._payments[payment.id] = (expires, payment)
+            for key in self._keys_for(payment):
+                previous = self._keys.get(key)
+                # A phone points at its newest payment
+                if key[0] != 'phone' or previous is None or previous < payment.id:
+                    self._keys[key] = payment.id
+            if len(self._payments) > self.size:
+                self._evict(now)
+
+    def find(self, payment_id=None, checkout_id=None, transaction_id=None, phone=None):
+        """
+        The indexed Payment for the most specific identifier given (the one
+        SQLite would be searched by first), or None
+        """
+        now = time.time()
+        with self._lock:
+            self._evict(now)
+            for kind, value in (('id', payment_id), ('checkout', checkout_id), ('transaction', transaction_id), ('phone', phone)):
+                if not value:
+                    continue
+                if kind == 'id':
+                    try:
+                        found = int(value)
+                    except (TypeError, ValueError):
+                        return None
+                else:
+                    found = self._keys.get((kind, value))
+                entry = self._payments.get(found)
+                return entry[1] if entry and entry[0] > now else None
+        return None
+
+    def clear(self):
+        with self._lock:
+            self._payments.clear()
+            self._keys.clear()
+
+
+recent_payments = RecentPayments()
@@ -0,0 +1,312 @@
+"""
+M-Pesa statement reconciliation.
+
+    python reconcile.py run statement.csv [--out DIR] [--since DATE] [--until DATE] [--apply]
+
+Reads a statement export (CSV, or NDJSON for .ndjson/.jsonl files) in chunks
+of RECONCILE_CHUNK_SIZE rows, so memory does not grow with the statement. Our
+side is loaded once per run into hash indexes: payments by
+mpesa_receipt_number and by transaction_id. Payments that have no receipt
+and are not completed are also indexed by (phone, amount), oldest first, so
+money that arrived without a callback can still be matched. Statement phones
+go through server.format_phone_number, which is cached.
+
+Four CSV reports are written to --out:
+- matched.csv: statement rows matched to a payment, how they matched
+  (receipt, transaction_id, phone_amount) and the action taken (ok, complete,
+  fail, amount_mismatch, conflict, duplicate, review)
+- missing_ours.csv: statement rows with no payment
+- missing_theirs.csv: completed payments in the window that the statement
+  does not list
+- unrecognised.csv: statement rows whose status is not one of
+  STATEMENT_STATUSES (reversals, pending, free-text result descriptions).
+  They are never corrected. A row without a status column counts as
+  completed.
+
+A match on phone and amount alone is only a guess, so it is reported as
+review and never corrected.
+
+With --apply, the complete and fail actions are applied through
+payment_states.transition() (source 'reconcile', compare-and-set on the status
+we saw), in one transaction per RECONCILE_BATCH_SIZE corrections per shard.
+Completed payments are granted access as a callback would.
+Archived payments are not considered.
+"""
+import os
+import sys
+import csv
+import json
+import argparse
+from collections import defaultdict, deque
+from itertools import islice
+
+import database
+from payment_states import transition
+from sharding import SHARD_COUNT, init_shards, connect_shard
+
+RECONCILE_CHUNK_SIZE = int(os.environ.get('RECONCILE_CHUNK_SIZE', '10000'))
+RECONCILE_BATCH_SIZE = int(os.environ.get('RECONCILE_BATCH_SIZE', '500'))
+
+# Statement column names (lower-cased) for each field, M-Pesa export names first
+STATEMENT_FIELDS = {
+    'receipt': ('receipt no.', 'receipt no', 'receipt', 'transid', 'mpesa_receipt_number', 'mpesareceiptnumber'),
+    'transaction_id': ('transaction id', 'transaction_id', 'transactionid'),
+    'amount': ('paid in', 'amount', 'transamount'),
+    'phone': ('msisdn', 'phone', 'phone_number', 'phonenumber'),
+    'status': ('transaction status', 'status', 'resultdesc'),
+    'time': ('completion time', 'transtime', 'time', 'created_at')
+}
+
+STATEMENT_STATUSES = {
+    'completed': 'completed', 'complete': 'completed', 'success': 'completed', 'successful': 'completed',
+    'failed': 'failed', 'cancelled': 'failed', 'canceled': 'failed', 'declined': 'failed'
+}
+
+REPORT_COLUMNS = {
+    'matched': ('receipt', 'transaction_id', 'payment_id', 'phone', 'amount', 'statement_amount',
+                'our_status', 'statement_status', 'matched_by', 'action'),
+    'missing_ours': ('receipt', 'transaction_id', 'phone', 'amount', 'status', 'time'),
+    'missing_theirs': ('payment_id', 'phone', 'amount', 'receipt', 'transaction_id', 'created_at'),
+    'unrecognised': ('receipt', 'transaction_id', 'payment_id', 'phone', 'amount', 'status', 'time')
+}
+
+# The action that brings our status in line with the statement's
+CORRECTIONS = {
+    ('completed', 'pending'): 'complete', ('completed', 'processing'): 'complete',
+    ('completed', 'failed'): 'complete', ('completed', 'expired'): 'complete',
+    ('failed', 'pending'): 'fail', ('failed', 'processing'): 'fail',
+    ('failed', 'completed'): 'conflict'
+}
+
+
+def cents(amount):
+    return round(float(str(amount).replace(',', '')) * 100)
+
+
+class PaymentIndex:
+    """Our payments in the window, keyed for statement lookups"""
+
+    def __init__(self):
+        self.by_receipt = {}
+        self.by_transaction = {}
+        self.unreceipted = defaultdict(deque)
+        self.completed = {}
+        self.seen = set()
+
+    def add(self, shard, row):
+        # (shard, id, status, amount, phone, receipt, transaction_id, created_at)
+        entry = (shard, row['id'], row['status'], row['amount'], row['phone_number'],
+                 row['mpesa_receipt_number'], row['transaction_id'], row['created_at'])
+        if row['mpesa_receipt_number']:
+            self.by_receipt[row['mpesa_receipt_number']] = entry
+        if row['transaction_id']:
+            self.by_transaction[row['transaction_id']] = entry
+        if row['status'] == 'completed':
+            self.completed[row['id']] = entry
+        elif not row['mpesa_receipt_number']:
+            self.unreceipted[(row['phone_number'], cents(row['amount']))].append(entry)
+
+    def match(self, receipt, transaction_id, phone, amount, completed=True):
+        """
+        (entry, matched_by) for the payment a statement row refers to, or
+        (None, None). Only completed rows match by phone and amount.
+        """
+        if receipt and receipt in self.by_receipt:
+            return self.by_receipt[receipt], 'receipt'
+        if transaction_id and transaction_id in self.by_transaction:
+            return self.by_transaction[transaction_id], 'transaction_id'
+        if completed and phone and amount is not None:
+            candidates = self.unreceipted.get((phone, amount))
+            while candidates:
+                candidate = candidates.popleft()
+                if candidate[1] not in self.seen:
+                    return candidate, 'phone_amount'
+        return None, None
+
+
+def load_index(since=None, until=None):
+    index = PaymentIndex()
+    for shard in range(SHARD_COUNT):
+        conn = connect_shard(shard)
+        try:
+            rows = conn.execute('''
+                SELECT id, phone_number, amount, status, mpesa_receipt_number, transaction_id, created_at
+                FROM payments WHERE created_at >= ? AND created_at < ?
+            ''', (since or '0000-01-01', until or '9999-12-31'))
+            for row in rows:
+                index.add(shard, row)
+        finally:
+            conn.close()
+    return index
+
+
+def field_map(keys):
+    """{field: statement key} for the keys of a statement row"""
+    lowered = {key.strip().lower(): key for key in keys if key}
+    mapping = {}
+    for field, names in STATEMENT_FIELDS.items():
+        for name in names:
+            if name in lowered:
+                mapping[field] = lowered[name]
+                break
+    return mapping
+
+
+def read_statement(path, fmt=None):
+    """Statement rows as {field: value} dicts, read lazily"""
+    fmt = fmt or ('ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv')
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        if fmt == 'csv':
+            reader = csv.DictReader(f)
+            mapping = field_map(reader.fieldnames or [])
+            for row in reader:
+                yield {field: row.get(key) for field, key in mapping.items()}
+        else:
+            mappings = {}
+            for line in f:
+                if not line.strip():
+                    continue
+                row = json.loads(line)
+                keys = tuple(row)
+                if keys not in mappings:
+                    mappings[keys] = field_map(keys)
+                yield {field: row.get(key) for field, key in mappings[keys].items()}
+
+
+class Corrections:
+    """Pending status corrections per shard, applied in batched transactions"""
+
+    def __init__(self, apply, on_completed=None):
+        self.apply = apply
+        self.on_completed = on_completed
+        self.pending = defaultdict(list)
+        self.applied = 0
+
+    def add(self, entry, to_status, receipt):
+        if not self.apply:
+            return
+        self.pending[entry[0]].append((entry[1], entry[2], to_status, receipt))
+        if len(self.pending[entry[0]]) >= RECONCILE_BATCH_SIZE:
+            self.flush(entry[0])
+
+    def flush(self, shard=None):
+        for shard in ([shard] if shard is not None else list(self.pending)):
+            batch, self.pending[shard] = self.pending[shard], []
+            if not batch:
+                continue
+            completed = []
+            conn = connect_shard(shard)
+            try:
+                for payment_id, expected, to_status, receipt in batch:
+                    fields = {'mpesa_receipt_number': receipt} if to_status == 'completed' and receipt else {}
+                    rows = transition(conn, to_status, 'reconcile', 'id', payment_id, expected=expected, **fields)
+                    self.applied += len(rows)
+                    if to_status == 'completed':
+                        completed.extend(rows)
+                conn.commit()
+            finally:
+                conn.close()
+            for row in completed:
+                if self.on_completed:
+                    self.on_completed(row['id'], row['phone_number'], row['bundle_name'], row['amount'])
+
+
+def reconcile_statement(path, out_dir, since=None, until=None, apply=False, fmt=None, on_completed=None):
+    """Reconcile a statement file against payments; writes the reports and returns counts"""
+    # Phone rules live in server.py
+    from server import format_phone_number
+
+    index = load_index(since, until)
+    corrections = Corrections(apply, on_completed)
+    counts = defaultdict(int)
+    os.makedirs(out_dir, exist_ok=True)
+    files = {name: open(os.path.join(out_dir, f'{name}.csv'), 'w', newline='') for name in REPORT_COLUMNS}
+    try:
+        writers = {name: csv.writer(files[name]) for name in REPORT_COLUMNS}
+        for name, columns in REPORT_COLUMNS.items():
+            writers[name].writerow(columns)
+
+        rows = read_statement(path, fmt)
+        while True:
+            chunk = list(islice(rows, RECONCILE_CHUNK_SIZE))
+            if not chunk:
+                break
+            for row in chunk:
+                counts['statement_rows'] += 1
+                receipt = (row.get('receipt') or '').strip()
+                transaction_id = (row.get('transaction_id') or '').strip()
+                phone = format_phone_number(str(row['phone'])) if row.get('phone') else None
+                try:
+                    amount = cents(row['amount']) if row.get('amount') not in (None, '') else None
+                except ValueError:
+                    amount = None
+                raw_status = str(row.get('status') or '').strip()
+                status = STATEMENT_STATUSES.get(raw_status.lower()) if raw_status else 'completed'
+                if status is None:
+                    entry, _ = index.match(receipt, transaction_id, phone, amount, completed=False)
+                    counts['unrecognised'] += 1
+                    writers['unrecognised'].writerow((receipt, transaction_id, entry[1] if entry else None, phone,
+                                                      row.get('amount'), raw_status, row.get('time')))
+                    continue
+
+                entry, matched_by = index.match(receipt, transaction_id, phone, amount, status == 'completed')
+                if entry is None:
+                    counts['missing_ours'] += 1
+                    writers['missing_ours'].writerow((receipt, transaction_id, phone,
+                                                      row.get('amount'), status, row.get('time')))
+                    continue
+
+                if entry[1] in index.seen:
+                    action = 'duplicate'
+                else:
+                    index.seen.add(entry[1])
+                    action = CORRECTIONS.get((status, entry[2]), 'ok')
+                    if action == 'ok' and amount is not None and amount != cents(entry[3]):
+                        action = 'amount_mismatch'
+                    if matched_by == 'phone_amount' and action != 'ok':
+                        action = 'review'
+                    if action in ('complete', 'fail'):
+                        corrections.add(entry, status, receipt)
+                counts[action] += 1
+                writers['matched'].writerow((receipt or entry[5], transaction_id or entry[6], entry[1], entry[4],
+                                             entry[3], row.get('amount'), entry[2], status, matched_by, action))
+            corrections.flush()
+
+        for payment_id, entry in index.completed.items():
+            if payment_id not in index.seen:
+                counts['missing_theirs'] += 1
+                writers['missing_theirs'].writerow((payment_id, entry[4], entry[3], entry[5], entry[6], entry[7]))
+    finally:
+        for f in files.values():
+            f.close()
+    counts['applied'] = corrections.applied
+    return dict(counts)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Reconcile an M-Pesa statement with payments')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run = subparsers.add_parser('run', help='Match a statement export against payments and write reports')
+    run.add_argument('statement', help='CSV export, or NDJSON (.ndjson/.jsonl)')
+    run.add_argument('--format', choices=('csv', 'ndjson'), help='Default: from the file extension')
+    run.add_argument('--out', default='reconciliation', help='Directory for the reports (default ./reconciliation)')
+    run.add_argument('--since', help='Only payments created at or after this UTC time (YYYY-MM-DD[ HH:MM:SS])')
+    run.add_argument('--until', help='Only payments created before this UTC time')
+    run.add_argument('--apply', action='store_true', help='Apply the complete/fail corrections')
+
+    args = parser.parse_args(argv)
+    database.init_db()
+    init_shards()
+    if args.command == 'run':
+        on_completed = None
+        if args.apply:
+            # Granting access needs the package rules in server.py
+            from server import grant_access_for_payment
+            on_completed = grant_access_for_payment
+        counts = reconcile_statement(args.statement, args.out, args.since, args.until,
+                                     args.apply, args.format, on_completed)
+        print(', '.join(f'{key} {value}' for key, value in sorted(counts.items())), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
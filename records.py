@@ -0,0 +1,160 @@
+"""
+Typed records for payment, entitlement and report rows.
+
+Payment, Entitlement and CrbReport are namedtuples (tuple-backed, no
+per-instance dict). A cursor with row_factory(RecordType) builds them straight
+from the result rows for any column subset: unselected fields are None and
+columns the type does not know are dropped. Fields are read as attributes
+(payment.status).
+
+Each API shape a record is returned in is one serializer, compiled once
+with serializer(): an itemgetter over the record plus the response keys, so
+a listing never builds an intermediate dict per row. The response shapes
+are the ones the frontend already reads, so payments have one per endpoint
+family (listing/export, check-status, status lookup, batch status).
+"""
+from collections import namedtuple
+from operator import attrgetter, itemgetter
+
+from payment_states import client_status
+
+PAYMENT_FIELDS = ('id', 'phone_number', 'amount', 'bundle_name', 'status', 'checkout_request_id',
+                  'merchant_request_id', 'transaction_id', 'mpesa_receipt_number', 'result_code',
+                  'result_description', 'status_source', 'created_at', 'updated_at')
+ENTITLEMENT_FIELDS = ('id', 'phone_number', 'package_type', 'payment_id', 'is_active', 'expires_at', 'created_at')
+REPORT_FIELDS = ('id', 'phone_number', 'credit_score', 'crb_status', 'loan_eligibility', 'credit_history',
+                 'detailed_analysis', 'lender_recommendations', 'created_at')
+
+
+class Payment(namedtuple('Payment', PAYMENT_FIELDS, defaults=(None,) * len(PAYMENT_FIELDS))):
+    __slots__ = ()
+
+
+class Entitlement(namedtuple('Entitlement', ENTITLEMENT_FIELDS, defaults=(None,) * len(ENTITLEMENT_FIELDS))):
+    __slots__ = ()
+
+
+class CrbReport(namedtuple('CrbReport', REPORT_FIELDS, defaults=(None,) * len(REPORT_FIELDS))):
+    __slots__ = ()
+
+
+def row_factory(record_type):
+    """A sqlite3 row factory building record_type; the column layout is worked out once per statement"""
+    fields = record_type._fields
+    new = tuple.__new__
+    state = (None, None)
+
+    def factory(cursor, row):
+        nonlocal state
+        description, positions = state
+        if description is not cursor.description:
+            description = cursor.description
+            columns = {column[0]: n for n, column in enumerate(description)}
+            positions = tuple(columns.get(field) for field in fields)
+            state = (description, positions)
+        return new(record_type, [None if n is None else row[n] for n in positions])
+    return factory
+
+
+def record_cursor(conn, factory):
+    """A cursor on conn whose rows are built by factory (PAYMENT_ROW, ...)"""
+    cursor = conn.cursor()
+    cursor.row_factory = factory
+    return cursor
+
+
+def from_mapping(record_type, mapping):
+    """record_type from a dict or sqlite3.Row, ignoring keys it does not know"""
+    fields = record_type._fields
+    return record_type(**{key: mapping[key] for key in mapping.keys() if key in fields})
+
+
+def serializer(record_type, shape, transforms=None):
+    """
+    Compile record -> API dict for shape {api_key: field}. transforms maps
+    an api_key to a function applied to its value. The returned function
+    also has .keys and .values(record) (the values in key order, for CSV).
+    """
+    keys = tuple(shape)
+    positions = [record_type._fields.index(field) for field in shape.values()]
+    getter = itemgetter(*positions) if len(positions) > 1 else (lambda record: (record[positions[0]],))
+    transforms = [(keys.index(key), func) for key, func in (transforms or {}).items()]
+
+    if transforms:
+        def values(record):
+            values = list(getter(record))
+            for n, func in transforms:
+                values[n] = func(values[n])
+            return values
+    else:
+        values = getter
+
+    def serialize(record):
+        return dict(zip(keys, values(record)))
+    serialize.keys = keys
+    serialize.values = values
+    return serialize
+
+
+PAYMENT_ROW = row_factory(Payment)
+ENTITLEMENT_ROW = row_factory(Entitlement)
+REPORT_ROW = row_factory(CrbReport)
+
+payment_sort_key = attrgetter('created_at', 'id')
+
+# /api/payments pages and exports
+PAYMENT_LIST = serializer(Payment, {
+    'id': 'id',
+    'phone': 'phone_number',
+    'amount': 'amount',
+    'bundleName': 'bundle_name',
+    'status': 'status',
+    'receipt': 'mpesa_receipt_number',
+    'checkoutId': 'checkout_request_id',
+    'createdAt': 'created_at'
+})
+
+# check-status (Flask and ASGI)
+PAYMENT_STATUS = serializer(Payment, {
+    'id': 'id',
+    'phone': 'phone_number',
+    'amount': 'amount',
+    'bundleName': 'bundle_name',
+    'status': 'status',
+    'mpesaReceiptNumber': 'mpesa_receipt_number',
+    'resultDesc': 'result_description',
+    'createdAt': 'created_at'
+}, transforms={'status': client_status})
+
+# GET /api/payment/status/<checkout_id>
+PAYMENT_LOOKUP = serializer(Payment, {
+    'id': 'id',
+    'phone': 'phone_number',
+    'amount': 'amount',
+    'bundleName': 'bundle_name',
+    'status': 'status',
+    'receipt': 'mpesa_receipt_number',
+    'message': 'result_description',
+    'createdAt': 'created_at'
+}, transforms={'status': client_status})
+
+# /api/payment/status/batch
+PAYMENT_BATCH = serializer(Payment, {
+    'paymentId': 'id',
+    'status': 'status',
+    'amount': 'amount',
+    'bundleName': 'bundle_name',
+    'receipt': 'mpesa_receipt_number',
+    'checkoutRequestId': 'checkout_request_id',
+    'transactionId': 'transaction_id',
+    'updatedAt': 'updated_at'
+})
+
+# The always-present part of /api/crb/report; tier-gated keys are removed by the route
+CRB_REPORT = serializer(CrbReport, {
+    'phone': 'phone_number',
+    'generatedAt': 'created_at',
+    'creditScore': 'credit_score',
+    'crbStatus': 'crb_status',
+    'loanEligibility': 'loan_eligibility'
+})
@@ -0,0 +1,303 @@
+"""
+Replay captured traffic against a local instance.
+
+    python replay.py fake-lipana [--port 8082] [--latency-ms 0] [--complete-after 5] [--fail-every 0]
+    python replay.py run captures/requests.jsonl [--target URL] [--speed 1x|4x|max] [--concurrency 32]
+    python replay.py compare baseline.jsonl candidate.jsonl
+
+A capture (see capture.py) is played back in arrival order. At 1x every
+request is sent at its captured offset from the first one, at Nx the gaps
+are divided by N, and at max the requests are sent as fast as --concurrency
+allows. The schedule only depends on the capture, so two runs at the same
+speed send the same requests at the same offsets; --concurrency 1 also fixes
+their order. Phones were pseudonymized consistently, so a status check by
+phone finds the payment the replay initiated earlier. Checkout and
+transaction ids from production do not exist locally and take the
+not-found path.
+
+Run the local instance against the stand-in Lipana, with rate limits off
+since all replayed traffic comes from one IP:
+    LIPANA_API_KEY=fake LIPANA_BASE_URL=http://127.0.0.1:8082 RATE_LIMITING=0 gunicorn server:app
+fake-lipana answers STK pushes with sequential ids, reports each transaction
+pending until --complete-after seconds have passed and then successful
+(every --fail-every th one failed), and adds --latency-ms to every call.
+
+run prints each route's replay latency (client side, so it includes HTTP
+overhead) next to the captured production timings. For a like-for-like
+server-side comparison, start the local instance with CAPTURE_REQUESTS=1
+CAPTURE_SAMPLE_RATE=1, replay, and compare the two captures.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import requests
+
+
+def read_capture(path, limit=None):
+    """Captured entries in arrival order; lines that are not entries are skipped"""
+    entries = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(entry, dict) and entry.get('path') and entry.get('at') is not None:
+                entries.append(entry)
+    entries.sort(key=lambda entry: entry['at'])
+    return entries[:limit] if limit else entries
+
+
+def parse_speed(text):
+    """'max' -> None, '4x' or '4' -> 4.0"""
+    if text.lower() == 'max':
+        return None
+    speed = float(text.lower().rstrip('x'))
+    if speed <= 0:
+        raise argparse.ArgumentTypeError('speed must be above 0')
+    return speed
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values))) - 1))]
+
+
+def distribution(values):
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': values[-1] if values else None
+    }
+
+
+class Replayer:
+    """Sends captured requests on their schedule and records the latencies"""
+
+    def __init__(self, target, speed=1.0, concurrency=32, timeout=30, headers=None):
+        self.target = target.rstrip('/')
+        self.speed = speed
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.headers = headers or {}
+        self.results = []
+        self.max_lag_ms = 0.0
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            session.headers.update(self.headers)
+        return session
+
+    def send(self, entry):
+        started = time.perf_counter()
+        try:
+            response = self._session().request(
+                entry['method'], self.target + entry['path'], params=entry.get('query') or None,
+                json=entry.get('body'), timeout=self.timeout
+            )
+            status = response.status_code
+        except requests.RequestException as e:
+            status = f'error: {e.__class__.__name__}'
+        self.results.append((entry.get('route') or entry['path'], (time.perf_counter() - started) * 1000, status))
+
+    def run(self, entries):
+        if not entries:
+            return self.results
+        first_at = entries[0]['at']
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            started = time.perf_counter()
+            for entry in entries:
+                if self.speed:
+                    delay = (entry['at'] - first_at) / self.speed - (time.perf_counter() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+                    else:
+                        self.max_lag_ms = max(self.max_lag_ms, -delay * 1000)
+                executor.submit(self.send, entry)
+        return self.results
+
+
+def route_report(replayed, captured):
+    """{route: {'replay': distribution, 'captured': distribution, 'statuses': {...}}}"""
+    replay_ms = defaultdict(list)
+    statuses = defaultdict(Counter)
+    for route, ms, status in replayed:
+        replay_ms[route].append(ms)
+        statuses[route][str(status)] += 1
+    captured_ms = defaultdict(list)
+    for entry in captured:
+        if entry.get('duration_ms') is not None:
+            captured_ms[entry.get('route') or entry['path']].append(entry['duration_ms'])
+    return {
+        route: {
+            'replay': distribution(replay_ms.get(route, [])),
+            'captured': distribution(captured_ms.get(route, [])),
+            'statuses': dict(statuses.get(route, {}))
+        }
+        for route in sorted(set(replay_ms) | set(captured_ms))
+    }
+
+
+def _ms(value):
+    return f'{value:9.1f}' if value is not None else f"{'-':>9}"
+
+
+def _ratio(new, old):
+    return f'{new / old:6.2f}x' if new is not None and old else f"{'-':>7}"
+
+
+def print_report(report, labels=('replay', 'captured'), out=sys.stdout):
+    new, old = labels
+    out.write(f"{'route':<44}{'n':>7}  {new + ' p50':>14}{'p90':>9}{'p99':>9}  "
+              f"{old + ' p50':>14}{'p90':>9}{'p99':>9}  {'p50':>7}{'p99':>8}\n")
+    for route, row in report.items():
+        a, b = row[new], row[old]
+        out.write(f"{route[:43]:<44}{a['count']:>7}  {_ms(a['p50']):>14}{_ms(a['p90'])}{_ms(a['p99'])}  "
+                  f"{_ms(b['p50']):>14}{_ms(b['p90'])}{_ms(b['p99'])}  "
+                  f"{_ratio(a['p50'], b['p50'])}{_ratio(a['p99'], b['p99']):>8}\n")
+        failures = {status: n for status, n in row.get('statuses', {}).items() if not status.startswith(('2', '3'))}
+        if failures:
+            out.write(f"{'':<44}statuses {failures}\n")
+
+
+def compare_captures(baseline_path, candidate_path):
+    """Server-side duration distributions of two captures, per route"""
+    candidate = [(entry.get('route') or entry['path'], entry['duration_ms'], entry.get('status'))
+                 for entry in read_capture(candidate_path) if entry.get('duration_ms') is not None]
+    report = route_report(candidate, read_capture(baseline_path))
+    return {route: {'candidate': row['replay'], 'baseline': row['captured'], 'statuses': row['statuses']}
+            for route, row in report.items()}
+
+
+class FakeLipanaHandler(BaseHTTPRequestHandler):
+    """The Lipana endpoints the app calls, answered from memory"""
+    latency = 0.0
+    complete_after = 5.0
+    fail_every = 0
+    transactions = {}
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _transaction(self, transaction_id):
+        n, created = self.transactions[transaction_id]
+        if time.monotonic() - created < self.complete_after:
+            return {'transactionId': transaction_id, 'status': 'pending'}
+        if self.fail_every and n % self.fail_every == 0:
+            return {'transactionId': transaction_id, 'status': 'failed'}
+        receipt = f'FAKE{n:06d}'
+        return {'transactionId': transaction_id, 'status': 'success', 'mpesaReceiptNumber': receipt,
+                'metadata': {'mpesaReceiptNumber': receipt}}
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.latency)
+        if self.path.rstrip('/').endswith('/transactions/push-stk'):
+            with self.lock:
+                n = len(self.transactions) + 1
+                transaction_id = f'TXN{n:08d}'
+                self.transactions[transaction_id] = (n, time.monotonic())
+            return self._reply(200, {'success': True, 'data': {
+                'transactionId': transaction_id, 'checkoutRequestID': f'ws_CO_FAKE{n:08d}', 'status': 'pending'}})
+        self._reply(404, {'message': 'Not found'})
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        path, _, query = self.path.partition('?')
+        path = path.rstrip('/')
+        if path.endswith('/transactions'):
+            # Newest first, paged like Lipana's listing
+            params = parse_qs(query)
+            limit = int(params.get('limit', ['50'])[0])
+            page = int(params.get('page', ['1'])[0])
+            with self.lock:
+                ids = list(reversed(self.transactions))[(page - 1) * limit:page * limit]
+            return self._reply(200, {'data': [self._transaction(transaction_id) for transaction_id in ids]})
+        transaction_id = path.rsplit('/', 1)[-1]
+        if '/transactions/' in path and transaction_id in self.transactions:
+            return self._reply(200, {'data': self._transaction(transaction_id)})
+        self._reply(404, {'message': 'Transaction not found'})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay captured traffic')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run = subparsers.add_parser('run', help='Replay a capture against an instance and report latency per route')
+    run.add_argument('capture', help='JSONL written by capture.py')
+    run.add_argument('--target', default='http://127.0.0.1:5000')
+    run.add_argument('--speed', type=parse_speed, default=1.0, help='1x (default), Nx, or max')
+    run.add_argument('--concurrency', type=int, default=32, help='Requests in flight at most (default 32)')
+    run.add_argument('--timeout', type=float, default=30, help='Per-request timeout in seconds')
+    run.add_argument('--limit', type=int, help='Only replay the first N requests')
+    run.add_argument('--admin-key', default=os.environ.get('ADMIN_API_KEY'), help='Sent as X-Admin-Key')
+    run.add_argument('--json', help='Also write the report to this file')
+
+    compare = subparsers.add_parser('compare', help='Compare the per-route timings of two captures')
+    compare.add_argument('baseline')
+    compare.add_argument('candidate')
+    compare.add_argument('--json', help='Also write the report to this file')
+
+    fake = subparsers.add_parser('fake-lipana', help='Serve a stand-in Lipana API for replays')
+    fake.add_argument('--port', type=int, default=8082)
+    fake.add_argument('--latency-ms', type=float, default=0, help='Added to every response')
+    fake.add_argument('--complete-after', type=float, default=5, help='Seconds a transaction stays pending')
+    fake.add_argument('--fail-every', type=int, default=0, help='Fail every Nth transaction (0: none)')
+
+    args = parser.parse_args(argv)
+    if args.command == 'fake-lipana':
+        FakeLipanaHandler.latency = args.latency_ms / 1000.0
+        FakeLipanaHandler.complete_after = args.complete_after
+        FakeLipanaHandler.fail_every = args.fail_every
+        print(f"Fake Lipana listening on http://127.0.0.1:{args.port}/", file=sys.stderr)
+        ThreadingHTTPServer(('127.0.0.1', args.port), FakeLipanaHandler).serve_forever()
+        return
+
+    if args.command == 'run':
+        entries = read_capture(args.capture, args.limit)
+        replayer = Replayer(args.target, args.speed, args.concurrency, args.timeout,
+                            headers={'X-Admin-Key': args.admin_key} if args.admin_key else None)
+        started = time.perf_counter()
+        replayer.run(entries)
+        elapsed = time.perf_counter() - started
+        report = route_report(replayer.results, entries)
+        print_report(report)
+        print(f"Replayed {len(replayer.results)} requests in {elapsed:.1f}s "
+              f"(speed {'max' if args.speed is None else f'{args.speed:g}x'}, "
+              f"dispatch fell behind schedule by up to {replayer.max_lag_ms:.0f}ms)", file=sys.stderr)
+    else:
+        report = compare_captures(args.baseline, args.candidate)
+        print_report(report, labels=('candidate', 'baseline'))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
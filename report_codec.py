@@ -0,0 +1,140 @@
+"""
+Packed storage for the CRB report sections.
+
+crb_reports.credit_history, detailed_analysis and lender_recommendations are
+stored as small BLOBs instead of JSON text. Each starts with a format byte:
+- credit_history: one (month, score) pair per entry, packed as '<Hh'
+  (months since year 0, signed score), newest first as generated
+- detailed_analysis: the ANALYSIS_FIELDS in order, one unsigned byte each
+- lender_recommendations: the recommended lender ids, comma separated; the
+  report and PDF match lenders live, so only the references are kept
+
+The decoders are only called for the sections a package unlocks. They still
+read the JSON text written before the packed format (and any legacy value
+that did not fit it), so archived and unconverted rows keep working.
+convert_legacy_reports() rewrites existing rows; init_db() runs it once when
+upgrading to schema version 12.
+"""
+import json
+import struct
+from datetime import datetime
+
+FORMAT = 1
+
+HISTORY_ENTRY = struct.Struct('<Hh')
+ANALYSIS_FIELDS = ('payment_history', 'credit_utilization', 'credit_age', 'credit_mix', 'recent_inquiries')
+ANALYSIS = struct.Struct(f'<{len(ANALYSIS_FIELDS)}B')
+
+# The fixed recommendations stored before lenders were matched by score
+LEGACY_LENDER_NAMES = {
+    'KCB Bank': 'kcb',
+    'Equity Bank': 'equity',
+    'M-Shwari': 'mshwari',
+    'Tala': 'tala',
+    'Branch': 'branch'
+}
+
+REPORT_SECTIONS = ('credit_history', 'detailed_analysis', 'lender_recommendations')
+CONVERT_BATCH_SIZE = 500
+
+
+def _payload(value):
+    """The packed bytes after the format byte, or None for legacy JSON text"""
+    if isinstance(value, (bytes, memoryview)):
+        value = bytes(value)
+        if value[:1] != bytes([FORMAT]):
+            raise ValueError(f'Unknown report section format: {value[:1]!r}')
+        return value[1:]
+    return None
+
+
+def encode_credit_history(history):
+    """[{'month': 'Nov 2024', 'score': 612}, ...] -> bytes"""
+    packed = bytearray([FORMAT])
+    for item in history:
+        month = datetime.strptime(item['month'], '%b %Y')
+        packed += HISTORY_ENTRY.pack(month.year * 12 + month.month - 1, int(item['score']))
+    return bytes(packed)
+
+
+def decode_credit_history(value):
+    payload = _payload(value)
+    if payload is None:
+        return json.loads(value or '[]')
+    history = []
+    for months, score in HISTORY_ENTRY.iter_unpack(payload):
+        month = datetime(months // 12, months % 12 + 1, 1)
+        history.append({'month': month.strftime('%b %Y'), 'score': score})
+    return history
+
+
+def encode_analysis(analysis):
+    """{'payment_history': 80, ...} -> bytes; raises ValueError for anything but the five 0-255 metrics"""
+    if set(analysis) != set(ANALYSIS_FIELDS):
+        raise ValueError(f'Unexpected analysis fields: {sorted(analysis)}')
+    try:
+        return bytes([FORMAT]) + ANALYSIS.pack(*(int(analysis[field]) for field in ANALYSIS_FIELDS))
+    except struct.error as e:
+        raise ValueError(str(e))
+
+
+def decode_analysis(value):
+    payload = _payload(value)
+    if payload is None:
+        return json.loads(value or '{}')
+    return dict(zip(ANALYSIS_FIELDS, ANALYSIS.unpack(payload)))
+
+
+def encode_lender_ids(recommendations):
+    """Recommendations (or lender ids) -> bytes"""
+    ids = [item['id'] if isinstance(item, dict) else item for item in recommendations]
+    if any(',' in lender_id for lender_id in ids):
+        raise ValueError(f'Lender ids cannot contain commas: {ids}')
+    return bytes([FORMAT]) + ','.join(ids).encode()
+
+
+def decode_lender_ids(value):
+    payload = _payload(value)
+    if payload is None:
+        return [lender_id for lender_id in map(_legacy_lender_id, json.loads(value or '[]') or []) if lender_id]
+    return payload.decode().split(',') if payload else []
+
+
+def _legacy_lender_id(item):
+    return item.get('id') or LEGACY_LENDER_NAMES.get(item.get('name'))
+
+
+ENCODERS = {
+    'credit_history': encode_credit_history,
+    'detailed_analysis': encode_analysis,
+    'lender_recommendations': lambda value: encode_lender_ids(decode_lender_ids(value))
+}
+
+
+def encode_legacy(section, text):
+    """Packed form of a legacy JSON section, or the text unchanged if it does not fit"""
+    try:
+        value = text if section == 'lender_recommendations' else json.loads(text)
+        return ENCODERS[section](value)
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return text
+
+
+def convert_legacy_reports(cursor):
+    """Pack every report section still stored as JSON text. Returns the number of rows rewritten."""
+    converted = 0
+    last_id = 0
+    while True:
+        rows = [tuple(row) for row in cursor.execute(f'''
+            SELECT id, {', '.join(REPORT_SECTIONS)} FROM crb_reports
+            WHERE id > ? AND ({' OR '.join(f"typeof({s}) = 'text'" for s in REPORT_SECTIONS)})
+            ORDER BY id LIMIT ?
+        ''', (last_id, CONVERT_BATCH_SIZE))]
+        if not rows:
+            return converted
+        cursor.executemany(f'''
+            UPDATE crb_reports SET {', '.join(f'{s} = ?' for s in REPORT_SECTIONS)} WHERE id = ?
+        ''', [tuple(encode_legacy(section, value) if isinstance(value, str) else value
+                    for section, value in zip(REPORT_SECTIONS, row[1:])) + (row[0],) for row in rows])
+        converted += len(rows)
+        last_id = rows[-1][0]
@@ -0,0 +1,187 @@
+"""
+CRB report generation and scheduled refresh.
+
+Reports are never built on a request path. Granting a package queues the
+phone in report_requests, and prepare_requested_reports() builds the first
+report in the background every REPORT_REQUEST_INTERVAL_SECONDS. Until it
+exists the report routes answer "being prepared" (and queue the phone again,
+in case the grant could not). refresh_stale_reports() keeps reports current:
+1. on every shard, scan crb_reports by created_at (oldest first, through
+   idx_crb_reports_created) for each entitled phone's latest report older
+   than REPORT_REFRESH_DAYS, REPORT_REFRESH_SCAN_LIMIT at a time
+2. refresh the REPORT_REFRESH_BATCH_SIZE of those whose owners paid most
+   recently first
+3. write each new version as a new row, only if the report it replaces is
+   still the latest, so a reader sees either the old or the new version and
+   two refreshers never both swap. archive.py moves the superseded rows out.
+
+A refresh carries the score history forward: months already in the previous
+report keep their scores and the newest month is added.
+
+Run both in-process (see server.start_background_jobs), or from cron with:
+    python reports.py prepare
+    python reports.py refresh [--max-age-days N]
+"""
+import os
+import sys
+import random
+import argparse
+from datetime import datetime, timedelta, timezone
+
+import database
+from lenders import match_lenders
+from records import REPORT_ROW, record_cursor
+from report_codec import encode_credit_history, decode_credit_history, encode_analysis, encode_lender_ids
+from sharding import SHARD_COUNT, init_shards, connect_shard
+from storage import store, utc_timestamp
+
+REPORT_REFRESH_DAYS = int(os.environ.get('REPORT_REFRESH_DAYS', '30'))
+REPORT_REFRESH_BATCH_SIZE = int(os.environ.get('REPORT_REFRESH_BATCH_SIZE', '100'))
+# Stale reports looked at per batch when picking the most active owners
+REPORT_REFRESH_SCAN_LIMIT = int(os.environ.get('REPORT_REFRESH_SCAN_LIMIT', '1000'))
+
+HISTORY_MONTHS = 6
+
+
+def standing(credit_score):
+    """(crb_status, loan_eligibility) for a score"""
+    if credit_score >= 700:
+        return 'Good Standing', 'Eligible for premium loans up to KES 500,000'
+    if credit_score >= 550:
+        return 'Fair Standing', 'Eligible for standard loans up to KES 200,000'
+    if credit_score >= 400:
+        return 'Needs Improvement', 'Limited eligibility - small loans up to KES 50,000'
+    return 'Poor Standing', 'Not currently eligible - work on improving score'
+
+
+def recent_months(now, count=HISTORY_MONTHS):
+    """'Nov 2024'-style labels for the count months up to now, newest first"""
+    year, month = now.year, now.month
+    months = []
+    for _ in range(count):
+        months.append(datetime(year, month, 1).strftime('%b %Y'))
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    return months
+
+
+def build_report(previous=None, now=None):
+    """crb_reports columns for a new report, carried forward from previous if given"""
+    now = now or datetime.now(timezone.utc)
+    known = {}
+    if previous and previous.credit_score is not None:
+        credit_score = min(850, max(300, previous.credit_score + random.randint(-25, 25)))
+        try:
+            known = {item['month']: item['score'] for item in decode_credit_history(previous.credit_history)}
+        except ValueError:
+            pass
+    else:
+        credit_score = random.randint(300, 850)
+
+    crb_status, loan_eligibility = standing(credit_score)
+    credit_history = [
+        {'month': month, 'score': known.get(month, credit_score - random.randint(-20, 30 + 10 * n))}
+        for n, month in enumerate(recent_months(now))
+    ]
+    return {
+        'credit_score': credit_score,
+        'crb_status': crb_status,
+        'loan_eligibility': loan_eligibility,
+        'credit_history': encode_credit_history(credit_history),
+        'detailed_analysis': encode_analysis({
+            'payment_history': random.randint(60, 100),
+            'credit_utilization': random.randint(10, 90),
+            'credit_age': random.randint(1, 15),
+            'credit_mix': random.randint(50, 100),
+            'recent_inquiries': random.randint(0, 10)
+        }),
+        'lender_recommendations': encode_lender_ids(match_lenders(credit_score))
+    }
+
+
+def refresh_cutoff(max_age_days=None):
+    max_age_days = REPORT_REFRESH_DAYS if max_age_days is None else max_age_days
+    return utc_timestamp(datetime.now(timezone.utc) - timedelta(days=max_age_days))
+
+
+def prepare_requested_reports():
+    """Build the first report of every queued phone, on every shard. Returns the number built."""
+    prepared = 0
+    for shard in range(SHARD_COUNT):
+        conn = connect_shard(shard)
+        try:
+            while True:
+                phones = store.reports.requested(conn, REPORT_REFRESH_BATCH_SIZE)
+                for phone in phones:
+                    if store.reports.fulfil(phone, build_report(), conn):
+                        prepared += 1
+                conn.commit()
+                if len(phones) < REPORT_REFRESH_BATCH_SIZE:
+                    break
+        finally:
+            conn.close()
+    if prepared:
+        print(f"Prepared {prepared} requested CRB reports", file=sys.stderr)
+    return prepared
+
+
+def find_stale_reports(conn, cutoff, now):
+    """The next batch to refresh on conn: stale latest reports of entitled phones, most recently active first"""
+    return record_cursor(conn, REPORT_ROW).execute('''
+        SELECT r.*, (SELECT MAX(p.created_at) FROM payments p WHERE p.phone_number = r.phone_number) AS last_active
+        FROM (
+            SELECT * FROM crb_reports c
+            WHERE c.created_at < ?
+              AND NOT EXISTS (SELECT 1 FROM crb_reports n WHERE n.phone_number = c.phone_number AND n.id > c.id)
+              AND EXISTS (
+                  SELECT 1 FROM user_access a
+                  WHERE a.phone_number = c.phone_number AND a.is_active = 1
+                    AND (a.expires_at IS NULL OR a.expires_at > ?)
+              )
+            ORDER BY c.created_at
+            LIMIT ?
+        ) r
+        ORDER BY last_active IS NULL, last_active DESC
+        LIMIT ?
+    ''', (cutoff, now, REPORT_REFRESH_SCAN_LIMIT, REPORT_REFRESH_BATCH_SIZE)).fetchall()
+
+
+def refresh_stale_reports(max_age_days=None):
+    """Refresh every stale report of an entitled phone, on every shard. Returns the number refreshed."""
+    cutoff = refresh_cutoff(max_age_days)
+    refreshed = 0
+    for shard in range(SHARD_COUNT):
+        conn = connect_shard(shard)
+        try:
+            while True:
+                stale = find_stale_reports(conn, cutoff, utc_timestamp())
+                for report in stale:
+                    if store.reports.replace(report.phone_number, report.id, build_report(report), conn=conn):
+                        refreshed += 1
+                conn.commit()
+                if len(stale) < REPORT_REFRESH_BATCH_SIZE:
+                    break
+        finally:
+            conn.close()
+    if refreshed:
+        print(f"Refreshed {refreshed} CRB reports older than {cutoff}", file=sys.stderr)
+    return refreshed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Prepare requested and refresh stale CRB reports')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('prepare', help='Build the first report of every queued phone')
+    refresh = subparsers.add_parser('refresh', help='Regenerate reports older than the refresh window')
+    refresh.add_argument('--max-age-days', type=int, help=f'Default REPORT_REFRESH_DAYS ({REPORT_REFRESH_DAYS})')
+
+    args = parser.parse_args(argv)
+    database.init_db()
+    init_shards()
+    if args.command == 'prepare':
+        print(f"Prepared {prepare_requested_reports()} reports", file=sys.stderr)
+    elif args.command == 'refresh':
+        print(f"Refreshed {refresh_stale_reports(args.max_age_days)} reports", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,41 +1,42 @@
 import os
+import re
+import io
+import csv
 import json
-import sqlite3
 import hmac
+import base64
 import hashlib
-import requests
+import math
 import sys
-from datetime import datetime
-from flask import Flask, request, jsonify, send_from_directory, send_file
-from lipana import Lipana
-
-app = Flask(__name__, static_folder='.')
-
-# Initialize Lipana SDK
-api_key = os.environ.get('LIPANA_API_KEY', '')
-print(f"LIPANA_API_KEY present: {bool(api_key)}", file=sys.stderr)
-print(f"LIPANA_API_KEY length: {len(api_key)}", file=sys.stderr)
-if api_key:
-    print(f"LIPANA_API_KEY prefix: {api_key[:15]}..." if len(api_key) > 15 else f"LIPANA_API_KEY: {api_key}", file=sys.stderr)
-
-# Determine environment based on key prefix
-if api_key.startswith('lip_sk_test_') or api_key.startswith('lip_pk_test_'):
-    lipana_env = 'sandbox'
-else:
-    lipana_env = 'production'  # Default to production (sandbox not always available)
-
-print(f"Lipana environment: {lipana_env}", file=sys.stderr)
-
-# Initialize Lipana client
-lipana_client = None
-if api_key:
-    try:
-        lipana_client = Lipana(api_key=api_key, environment=lipana_env)
-        print("Lipana SDK initialized successfully", file=sys.stderr)
-    except Exception as e:
-        print(f"Failed to initialize Lipana SDK: {str(e)}", file=sys.stderr)
+from functools import wraps, lru_cache
+from itertools import islice
+from datetime import datetime, timedelta, timezone
+from flask import Flask, Blueprint, Response, request, jsonify, send_from_directory, send_file
+from database import init_db, refresh_snapshot, SNAPSHOT_PATH
+from lipana_gateway import get_lipana_client, query_transaction_status
+from profiling import init_profiling
+from capture import init_capture
+from health import check_readiness
+from payment_service import PaymentError, PaymentPipeline, PaymentService
+from archive import archive_old_rows, find_archived_payment, match_archived_payments
+from background import start_periodic, worker_status
+from sharding import (init_shards, connect_phone, connect_shard, connect_payment, group_by_shard,
+                      shard_connections, shard_read_connections, merge_sorted,
+                      payment_id_shard, candidate_payment_connections)
+from storage import store, utc_timestamp
+from payment_states import can_transition, transition, ACTIVE_STATES, RETURNING as PAYMENT_COLUMNS
+from sweeper import sweep_stuck_payments, expire_entitlements
+from leads import dispatch_leads
+from lenders import find_lender, match_lenders
+from report_codec import decode_credit_history, decode_analysis
+from recent_payments import recent_payments
+from records import (PAYMENT_ROW, PAYMENT_LIST, PAYMENT_STATUS, PAYMENT_LOOKUP, PAYMENT_BATCH,
+                     CRB_REPORT, payment_sort_key)
+from reports import prepare_requested_reports, refresh_stale_reports
+from ratelimit import check_rate_limit, client_ip, prune_buckets, RATE_LIMITING
+from analytics import query_rollups, counter_for_days, METRICS, GRANULARITIES
 
-DATABASE_PATH = 'payments.db'
+api = Blueprint('api', __name__)
 
 PACKAGES = {
     'standard': {
@@ -53,7 +54,8 @@ PACKAGES = {
             'dispute_assistance': False,
             'priority_support': False
         },
-        'description': 'Basic CRB check with credit score and status'
+        'description': 'Basic CRB check with credit score and status',
+        'duration_days': 30
     },
     'premium': {
         'name': 'Premium Package',
@@ -70,7 +72,8 @@ PACKAGES = {
             'dispute_assistance': False,
             'priority_support': False
         },
-        'description': 'Comprehensive CRB report with detailed analysis'
+        'description': 'Comprehensive CRB report with detailed analysis',
+        'duration_days': 90
     },
     'golden': {
         'name': 'Golden Premium Package',
@@ -89,82 +92,8 @@ PACKAGES = {
             'download_report': True,
             'direct_lenders': True
         },
-        'description': 'Complete CRB solution with priority support and dispute assistance'
-    }
-}
-
-DIRECT_LENDERS = {
-    'mshwari': {
-        'name': 'M-Shwari',
-        'type': 'Instant Mobile Loans',
-        'max_amount': 50000,
-        'interest_rate': '7.5% per month',
-        'contact': '+254700000001',
-        'badge': 'Pre-approved',
-        'color': 'green'
-    },
-    'tala': {
-        'name': 'Tala Kenya',
-        'type': 'Fast Approval Loans',
-        'max_amount': 50000,
-        'interest_rate': '15% per month',
-        'contact': '+254700000002',
-        'badge': 'Verified Partner',
-        'color': 'blue'
-    },
-    'branch': {
-        'name': 'Branch Kenya',
-        'type': 'Flexible Repayment',
-        'max_amount': 70000,
-        'interest_rate': '1-3% per day',
-        'contact': '+254700000003',
-        'badge': 'Trusted',
-        'color': 'purple'
-    },
-    'kcb': {
-        'name': 'KCB M-Pesa',
-        'type': 'Bank-backed Loans',
-        'max_amount': 1000000,
-        'interest_rate': '1.083% per month',
-        'contact': '+254700000004',
-        'badge': 'Official Bank',
-        'color': 'orange'
-    },
-    'zenka': {
-        'name': 'Zenka Finance',
-        'type': 'Quick Cash Loans',
-        'max_amount': 30000,
-        'interest_rate': '9% per month',
-        'contact': '+254700000005',
-        'badge': 'Fast Approval',
-        'color': 'teal'
-    },
-    'opesa': {
-        'name': 'OPesa Loans',
-        'type': 'Emergency Loans',
-        'max_amount': 25000,
-        'interest_rate': '8% per month',
-        'contact': '+254700000006',
-        'badge': 'Quick Access',
-        'color': 'cyan'
-    },
-    'fuliza': {
-        'name': 'Fuliza by Safaricom',
-        'type': 'Overdraft Facility',
-        'max_amount': 100000,
-        'interest_rate': '1% per day',
-        'contact': '+254700000007',
-        'badge': 'Official M-Pesa',
-        'color': 'green'
-    },
-    'equity': {
-        'name': 'Equity Bank EazzyLoan',
-        'type': 'Bank Loans',
-        'max_amount': 500000,
-        'interest_rate': '1.25% per month',
-        'contact': '+254700000008',
-        'badge': 'Premium Bank',
-        'color': 'red'
+        'description': 'Complete CRB solution with priority support and dispute assistance',
+        'duration_days': 365
     }
 }
 
@@ -181,159 +110,45 @@ FEATURE_LABELS = {
     'priority_support': '24/7 Priority Support'
 }
 
-def init_db():
-    conn = sqlite3.connect(DATABASE_PATH)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS payments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            phone_number TEXT NOT NULL,
-            amount REAL NOT NULL,
-            bundle_name TEXT NOT NULL,
-            checkout_request_id TEXT,
-            merchant_request_id TEXT,
-            transaction_id TEXT,
-            mpesa_receipt_number TEXT,
-            status TEXT DEFAULT 'pending',
-            result_code INTEGER,
-            result_description TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS user_access (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            phone_number TEXT NOT NULL,
-            package_type TEXT NOT NULL,
-            payment_id INTEGER,
-            is_active INTEGER DEFAULT 1,
-            expires_at TIMESTAMP,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (payment_id) REFERENCES payments(id)
-        )
-    ''')
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS crb_reports (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            phone_number TEXT NOT NULL,
-            credit_score INTEGER,
-            crb_status TEXT,
-            loan_eligibility TEXT,
-            credit_history TEXT,
-            detailed_analysis TEXT,
-            lender_recommendations TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+def get_user_package(phone_number, conn=None, cached=True):
+    """Get the user's active (unexpired) package type, optionally on the caller's connection"""
+    return store.entitlements.active_package(phone_number, conn=conn, cached=cached)
 
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def get_user_package(phone_number):
-    """Get the user's active package type"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT package_type FROM user_access 
-        WHERE phone_number = ? AND is_active = 1
-        ORDER BY created_at DESC LIMIT 1
-    ''', (phone_number,))
-    result = cursor.fetchone()
-    conn.close()
-    return result['package_type'] if result else None
+def package_expiry(package_type):
+    """When a package granted now runs out"""
+    days = PACKAGES.get(package_type, PACKAGES['standard'])['duration_days']
+    return datetime.now(timezone.utc) + timedelta(days=days)
 
 def grant_user_access(phone_number, package_type, payment_id):
     """Grant user access to a package"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('''
-        INSERT INTO user_access (phone_number, package_type, payment_id, is_active)
-        VALUES (?, ?, ?, 1)
-    ''', (phone_number, package_type, payment_id))
-    conn.commit()
-    conn.close()
-
-def generate_crb_report(phone_number):
-    """Generate or retrieve CRB report for user"""
-    import random
-    
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        SELECT * FROM crb_reports WHERE phone_number = ?
-        ORDER BY created_at DESC LIMIT 1
-    ''', (phone_number,))
-    existing = cursor.fetchone()
-    
-    if existing:
-        conn.close()
-        return dict(existing)
-    
-    credit_score = random.randint(300, 850)
-    
-    if credit_score >= 700:
-        crb_status = 'Good Standing'
-        loan_eligibility = 'Eligible for premium loans up to KES 500,000'
-    elif credit_score >= 550:
-        crb_status = 'Fair Standing'
-        loan_eligibility = 'Eligible for standard loans up to KES 200,000'
-    elif credit_score >= 400:
-        crb_status = 'Needs Improvement'
-        loan_eligibility = 'Limited eligibility - small loans up to KES 50,000'
-    else:
-        crb_status = 'Poor Standing'
-        loan_eligibility = 'Not currently eligible - work on improving score'
-    
-    credit_history = json.dumps([
-        {'month': 'Nov 2024', 'score': credit_score - random.randint(-20, 30)},
-        {'month': 'Oct 2024', 'score': credit_score - random.randint(-20, 40)},
-        {'month': 'Sep 2024', 'score': credit_score - random.randint(-20, 50)},
-        {'month': 'Aug 2024', 'score': credit_score - random.randint(-20, 60)},
-        {'month': 'Jul 2024', 'score': credit_score - random.randint(-20, 70)},
-        {'month': 'Jun 2024', 'score': credit_score - random.randint(-20, 80)},
-    ])
-    
-    detailed_analysis = json.dumps({
-        'payment_history': random.randint(60, 100),
-        'credit_utilization': random.randint(10, 90),
-        'credit_age': random.randint(1, 15),
-        'credit_mix': random.randint(50, 100),
-        'recent_inquiries': random.randint(0, 10)
-    })
-    
-    lender_recommendations = json.dumps([
-        {'name': 'KCB Bank', 'max_loan': 300000, 'rate': '13.5%'},
-        {'name': 'Equity Bank', 'max_loan': 250000, 'rate': '14.0%'},
-        {'name': 'M-Shwari', 'max_loan': 50000, 'rate': '7.5%'},
-        {'name': 'Tala', 'max_loan': 30000, 'rate': '15.0%'},
-        {'name': 'Branch', 'max_loan': 70000, 'rate': '12.0%'}
-    ])
-    
-    cursor.execute('''
-        INSERT INTO crb_reports (phone_number, credit_score, crb_status, loan_eligibility, 
-                                  credit_history, detailed_analysis, lender_recommendations)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-    ''', (phone_number, credit_score, crb_status, loan_eligibility, 
-          credit_history, detailed_analysis, lender_recommendations))
-    conn.commit()
-    
-    cursor.execute('SELECT * FROM crb_reports WHERE id = ?', (cursor.lastrowid,))
-    report = dict(cursor.fetchone())
-    conn.close()
-    
+    store.entitlements.grant(phone_number, package_type, payment_id, expires_at=package_expiry(package_type))
+
+def ready_report(phone_number):
+    """
+    The phone's stored CRB report, or None while the background worker is still
+    preparing it (reports.py). The phone is queued again in case its grant
+    could not queue it.
+    """
+    report = store.reports.latest(phone_number)
+    if report is None:
+        store.reports.request(phone_number)
     return report
 
+def report_preparing():
+    """202 from a report route while the phone's report is being prepared"""
+    return jsonify({
+        'success': True,
+        'preparing': True,
+        'message': 'Your CRB report is being prepared. Please try again in a few seconds.'
+    }), 202
+
+NON_DIGITS = re.compile(r'\D')
+KENYAN_MOBILE = re.compile(r'^254[17]\d{8}$')
+
+# Callers repeat the same few numbers (status polling, statement reconciliation)
+@lru_cache(maxsize=65536)
 def format_phone_number(phone):
-    cleaned = ''.join(filter(str.isdigit, phone.replace('+', '')))
+    cleaned = NON_DIGITS.sub('', phone.replace('+', ''))
     
     if cleaned.startswith('254'):
         pass
@@ -342,212 +157,197 @@ def format_phone_number(phone):
     elif cleaned.startswith('7') or cleaned.startswith('1'):
         cleaned = '254' + cleaned
     
-    import re
-    if not re.match(r'^254[17]\d{8}$', cleaned):
+    if not KENYAN_MOBILE.match(cleaned):
         return None
     
     return cleaned
 
-@app.route('/api/payment/initiate', methods=['POST', 'OPTIONS'])
+def normalize_phone_numbers(phones):
+    """
+    format_phone_number over a whole list in one pass with the precompiled
+    patterns bound locally. Non-string or invalid entries become None.
+    """
+    sub = NON_DIGITS.sub
+    match = KENYAN_MOBILE.match
+    normalized = []
+    append = normalized.append
+    for phone in phones:
+        if not isinstance(phone, str):
+            append(None)
+            continue
+        cleaned = sub('', phone)
+        first = cleaned[:1]
+        if cleaned.startswith('254'):
+            pass
+        elif first == '0':
+            cleaned = '254' + cleaned[1:]
+        elif first == '7' or first == '1':
+            cleaned = '254' + cleaned
+        append(cleaned if match(cleaned) else None)
+    return normalized
+
+def throttle_request(route_class, data, forwarded_for, remote_addr):
+    """(429 body, retry_after) if the request is over its route-class budget, else None"""
+    data = data if isinstance(data, dict) else {}
+    phone = data.get('phone') or data.get('phoneNumber') or data.get('phone_number')
+    phone = format_phone_number(phone) if isinstance(phone, str) else None
+    retry_after = check_rate_limit(route_class, ip=client_ip(forwarded_for, remote_addr), phone=phone)
+    if retry_after is None:
+        return None
+    print(f"Throttled {route_class} request (retry after {retry_after}s)", file=sys.stderr)
+    return {'success': False, 'error': 'Too many requests. Please wait a moment and try again.'}, retry_after
+
+def rate_limited(route_class):
+    """Answer requests over route_class's per-IP / per-phone budget with 429 and Retry-After"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'OPTIONS':
+                throttled = throttle_request(route_class, request.get_json(silent=True),
+                                             request.headers.get('X-Forwarded-For'), request.remote_addr)
+                if throttled:
+                    body, retry_after = throttled
+                    return jsonify(body), 429, {'Retry-After': str(retry_after)}
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def validate_payment_body(ctx):
+    data = ctx.data
+    if not data:
+        raise PaymentError({'success': False, 'error': 'No data provided'})
+    
+    phone = data.get('phone')
+    amount = data.get('amount')
+    
+    if not phone or amount is None:
+        raise PaymentError({
+            'success': False, 
+            'error': 'Missing required fields: phone and amount'
+        })
+    
+    formatted_phone = format_phone_number(phone)
+    if not formatted_phone:
+        raise PaymentError({
+            'success': False,
+            'error': 'Invalid phone number format. Use 254XXXXXXXXX, 0XXXXXXXXX, or +254XXXXXXXXX'
+        })
+    
+    ctx.phone = formatted_phone
+    ctx.amount = amount
+    ctx.bundle_name = data.get('bundleName', 'CRB Check')
+
+def price_from_body(ctx):
+    try:
+        amount = float(ctx.amount)
+    except (ValueError, TypeError):
+        raise PaymentError({'success': False, 'error': 'Invalid amount'})
+    if amount < 10:
+        raise PaymentError({'success': False, 'error': 'Minimum amount is KES 10'})
+    ctx.amount = amount
+
+def respond_payment(ctx):
+    return {
+        'success': True,
+        'message': 'STK push sent successfully. Check your phone to complete payment.',
+        'paymentId': ctx.payment_id,
+        'checkoutRequestId': ctx.checkout_id
+    }
+
+def respond_compat_payment(ctx):
+    return {
+        'success': True,
+        'message': 'STK push sent successfully. Check your phone to complete payment.',
+        'transactionId': ctx.transaction_id,
+        'checkoutRequestID': ctx.checkout_id
+    }
+
+def validate_upgrade_body(ctx):
+    data = ctx.data
+    phone = data.get('phone')
+    target_package = data.get('targetPackage')
+    
+    if not phone or not target_package:
+        raise PaymentError({'success': False, 'error': 'Phone and target package required'})
+    
+    formatted_phone = format_phone_number(phone)
+    if not formatted_phone:
+        raise PaymentError({'success': False, 'error': 'Invalid phone number'})
+    
+    if target_package not in PACKAGES:
+        raise PaymentError({'success': False, 'error': 'Invalid package'})
+    
+    ctx.phone = formatted_phone
+    ctx.target_package = target_package
+    ctx.bundle_name = target_package
+
+def price_upgrade(ctx):
+    """Charge the difference between the target package and the user's current one"""
+    current_package = get_user_package(ctx.phone, conn=ctx.conn)
+    target_pkg = PACKAGES[ctx.target_package]
+    
+    if current_package:
+        current_pkg = PACKAGES.get(current_package, PACKAGES['standard'])
+        amount = target_pkg['price'] - current_pkg['price']
+        if amount <= 0:
+            raise PaymentError({'success': False, 'error': 'Cannot downgrade package'})
+    else:
+        amount = target_pkg['price']
+    
+    ctx.amount = amount
+
+def respond_upgrade(ctx):
+    target_pkg = PACKAGES[ctx.target_package]
+    return {
+        'success': True,
+        'message': f'Upgrade to {target_pkg["name"]} initiated. Check your phone to complete payment of KES {ctx.amount}.',
+        'paymentId': ctx.payment_id,
+        'checkoutRequestId': ctx.checkout_id,
+        'amount': ctx.amount,
+        'targetPackage': ctx.target_package
+    }
+
+PAYMENT_PIPELINE = PaymentPipeline(
+    'payment', validate_payment_body, price_from_body, respond_payment,
+    'Payment service not configured. Please contact support.'
+)
+COMPAT_PAYMENT_PIPELINE = PaymentPipeline(
+    'compat-payment', validate_payment_body, price_from_body, respond_compat_payment,
+    'Payment service not configured. Please contact support.'
+)
+UPGRADE_PIPELINE = PaymentPipeline(
+    'upgrade', validate_upgrade_body, price_upgrade, respond_upgrade,
+    'Payment service not configured.'
+)
+
+# Connections are opened per request; they may hop between threads in asgi.py
+payments = PaymentService(
+    connect=lambda phone: connect_phone(phone, check_same_thread=False),
+    get_client=get_lipana_client,
+    id_shard=payment_id_shard,
+    remember_payment=recent_payments.remember
+)
+
+@api.route('/api/payment/initiate', methods=['POST', 'OPTIONS'])
+@rate_limited('initiate')
 def initiate_payment():
     if request.method == 'OPTIONS':
         return jsonify({})
     try:
-        data = request.get_json()
-        
-        if not data:
-            return jsonify({'success': False, 'error': 'No data provided'}), 400
-        
-        phone = data.get('phone')
-        amount = data.get('amount')
-        bundle_name = data.get('bundleName', 'CRB Check')
-        
-        if not phone or amount is None:
-            return jsonify({
-                'success': False, 
-                'error': 'Missing required fields: phone and amount'
-            }), 400
-        
-        formatted_phone = format_phone_number(phone)
-        if not formatted_phone:
-            return jsonify({
-                'success': False,
-                'error': 'Invalid phone number format. Use 254XXXXXXXXX, 0XXXXXXXXX, or +254XXXXXXXXX'
-            }), 400
-        
-        try:
-            amount = float(amount)
-            if amount < 10:
-                return jsonify({'success': False, 'error': 'Minimum amount is KES 10'}), 400
-        except (ValueError, TypeError):
-            return jsonify({'success': False, 'error': 'Invalid amount'}), 400
-        
-        if not lipana_client:
-            return jsonify({
-                'success': False, 
-                'error': 'Payment service not configured. Please contact support.'
-            }), 500
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO payments (phone_number, amount, bundle_name, status)
-            VALUES (?, ?, ?, 'pending')
-        ''', (formatted_phone, amount, bundle_name))
-        payment_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        
-        phone_with_plus = f'+{formatted_phone}'
-        print(f"Initiating STK push via SDK for {phone_with_plus}, amount: {int(amount)}", file=sys.stderr)
-        
-        try:
-            stk_response = lipana_client.transactions.initiate_stk_push(
-                phone=phone_with_plus,
-                amount=int(amount)
-            )
-            print(f"SDK STK push response: {stk_response}", file=sys.stderr)
-            
-            checkout_id = stk_response.get('checkoutRequestID') or stk_response.get('checkoutRequestId')
-            transaction_id = stk_response.get('transactionId')
-            
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE payments 
-                SET checkout_request_id = ?, transaction_id = ?, status = 'processing', updated_at = ?
-                WHERE id = ?
-            ''', (checkout_id, transaction_id, datetime.now().isoformat(), payment_id))
-            conn.commit()
-            conn.close()
-            
-            return jsonify({
-                'success': True,
-                'message': 'STK push sent successfully. Check your phone to complete payment.',
-                'paymentId': payment_id,
-                'checkoutRequestId': checkout_id
-            })
-            
-        except Exception as sdk_error:
-            error_msg = str(sdk_error)
-            print(f"SDK STK push error: {error_msg}", file=sys.stderr)
-            
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE payments SET status = 'failed', result_description = ?, updated_at = ?
-                WHERE id = ?
-            ''', (error_msg, datetime.now().isoformat(), payment_id))
-            conn.commit()
-            conn.close()
-            
-            return jsonify({'success': False, 'error': error_msg}), 400
-            
+        body, status = payments.initiate(PAYMENT_PIPELINE, request.get_json())
+        return jsonify(body), status
     except Exception as e:
         print(f"Payment error: {str(e)}", file=sys.stderr)
         return jsonify({'success': False, 'error': 'An error occurred. Please try again.'}), 500
 
-@app.route('/functions/v1/initiate-payment', methods=['POST', 'OPTIONS'])
+@api.route('/functions/v1/initiate-payment', methods=['POST', 'OPTIONS'])
+@rate_limited('initiate')
 def supabase_compat_initiate_payment():
     if request.method == 'OPTIONS':
         return jsonify({})
-    
     try:
-        data = request.get_json()
-        
-        if not data:
-            return jsonify({'success': False, 'error': 'No data provided'}), 400
-        
-        phone = data.get('phone')
-        amount = data.get('amount')
-        bundle_name = data.get('bundleName', 'CRB Check')
-        
-        if not phone or amount is None:
-            return jsonify({
-                'success': False, 
-                'error': 'Missing required fields: phone and amount'
-            }), 400
-        
-        formatted_phone = format_phone_number(phone)
-        if not formatted_phone:
-            return jsonify({
-                'success': False,
-                'error': 'Invalid phone number format. Use 254XXXXXXXXX, 0XXXXXXXXX, or +254XXXXXXXXX'
-            }), 400
-        
-        try:
-            amount = float(amount)
-            if amount < 10:
-                return jsonify({'success': False, 'error': 'Minimum amount is KES 10'}), 400
-        except (ValueError, TypeError):
-            return jsonify({'success': False, 'error': 'Invalid amount'}), 400
-        
-        if not lipana_client:
-            return jsonify({
-                'success': False, 
-                'error': 'Payment service not configured. Please contact support.'
-            }), 500
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO payments (phone_number, amount, bundle_name, status)
-            VALUES (?, ?, ?, 'pending')
-        ''', (formatted_phone, amount, bundle_name))
-        payment_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        
-        phone_with_plus = f'+{formatted_phone}'
-        print(f"Initiating STK push via SDK for {phone_with_plus}, amount: {int(amount)}", file=sys.stderr)
-        
-        try:
-            stk_response = lipana_client.transactions.initiate_stk_push(
-                phone=phone_with_plus,
-                amount=int(amount)
-            )
-            print(f"SDK STK push response: {stk_response}", file=sys.stderr)
-            
-            checkout_id = stk_response.get('checkoutRequestID') or stk_response.get('checkoutRequestId')
-            transaction_id = stk_response.get('transactionId')
-            
-            if stk_response.get('data'):
-                data_obj = stk_response.get('data', {})
-                checkout_id = checkout_id or data_obj.get('checkoutRequestID') or data_obj.get('checkoutRequestId')
-                transaction_id = transaction_id or data_obj.get('transactionId')
-            
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE payments 
-                SET checkout_request_id = ?, transaction_id = ?, status = 'processing', updated_at = ?
-                WHERE id = ?
-            ''', (checkout_id, transaction_id, datetime.now().isoformat(), payment_id))
-            conn.commit()
-            conn.close()
-            
-            return jsonify({
-                'success': True,
-                'message': 'STK push sent successfully. Check your phone to complete payment.',
-                'transactionId': transaction_id,
-                'checkoutRequestID': checkout_id
-            })
-            
-        except Exception as sdk_error:
-            error_msg = str(sdk_error)
-            print(f"SDK STK push error: {error_msg}", file=sys.stderr)
-            
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE payments SET status = 'failed', result_description = ?, updated_at = ?
-                WHERE id = ?
-            ''', (error_msg, datetime.now().isoformat(), payment_id))
-            conn.commit()
-            conn.close()
-            
-            return jsonify({'success': False, 'error': error_msg}), 400
-            
+        body, status = payments.initiate(COMPAT_PAYMENT_PIPELINE, request.get_json())
+        return jsonify(body), status
     except Exception as e:
         print(f"Payment error: {str(e)}", file=sys.stderr)
         return jsonify({'success': False, 'error': 'An error occurred. Please try again.'}), 500
@@ -576,32 +376,187 @@ def determine_package_type(bundle_name, amount):
 
 def grant_access_for_payment(payment_id, phone_number, bundle_name, amount):
     """Grant user access for a completed payment"""
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    package_type = determine_package_type(bundle_name, amount)
+    if not store.entitlements.grant(phone_number, package_type, payment_id, amount,
+                                    expires_at=package_expiry(package_type)):
+        return False
     
-    cursor.execute('''
-        SELECT id FROM user_access 
-        WHERE payment_id = ?
-    ''', (payment_id,))
-    existing = cursor.fetchone()
+    print(f"ACCESS GRANTED: {phone_number} -> {package_type} package (Payment ID: {payment_id})", file=sys.stderr)
+    try:
+        store.reports.request(phone_number)
+    except Exception as e:
+        print(f"Could not queue CRB report for {phone_number}: {str(e)}", file=sys.stderr)
+    return True
+
+def is_valid_identifier(val):
+    return val and val not in ['null', 'undefined', 'None', '']
+
+def extract_status_identifiers(data):
+    """Pull (checkout_id, transaction_id, phone, payment_id) out of a check-status body"""
+    checkout_id = data.get('checkoutRequestID') or data.get('checkoutRequestId') or data.get('checkout_request_id')
+    transaction_id = data.get('transactionId') or data.get('transaction_id')
+    phone = data.get('phone') or data.get('phoneNumber') or data.get('phone_number')
+    payment_id = data.get('paymentId') or data.get('payment_id')
+    return checkout_id, transaction_id, phone, payment_id
+
+def recent_status_payment(checkout_id, transaction_id, phone, payment_id):
+    """
+    The payment from this worker's recent-payments index, when the index can
+    answer: completed payments, or active ones the caller confirms with Lipana.
+    A phone-only hit is served for active payments alone, since another
+    worker may hold a newer payment for the phone.
+    """
+    keyed = is_valid_identifier(payment_id) or is_valid_identifier(checkout_id) or is_valid_identifier(transaction_id)
+    payment = recent_payments.find(
+        payment_id=payment_id if is_valid_identifier(payment_id) else None,
+        checkout_id=checkout_id if is_valid_identifier(checkout_id) else None,
+        transaction_id=transaction_id if is_valid_identifier(transaction_id) else None,
+        phone=format_phone_number(phone) if is_valid_identifier(phone) and not keyed else None
+    )
+    if payment and ((keyed and payment.status == 'completed') or needs_lipana_check(payment)):
+        return payment
+    return None
+
+def find_status_payment(cursor, checkout_id, transaction_id, phone, payment_id):
+    """Find the payment a check-status request refers to, trying each identifier in turn"""
+    has_identifier = (is_valid_identifier(checkout_id) or is_valid_identifier(transaction_id)
+                      or is_valid_identifier(phone) or is_valid_identifier(payment_id))
     
-    if existing:
-        conn.close()
-        return False
+    payment = recent_status_payment(checkout_id, transaction_id, phone, payment_id)
+    if payment:
+        return payment
     
-    package_type = determine_package_type(bundle_name, amount)
+    cursor.row_factory = PAYMENT_ROW
+    if is_valid_identifier(payment_id):
+        cursor.execute('''
+            SELECT id, phone_number, amount, bundle_name, status, checkout_request_id, transaction_id,
+                   mpesa_receipt_number, result_description, created_at
+            FROM payments 
+            WHERE id = ?
+        ''', (payment_id,))
+        payment = cursor.fetchone()
     
-    cursor.execute('''
-        INSERT INTO user_access (phone_number, package_type, payment_id, is_active)
-        VALUES (?, ?, ?, 1)
-    ''', (phone_number, package_type, payment_id))
-    conn.commit()
-    conn.close()
+    if not payment and is_valid_identifier(checkout_id):
+        cursor.execute('''
+            SELECT id, phone_number, amount, bundle_name, status, checkout_request_id, transaction_id,
+                   mpesa_receipt_number, result_description, created_at
+            FROM payments 
+            WHERE checkout_request_id = ?
+        ''', (checkout_id,))
+        payment = cursor.fetchone()
     
-    print(f"ACCESS GRANTED: {phone_number} -> {package_type} package (Payment ID: {payment_id})", file=sys.stderr)
-    return True
+    if not payment and is_valid_identifier(transaction_id):
+        cursor.execute('''
+            SELECT id, phone_number, amount, bundle_name, status, checkout_request_id, transaction_id,
+                   mpesa_receipt_number, result_description, created_at
+            FROM payments 
+            WHERE transaction_id = ?
+        ''', (transaction_id,))
+        payment = cursor.fetchone()
+    
+    if not payment and is_valid_identifier(phone):
+        formatted_phone = format_phone_number(phone)
+        if formatted_phone:
+            cursor.execute('''
+                SELECT id, phone_number, amount, bundle_name, status, checkout_request_id, transaction_id,
+                       mpesa_receipt_number, result_description, created_at
+                FROM payments 
+                WHERE phone_number = ?
+                ORDER BY created_at DESC
+                LIMIT 1
+            ''', (formatted_phone,))
+            payment = cursor.fetchone()
+    
+    if payment:
+        recent_payments.remember(payment)
+    
+    if not payment and has_identifier:
+        payment = find_archived_payment(
+            payment_id=payment_id if is_valid_identifier(payment_id) else None,
+            checkout_id=checkout_id if is_valid_identifier(checkout_id) else None,
+            transaction_id=transaction_id if is_valid_identifier(transaction_id) else None,
+            phone=format_phone_number(phone) if is_valid_identifier(phone) else None
+        )
+    
+    if not payment and not has_identifier:
+        print("No identifier provided, falling back to most recent payment", file=sys.stderr)
+        statuses = ACTIVE_STATES + ('completed',)
+        cursor.execute(f'''
+            SELECT id, phone_number, amount, bundle_name, status, checkout_request_id, transaction_id,
+                   mpesa_receipt_number, result_description, created_at
+            FROM payments 
+            WHERE status IN ({','.join('?' * len(statuses))})
+            ORDER BY created_at DESC
+            LIMIT 1
+        ''', statuses)
+        payment = cursor.fetchone()
+        if payment:
+            print(f"Found fallback payment: ID={payment.id}, status={payment.status}", file=sys.stderr)
+    
+    return payment
+
+def connect_for_status(checkout_id, transaction_id, phone, payment_id):
+    """Connection to the database a check-status request's payment lives in"""
+    return connect_payment(
+        payment_id=payment_id if is_valid_identifier(payment_id) else None,
+        checkout_id=checkout_id if is_valid_identifier(checkout_id) else None,
+        transaction_id=transaction_id if is_valid_identifier(transaction_id) else None,
+        phone=format_phone_number(phone) if is_valid_identifier(phone) else None
+    )
+
+def needs_lipana_check(payment):
+    return payment.status in ACTIVE_STATES and payment.transaction_id
 
-@app.route('/functions/v1/check-payment-status', methods=['POST', 'OPTIONS'])
+def read_payment(conn, payment_id):
+    """The stored payment, with the same columns find_status_payment selects"""
+    cursor = conn.cursor()
+    cursor.row_factory = PAYMENT_ROW
+    return cursor.execute(f'SELECT {PAYMENT_COLUMNS} FROM payments WHERE id = ?', (payment_id,)).fetchone()
+
+def complete_status_check(conn, payment, new_status, mpesa_receipt):
+    """Record a status found in Lipana, grant access if completed, and build the check-status response"""
+    updated_payment = payment
+    
+    if new_status and can_transition(payment.status, new_status):
+        changed = transition(conn, new_status, 'check-status', 'id', payment.id,
+                             expected=payment.status, mpesa_receipt_number=mpesa_receipt)
+        conn.commit()
+        
+        if changed:
+            print(f"Payment status updated to: {new_status}", file=sys.stderr)
+            recent_payments.remember(changed[0])
+            updated_payment = payment._replace(status=new_status, mpesa_receipt_number=mpesa_receipt)
+            if new_status == 'completed':
+                grant_access_for_payment(
+                    payment.id,
+                    payment.phone_number,
+                    payment.bundle_name,
+                    payment.amount
+                )
+        else:
+            # Another request moved it first; report what is stored now
+            updated_payment = read_payment(conn, payment.id) or payment
+            recent_payments.remember(updated_payment)
+    
+    has_access = False
+    package_type = None
+    if updated_payment.status == 'completed':
+        # The grant may have happened in another worker, so a cached miss is checked in SQLite
+        package_type = (get_user_package(updated_payment.phone_number)
+                        or get_user_package(updated_payment.phone_number, cached=False))
+        has_access = package_type is not None
+    
+    return {
+        'success': True,
+        'payment': PAYMENT_STATUS(updated_payment),
+        'access': {
+            'granted': has_access,
+            'packageType': package_type
+        }
+    }
+
+@api.route('/functions/v1/check-payment-status', methods=['POST', 'OPTIONS'])
+@rate_limited('status')
 def supabase_compat_check_status():
     if request.method == 'OPTIONS':
         return jsonify({})
@@ -611,186 +566,31 @@ def supabase_compat_check_status():
         
         print(f"Full check-status request body: {json.dumps(data)}", file=sys.stderr)
         
-        checkout_id = data.get('checkoutRequestID') or data.get('checkoutRequestId') or data.get('checkout_request_id')
-        transaction_id = data.get('transactionId') or data.get('transaction_id')
-        phone = data.get('phone') or data.get('phoneNumber') or data.get('phone_number')
-        payment_id = data.get('paymentId') or data.get('payment_id')
+        checkout_id, transaction_id, phone, payment_id = extract_status_identifiers(data)
         
         print(f"Check status request - checkout_id: {checkout_id}, transaction_id: {transaction_id}, phone: {phone}, payment_id: {payment_id}", file=sys.stderr)
         
-        def is_valid(val):
-            return val and val not in ['null', 'undefined', 'None', '']
-        
-        has_identifier = is_valid(checkout_id) or is_valid(transaction_id) or is_valid(phone) or is_valid(payment_id)
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        payment = None
-        
-        if is_valid(payment_id):
-            cursor.execute('''
-                SELECT id, phone_number, amount, bundle_name, status, transaction_id,
-                       mpesa_receipt_number, result_description, created_at
-                FROM payments 
-                WHERE id = ?
-            ''', (payment_id,))
-            payment = cursor.fetchone()
-        
-        if not payment and is_valid(checkout_id):
-            cursor.execute('''
-                SELECT id, phone_number, amount, bundle_name, status, transaction_id,
-                       mpesa_receipt_number, result_description, created_at
-                FROM payments 
-                WHERE checkout_request_id = ?
-            ''', (checkout_id,))
-            payment = cursor.fetchone()
-        
-        if not payment and is_valid(transaction_id):
-            cursor.execute('''
-                SELECT id, phone_number, amount, bundle_name, status, transaction_id,
-                       mpesa_receipt_number, result_description, created_at
-                FROM payments 
-                WHERE transaction_id = ?
-            ''', (transaction_id,))
-            payment = cursor.fetchone()
-        
-        if not payment and is_valid(phone):
-            formatted_phone = format_phone_number(phone)
-            if formatted_phone:
-                cursor.execute('''
-                    SELECT id, phone_number, amount, bundle_name, status, transaction_id,
-                           mpesa_receipt_number, result_description, created_at
-                    FROM payments 
-                    WHERE phone_number = ?
-                    ORDER BY created_at DESC
-                    LIMIT 1
-                ''', (formatted_phone,))
-                payment = cursor.fetchone()
-        
-        if not payment and not has_identifier:
-            print("No identifier provided, falling back to most recent payment", file=sys.stderr)
-            cursor.execute('''
-                SELECT id, phone_number, amount, bundle_name, status, transaction_id,
-                       mpesa_receipt_number, result_description, created_at
-                FROM payments 
-                WHERE status IN ('pending', 'processing', 'completed')
-                ORDER BY created_at DESC
-                LIMIT 1
-            ''')
-            payment = cursor.fetchone()
-            if payment:
-                print(f"Found fallback payment: ID={payment['id']}, status={payment['status']}", file=sys.stderr)
+        # An index hit knows its shard, so the shards need not be searched
+        payment = recent_status_payment(checkout_id, transaction_id, phone, payment_id)
+        if payment:
+            conn = connect_phone(payment.phone_number)
+        else:
+            conn = connect_for_status(checkout_id, transaction_id, phone, payment_id)
+            payment = find_status_payment(conn.cursor(), checkout_id, transaction_id, phone, payment_id)
         
         if not payment:
             conn.close()
             return jsonify({'success': False, 'error': 'Payment not found'}), 404
         
-        current_status = payment['status']
-        db_transaction_id = payment['transaction_id']
-        
-        if current_status in ['pending', 'processing'] and db_transaction_id:
-            new_status = None
-            mpesa_receipt = None
-            
-            if lipana_client:
-                try:
-                    print(f"Querying Lipana SDK for transaction status: {db_transaction_id}", file=sys.stderr)
-                    status_response = lipana_client.transactions.retrieve(db_transaction_id)
-                    print(f"Lipana SDK response: {status_response}", file=sys.stderr)
-                    
-                    lipana_status = status_response.get('status', '').lower()
-                    mpesa_receipt = status_response.get('mpesaReceiptNumber') or status_response.get('receipt')
-                    
-                    if lipana_status == 'success' or lipana_status == 'completed':
-                        new_status = 'completed'
-                    elif lipana_status == 'failed' or lipana_status == 'cancelled':
-                        new_status = 'failed'
-                        
-                except Exception as sdk_error:
-                    print(f"SDK error, trying direct API: {str(sdk_error)}", file=sys.stderr)
-            
-            if not new_status and api_key:
-                try:
-                    print(f"Querying Lipana transactions list for: {db_transaction_id}", file=sys.stderr)
-                    headers = {
-                        'x-api-key': api_key,
-                        'Content-Type': 'application/json'
-                    }
-                    api_url = "https://api.lipana.dev/v1/transactions"
-                    response = requests.get(api_url, headers=headers, timeout=15)
-                    print(f"Lipana API response status: {response.status_code}", file=sys.stderr)
-                    
-                    if response.status_code == 200:
-                        api_response = response.json()
-                        transactions = api_response.get('data', [])
-                        
-                        for txn in transactions:
-                            if txn.get('transactionId') == db_transaction_id:
-                                print(f"Found transaction in list: {txn}", file=sys.stderr)
-                                lipana_status = txn.get('status', '').lower()
-                                metadata = txn.get('metadata', {})
-                                mpesa_receipt = metadata.get('mpesaReceiptNumber') or txn.get('mpesaReceiptNumber')
-                                
-                                if lipana_status == 'success' or lipana_status == 'completed':
-                                    new_status = 'completed'
-                                elif lipana_status == 'failed' or lipana_status == 'cancelled':
-                                    new_status = 'failed'
-                                break
-                except Exception as api_error:
-                    print(f"Direct API error: {str(api_error)}", file=sys.stderr)
-            
-            if new_status and new_status != current_status:
-                cursor.execute('''
-                    UPDATE payments 
-                    SET status = ?, mpesa_receipt_number = ?, updated_at = ?
-                    WHERE id = ?
-                ''', (new_status, mpesa_receipt, datetime.now().isoformat(), payment['id']))
-                conn.commit()
-                current_status = new_status
-                print(f"Payment status updated to: {new_status}", file=sys.stderr)
-                
-                if new_status == 'completed':
-                    grant_access_for_payment(
-                        payment['id'],
-                        payment['phone_number'],
-                        payment['bundle_name'],
-                        payment['amount']
-                    )
-        
-        cursor.execute('''
-            SELECT id, phone_number, amount, bundle_name, status, 
-                   mpesa_receipt_number, result_description, created_at
-            FROM payments 
-            WHERE id = ?
-        ''', (payment['id'],))
-        updated_payment = cursor.fetchone()
-        
-        has_access = False
-        package_type = None
-        if updated_payment['status'] == 'completed':
-            package_type = get_user_package(updated_payment['phone_number'])
-            has_access = package_type is not None
+        new_status = None
+        mpesa_receipt = None
+        if needs_lipana_check(payment):
+            new_status, mpesa_receipt = query_transaction_status(payment.transaction_id)
         
+        result = complete_status_check(conn, payment, new_status, mpesa_receipt)
         conn.close()
         
-        return jsonify({
-            'success': True,
-            'payment': {
-                'id': updated_payment['id'],
-                'phone': updated_payment['phone_number'],
-                'amount': updated_payment['amount'],
-                'bundleName': updated_payment['bundle_name'],
-                'status': updated_payment['status'],
-                'mpesaReceiptNumber': updated_payment['mpesa_receipt_number'],
-                'resultDesc': updated_payment['result_description'],
-                'createdAt': updated_payment['created_at']
-            },
-            'access': {
-                'granted': has_access,
-                'packageType': package_type
-            }
-        })
+        return jsonify(result)
         
     except Exception as e:
         print(f"Check status error: {str(e)}", file=sys.stderr)
@@ -822,7 +622,94 @@ def verify_lipana_signature(payload, signature):
         print(f"ERROR: Signature verification failed: {str(e)}")
         return False
 
-@app.route('/api/payment/callback', methods=['POST'])
+def process_payment_callback(data):
+    """Apply a Lipana webhook payload to its payment. Returns (body, status)."""
+    if not data:
+        return {'status': 'error', 'message': 'No data received'}, 400
+
+    event_type = data.get('event', '')
+    payment_data = data.get('data', data)
+
+    transaction_id = payment_data.get('transactionId') or payment_data.get('transaction_id')
+    checkout_request_id = payment_data.get('checkoutRequestID') or payment_data.get('checkoutRequestId') or payment_data.get('checkout_request_id')
+    payment_status = payment_data.get('status', '')
+    amount = payment_data.get('amount')
+    phone = payment_data.get('phone')
+
+    print(f"Webhook event: {event_type}, transaction_id: {transaction_id}, status: {payment_status}", file=sys.stderr)
+
+    body = data.get('Body', {})
+    stk_callback = body.get('stkCallback', {})
+    if stk_callback:
+        checkout_request_id = checkout_request_id or stk_callback.get('CheckoutRequestID')
+        result_code = stk_callback.get('ResultCode')
+        result_desc = stk_callback.get('ResultDesc', '')
+
+        callback_metadata = stk_callback.get('CallbackMetadata', {})
+        items = callback_metadata.get('Item', [])
+
+        mpesa_receipt = None
+        for item in items:
+            name = item.get('Name', '')
+            value = item.get('Value')
+            if name == 'MpesaReceiptNumber':
+                mpesa_receipt = value
+
+        db_status = 'completed' if result_code == 0 else 'failed'
+    else:
+        mpesa_receipt = None
+        result_desc = ''
+
+        if event_type in ['payment.success', 'transaction.success'] or payment_status == 'success':
+            db_status = 'completed'
+        elif event_type in ['payment.failed', 'transaction.failed'] or payment_status == 'failed':
+            db_status = 'failed'
+        elif event_type == 'payout.initiated':
+            return {'status': 'success', 'message': 'Payout event ignored'}, 200
+        else:
+            db_status = 'pending'
+
+    if checkout_request_id:
+        match_column, match_value = 'checkout_request_id', checkout_request_id
+    elif transaction_id:
+        match_column, match_value = 'transaction_id', transaction_id
+    else:
+        match_column = None
+
+    changed = []
+    if match_column:
+        key = 'checkout_id' if match_column == 'checkout_request_id' else 'transaction_id'
+        for conn in candidate_payment_connections(**{key: match_value}):
+            try:
+                # Conditional: a stale or out-of-order event (e.g. pending after completed) changes nothing
+                changed = transition(conn, db_status, 'callback', match_column, match_value,
+                                     result_description=result_desc, mpesa_receipt_number=mpesa_receipt)
+                conn.commit()
+            finally:
+                conn.close()
+            if changed:
+                break
+        for payment_record in changed:
+            recent_payments.remember(payment_record)
+
+    if not changed:
+        print(f"Callback for {match_value if match_column else 'unknown payment'} made no transition to {db_status}", file=sys.stderr)
+        return {'status': 'success', 'message': 'No status change'}, 200
+
+    if db_status == 'completed':
+        for payment_record in changed:
+            grant_access_for_payment(
+                payment_record['id'],
+                payment_record['phone_number'],
+                payment_record['bundle_name'],
+                payment_record['amount']
+            )
+
+    print(f"Payment updated to {db_status}", file=sys.stderr)
+
+    return {'status': 'success', 'message': 'Callback processed'}, 200
+
+@api.route('/api/payment/callback', methods=['POST'])
 def payment_callback():
     try:
         signature = request.headers.get('X-Lipana-Signature', '')
@@ -835,106 +722,115 @@ def payment_callback():
         data = request.get_json()
         print(f"Callback received: {json.dumps(data, indent=2)}")
         
-        if not data:
-            return jsonify({'status': 'error', 'message': 'No data received'}), 400
-        
-        event_type = data.get('event', '')
-        payment_data = data.get('data', data)
-        
-        transaction_id = payment_data.get('transactionId') or payment_data.get('transaction_id')
-        checkout_request_id = payment_data.get('checkoutRequestID') or payment_data.get('checkoutRequestId') or payment_data.get('checkout_request_id')
-        payment_status = payment_data.get('status', '')
-        amount = payment_data.get('amount')
-        phone = payment_data.get('phone')
-        
-        print(f"Webhook event: {event_type}, transaction_id: {transaction_id}, status: {payment_status}", file=sys.stderr)
-        
-        body = data.get('Body', {})
-        stk_callback = body.get('stkCallback', {})
-        if stk_callback:
-            checkout_request_id = checkout_request_id or stk_callback.get('CheckoutRequestID')
-            result_code = stk_callback.get('ResultCode')
-            result_desc = stk_callback.get('ResultDesc', '')
-            
-            callback_metadata = stk_callback.get('CallbackMetadata', {})
-            items = callback_metadata.get('Item', [])
-            
-            mpesa_receipt = None
-            for item in items:
-                name = item.get('Name', '')
-                value = item.get('Value')
-                if name == 'MpesaReceiptNumber':
-                    mpesa_receipt = value
-            
-            db_status = 'completed' if result_code == 0 else 'failed'
-        else:
-            mpesa_receipt = None
-            result_desc = ''
-            
-            if event_type in ['payment.success', 'transaction.success'] or payment_status == 'success':
-                db_status = 'completed'
-            elif event_type in ['payment.failed', 'transaction.failed'] or payment_status == 'failed':
-                db_status = 'failed'
-            elif event_type == 'payout.initiated':
-                return jsonify({'status': 'success', 'message': 'Payout event ignored'})
-            else:
-                db_status = 'pending'
+        result, status = process_payment_callback(data)
+        return jsonify(result), status
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
+    except Exception as e:
+        print(f"Callback error: {str(e)}")
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+BATCH_STATUS_MAX_IDS = int(os.environ.get('BATCH_STATUS_MAX_IDS', '1000'))
+BATCH_STATUS_CHUNK = 500
+
+def match_payment_rows(cursor, ids):
+    """
+    Match a chunk of mixed identifiers with one indexed IN (...) query per
+    kind. An id is matched as a checkout_request_id first, then a
+    transaction_id, then a numeric payment id. Returns {id: Payment} for matches.
+    """
+    cursor.row_factory = PAYMENT_ROW
+    columns = 'id, status, amount, bundle_name, mpesa_receipt_number, checkout_request_id, transaction_id, updated_at'
+    placeholders = ','.join('?' * len(ids))
+    
+    by_checkout = {}
+    cursor.execute(f'SELECT {columns} FROM payments WHERE checkout_request_id IN ({placeholders})', ids)
+    for row in cursor.fetchall():
+        by_checkout[row.checkout_request_id] = row
+    
+    remaining = [i for i in ids if i not in by_checkout]
+    by_transaction = {}
+    if remaining:
+        cursor.execute(f"SELECT {columns} FROM payments WHERE transaction_id IN ({','.join('?' * len(remaining))})", remaining)
+        for row in cursor.fetchall():
+            by_transaction[row.transaction_id] = row
+    
+    numeric = [int(i) for i in remaining if i not in by_transaction and i.isdigit()]
+    by_id = {}
+    if numeric:
+        cursor.execute(f"SELECT {columns} FROM payments WHERE id IN ({','.join('?' * len(numeric))})", numeric)
+        for row in cursor.fetchall():
+            by_id[str(row.id)] = row
+    
+    matched = {}
+    for i in ids:
+        row = by_checkout.get(i) or by_transaction.get(i) or by_id.get(i)
+        if row:
+            matched[i] = row
+    return matched
+
+def resolve_payment_statuses(ids):
+    """Resolve a chunk of ids against each live table in turn, then the archive. Returns {id: entry or None}."""
+    matched = {}
+    for conn in shard_connections():
+        try:
+            remaining = [i for i in ids if i not in matched]
+            if remaining:
+                matched.update(match_payment_rows(conn.cursor(), remaining))
+        finally:
+            conn.close()
+    matched.update(match_archived_payments([i for i in ids if i not in matched], match_payment_rows))
+    return {i: PAYMENT_BATCH(matched[i]) if i in matched else None for i in ids}
+
+@api.route('/api/payment/status/batch', methods=['POST', 'OPTIONS'])
+def batch_payment_status():
+    """Status of many payments at once, by checkout, transaction or payment id"""
+    if request.method == 'OPTIONS':
+        return jsonify({})
+    try:
+        data = request.get_json(silent=True) or {}
+        raw_ids = data.get('ids')
         
-        payment_record = None
-        if checkout_request_id:
-            cursor.execute('''
-                UPDATE payments 
-                SET status = ?, result_description = ?, 
-                    mpesa_receipt_number = ?, updated_at = ?
-                WHERE checkout_request_id = ?
-            ''', (db_status, result_desc, mpesa_receipt, 
-                  datetime.now().isoformat(), checkout_request_id))
-            cursor.execute('SELECT id, phone_number, bundle_name FROM payments WHERE checkout_request_id = ?', (checkout_request_id,))
-            payment_record = cursor.fetchone()
-        elif transaction_id:
-            cursor.execute('''
-                UPDATE payments 
-                SET status = ?, result_description = ?, 
-                    mpesa_receipt_number = ?, updated_at = ?
-                WHERE transaction_id = ?
-            ''', (db_status, result_desc, mpesa_receipt, 
-                  datetime.now().isoformat(), transaction_id))
-            cursor.execute('SELECT id, phone_number, bundle_name FROM payments WHERE transaction_id = ?', (transaction_id,))
-            payment_record = cursor.fetchone()
+        if not isinstance(raw_ids, list) or not raw_ids:
+            return jsonify({'success': False, 'error': 'ids must be a non-empty list'}), 400
         
-        conn.commit()
-        conn.close()
+        if len(raw_ids) > BATCH_STATUS_MAX_IDS:
+            return jsonify({
+                'success': False,
+                'error': f'Too many ids: at most {BATCH_STATUS_MAX_IDS} per request'
+            }), 400
         
-        if db_status == 'completed' and payment_record:
-            conn2 = get_db_connection()
-            cursor2 = conn2.cursor()
-            cursor2.execute('SELECT amount FROM payments WHERE id = ?', (payment_record['id'],))
-            payment_amount = cursor2.fetchone()
-            conn2.close()
-            
-            grant_access_for_payment(
-                payment_record['id'],
-                payment_record['phone_number'],
-                payment_record['bundle_name'],
-                payment_amount['amount'] if payment_amount else None
-            )
+        ids = list(dict.fromkeys(str(i).strip() for i in raw_ids if i is not None and str(i).strip()))
+        chunks = [ids[n:n + BATCH_STATUS_CHUNK] for n in range(0, len(ids), BATCH_STATUS_CHUNK)]
         
-        print(f"Payment updated to {db_status}", file=sys.stderr)
+        stream = data.get('format') == 'ndjson' or request.args.get('format') == 'ndjson'
+        if stream:
+            def generate():
+                for chunk in chunks:
+                    for payment_ref, entry in resolve_payment_statuses(chunk).items():
+                        yield json.dumps({'id': payment_ref, 'found': entry is not None, 'payment': entry}) + '\n'
+            return Response(generate(), mimetype='application/x-ndjson')
         
-        return jsonify({'status': 'success', 'message': 'Callback processed'})
+        statuses = {}
+        for chunk in chunks:
+            statuses.update(resolve_payment_statuses(chunk))
+        
+        return jsonify({
+            'success': True,
+            'statuses': statuses,
+            'notFound': [i for i, entry in statuses.items() if entry is None]
+        })
         
     except Exception as e:
-        print(f"Callback error: {str(e)}")
-        return jsonify({'status': 'error', 'message': str(e)}), 500
+        print(f"Batch status error: {str(e)}", file=sys.stderr)
+        return jsonify({'success': False, 'error': str(e)}), 500
 
-@app.route('/api/payment/status/<checkout_id>', methods=['GET'])
+@api.route('/api/payment/status/<checkout_id>', methods=['GET'])
+@rate_limited('status')
 def check_payment_status(checkout_id):
     try:
-        conn = get_db_connection()
+        conn = connect_payment(checkout_id=checkout_id)
         cursor = conn.cursor()
+        cursor.row_factory = PAYMENT_ROW
         cursor.execute('''
             SELECT id, phone_number, amount, bundle_name, status, 
                    mpesa_receipt_number, result_description, created_at
@@ -942,7 +838,7 @@ def check_payment_status(checkout_id):
             WHERE checkout_request_id = ?
         ''', (checkout_id,))
         
-        payment = cursor.fetchone()
+        payment = cursor.fetchone() or find_archived_payment(checkout_id=checkout_id)
         conn.close()
         
         if not payment:
@@ -950,56 +846,248 @@ def check_payment_status(checkout_id):
         
         return jsonify({
             'success': True,
-            'payment': {
-                'id': payment['id'],
-                'phone': payment['phone_number'],
-                'amount': payment['amount'],
-                'bundleName': payment['bundle_name'],
-                'status': payment['status'],
-                'receipt': payment['mpesa_receipt_number'],
-                'message': payment['result_description'],
-                'createdAt': payment['created_at']
-            }
+            'payment': PAYMENT_LOOKUP(payment)
         })
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
-@app.route('/api/payments', methods=['GET'])
+PAYMENTS_PAGE_DEFAULT = 100
+PAYMENTS_PAGE_MAX = 500
+EXPORT_FETCH_SIZE = 500
+PAYMENT_LIST_COLUMNS = '''id, phone_number, amount, bundle_name, status,
+                   mpesa_receipt_number, checkout_request_id, created_at'''
+
+def encode_payments_cursor(created_at, payment_id):
+    raw = json.dumps([created_at, payment_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+def decode_payments_cursor(cursor):
+    created_at, payment_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    return created_at, int(payment_id)
+
+def next_day(date_str):
+    return (datetime.strptime(date_str, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+
+def build_payment_filters(args):
+    """
+    WHERE clause and params for /api/payments from query args: status
+    (comma separated), bundle, phone, from / to (YYYY-MM-DD or full
+    timestamps, inclusive) and cursor. Raises ValueError on bad input.
+    """
+    clauses = []
+    params = []
+    
+    statuses = [s for s in args.get('status', '').split(',') if s]
+    if statuses:
+        clauses.append(f"status IN ({','.join('?' * len(statuses))})")
+        params.extend(statuses)
+    
+    if args.get('bundle'):
+        clauses.append('bundle_name = ?')
+        params.append(args['bundle'])
+    
+    if args.get('phone'):
+        formatted_phone = format_phone_number(args['phone'])
+        if not formatted_phone:
+            raise ValueError('Invalid phone number')
+        clauses.append('phone_number = ?')
+        params.append(formatted_phone)
+    
+    date_from = args.get('from')
+    if date_from:
+        clauses.append('created_at >= ?')
+        params.append(date_from)
+    
+    date_to = args.get('to')
+    if date_to:
+        if len(date_to) == 10:
+            clauses.append('created_at < ?')
+            params.append(next_day(date_to))
+        else:
+            clauses.append('created_at <= ?')
+            params.append(date_to)
+    
+    if args.get('cursor'):
+        try:
+            created_at, payment_id = decode_payments_cursor(args['cursor'])
+        except Exception:
+            raise ValueError('Invalid cursor')
+        clauses.append('(created_at, id) < (?, ?)')
+        params.extend([created_at, payment_id])
+    
+    where = ('WHERE ' + ' AND '.join(clauses)) if clauses else ''
+    return where, params
+
+def iter_rows(cursor):
+    while True:
+        rows = cursor.fetchmany(EXPORT_FETCH_SIZE)
+        if not rows:
+            return
+        yield from rows
+
+def export_payments(where, params, export_format):
+    """Yield the filtered payments as CSV or NDJSON, a batch of rows at a time, merged across shards"""
+    conns = shard_read_connections()
+    try:
+        streams = []
+        for conn in conns:
+            cursor = conn.cursor()
+            cursor.row_factory = PAYMENT_ROW
+            cursor.execute(f'''
+                SELECT {PAYMENT_LIST_COLUMNS}
+                FROM payments
+                {where}
+                ORDER BY created_at DESC, id DESC
+            ''', params)
+            streams.append(iter_rows(cursor))
+        
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if export_format == 'csv':
+            writer.writerow(PAYMENT_LIST.keys)
+        
+        for n, p in enumerate(merge_sorted(streams, key=payment_sort_key, reverse=True), 1):
+            if export_format == 'csv':
+                writer.writerow(PAYMENT_LIST.values(p))
+            else:
+                buffer.write(json.dumps(PAYMENT_LIST(p)))
+                buffer.write('\n')
+            if n % EXPORT_FETCH_SIZE == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate(0)
+        
+        remainder = buffer.getvalue()
+        if remainder:
+            yield remainder
+    finally:
+        for conn in conns:
+            conn.close()
+
+@api.route('/api/payments', methods=['GET'])
 def get_all_payments():
+    """
+    Payments newest first, keyset-paginated on (created_at, id). Pass
+    nextCursor back as ?cursor= for the next page, or format=csv|ndjson to
+    stream every matching row.
+    """
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, phone_number, amount, bundle_name, status, 
-                   mpesa_receipt_number, checkout_request_id, created_at
-            FROM payments 
-            ORDER BY created_at DESC
-            LIMIT 100
-        ''')
+        try:
+            where, params = build_payment_filters(request.args)
+            limit = min(max(int(request.args.get('limit', PAYMENTS_PAGE_DEFAULT)), 1), PAYMENTS_PAGE_MAX)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        
+        export_format = request.args.get('format')
+        if export_format in ('csv', 'ndjson'):
+            mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+            filename = f"payments_{datetime.now().strftime('%Y%m%d%H%M%S')}.{export_format}"
+            return Response(
+                export_payments(where, params, export_format),
+                mimetype=mimetype,
+                headers={'Content-Disposition': f'attachment; filename={filename}'}
+            )
         
-        payments = cursor.fetchall()
-        conn.close()
+        # Each shard returns its own newest limit + 1; the merge keeps the overall newest
+        shard_pages = []
+        for conn in shard_read_connections():
+            cursor = conn.cursor()
+            cursor.row_factory = PAYMENT_ROW
+            cursor.execute(f'''
+                SELECT {PAYMENT_LIST_COLUMNS}
+                FROM payments 
+                {where}
+                ORDER BY created_at DESC, id DESC
+                LIMIT ?
+            ''', params + [limit + 1])
+            shard_pages.append(cursor.fetchall())
+            conn.close()
         
-        payment_list = []
-        for p in payments:
-            payment_list.append({
-                'id': p['id'],
-                'phone': p['phone_number'],
-                'amount': p['amount'],
-                'bundleName': p['bundle_name'],
-                'status': p['status'],
-                'receipt': p['mpesa_receipt_number'],
-                'checkoutId': p['checkout_request_id'],
-                'createdAt': p['created_at']
-            })
+        payments = list(islice(merge_sorted(shard_pages, key=payment_sort_key, reverse=True), limit + 1))
+        
+        next_cursor = None
+        if len(payments) > limit:
+            payments = payments[:limit]
+            last = payments[-1]
+            next_cursor = encode_payments_cursor(last.created_at, last.id)
+        
+        payment_list = [PAYMENT_LIST(p) for p in payments]
         
-        return jsonify({'success': True, 'payments': payment_list})
+        return jsonify({'success': True, 'payments': payment_list, 'nextCursor': next_cursor})
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
-@app.route('/api/packages', methods=['GET'])
+def admin_rejection():
+    """
+    The error response for an admin request, or None when X-Admin-Key matches
+    ADMIN_API_KEY. Admin endpoints are disabled (404) while the key is unset.
+    """
+    admin_key = os.environ.get('ADMIN_API_KEY')
+    if not admin_key:
+        return jsonify({'success': False, 'error': 'Not found'}), 404
+    if not hmac.compare_digest(request.headers.get('X-Admin-Key', ''), admin_key):
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+    return None
+
+@api.route('/api/admin/analytics', methods=['GET'])
+def get_analytics():
+    """
+    Hourly or daily rollups, e.g. ?granularity=day&from=2024-12-01&to=2024-12-07&metric=payments_completed
+    Reads only analytics_rollups, never the payments table.
+    """
+    rejection = admin_rejection()
+    if rejection:
+        return rejection
+
+    try:
+        granularity = request.args.get('granularity', 'day')
+        metric = request.args.get('metric')
+        if granularity not in GRANULARITIES:
+            return jsonify({'success': False, 'error': f"granularity must be one of: {', '.join(GRANULARITIES)}"}), 400
+        if metric and metric not in METRICS:
+            return jsonify({'success': False, 'error': f"metric must be one of: {', '.join(METRICS)}"}), 400
+
+        # Shards each hold the rollups of their own events; sum them per bucket
+        merged = {}
+        for conn in shard_read_connections():
+            for row in query_rollups(conn, granularity, request.args.get('from'), request.args.get('to'), metric):
+                entry = merged.setdefault((row['bucket'], row['metric'], row['dimension']), [0, 0])
+                entry[0] += row['count']
+                entry[1] += row['amount']
+            conn.close()
+
+        series = []
+        totals = {}
+        for (bucket, metric_name, dimension), (count, amount) in sorted(merged.items()):
+            series.append({
+                'bucket': bucket,
+                'metric': metric_name,
+                'dimension': dimension,
+                'count': count,
+                'amount': amount
+            })
+            total = totals.setdefault(metric_name, {'count': 0, 'amount': 0, 'byDimension': {}})
+            total['count'] += count
+            total['amount'] += amount
+            if dimension:
+                by_dim = total['byDimension'].setdefault(dimension, {'count': 0, 'amount': 0})
+                by_dim['count'] += count
+                by_dim['amount'] += amount
+
+        return jsonify({
+            'success': True,
+            'granularity': granularity,
+            'series': series,
+            'totals': totals
+        })
+
+    except Exception as e:
+        print(f"Analytics error: {str(e)}", file=sys.stderr)
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@api.route('/api/packages', methods=['GET'])
 def get_packages():
     """Get all available packages with their features"""
     packages_list = []
@@ -1009,6 +1097,7 @@ def get_packages():
             'name': pkg_data['name'],
             'price': pkg_data['price'],
             'description': pkg_data['description'],
+            'durationDays': pkg_data['duration_days'],
             'features': [
                 {
                     'key': key,
@@ -1020,7 +1109,7 @@ def get_packages():
         })
     return jsonify({'success': True, 'packages': packages_list})
 
-@app.route('/api/user/access', methods=['POST'])
+@api.route('/api/user/access', methods=['POST'])
 def check_user_access():
     """Check user's access level and available features"""
     try:
@@ -1097,7 +1186,17 @@ def check_user_access():
         print(f"Access check error: {str(e)}", file=sys.stderr)
         return jsonify({'success': False, 'error': str(e)}), 500
 
-@app.route('/api/crb/report', methods=['POST'])
+def requested_loan_amount(data):
+    """Optional loanAmount from a report request, for lender matching; raises ValueError if invalid"""
+    amount = data.get('loanAmount') or 0
+    if isinstance(amount, (bool, dict, list)):
+        raise ValueError('Invalid loan amount')
+    amount = float(amount)
+    if not math.isfinite(amount) or amount < 0:
+        raise ValueError('Invalid loan amount')
+    return amount
+
+@api.route('/api/crb/report', methods=['POST'])
 def get_crb_report():
     """Get CRB report based on user's package level"""
     try:
@@ -1111,6 +1210,11 @@ def get_crb_report():
         if not formatted_phone:
             return jsonify({'success': False, 'error': 'Invalid phone number'}), 400
         
+        try:
+            loan_amount = requested_loan_amount(data)
+        except ValueError:
+            return jsonify({'success': False, 'error': 'Invalid loan amount'}), 400
+        
         package_type = get_user_package(formatted_phone)
         
         if not package_type:
@@ -1119,7 +1223,9 @@ def get_crb_report():
                 'error': 'No active package. Please purchase a package to view your CRB report.'
             }), 403
         
-        report = generate_crb_report(formatted_phone)
+        report = ready_report(formatted_phone)
+        if report is None:
+            return report_preparing()
         package = PACKAGES.get(package_type, PACKAGES['standard'])
         features = package['features']
         
@@ -1129,35 +1235,28 @@ def get_crb_report():
                 'id': package_type,
                 'name': package['name']
             },
-            'report': {
-                'phone': formatted_phone,
-                'generatedAt': report.get('created_at')
-            }
+            'report': CRB_REPORT(report)
         }
         
-        if features.get('credit_score'):
-            response_data['report']['creditScore'] = report.get('credit_score')
-        
-        if features.get('crb_status'):
-            response_data['report']['crbStatus'] = report.get('crb_status')
-        
-        if features.get('loan_eligibility'):
-            response_data['report']['loanEligibility'] = report.get('loan_eligibility')
+        for feature, key in (('credit_score', 'creditScore'), ('crb_status', 'crbStatus'),
+                             ('loan_eligibility', 'loanEligibility')):
+            if not features.get(feature):
+                del response_data['report'][key]
         
         if features.get('credit_history'):
-            response_data['report']['creditHistory'] = json.loads(report.get('credit_history', '[]'))
+            response_data['report']['creditHistory'] = decode_credit_history(report.credit_history)
         else:
             response_data['report']['creditHistory'] = None
             response_data['report']['creditHistoryLocked'] = True
         
         if features.get('detailed_analysis'):
-            response_data['report']['detailedAnalysis'] = json.loads(report.get('detailed_analysis', '{}'))
+            response_data['report']['detailedAnalysis'] = decode_analysis(report.detailed_analysis)
         else:
             response_data['report']['detailedAnalysis'] = None
             response_data['report']['detailedAnalysisLocked'] = True
         
         if features.get('lender_recommendations'):
-            response_data['report']['lenderRecommendations'] = json.loads(report.get('lender_recommendations', '[]'))
+            response_data['report']['lenderRecommendations'] = match_lenders(report.credit_score or 0, loan_amount)
         else:
             response_data['report']['lenderRecommendations'] = None
             response_data['report']['lenderRecommendationsLocked'] = True
@@ -1202,108 +1301,24 @@ def get_crb_report():
         print(f"CRB report error: {str(e)}", file=sys.stderr)
         return jsonify({'success': False, 'error': str(e)}), 500
 
-@app.route('/api/upgrade/initiate', methods=['POST', 'OPTIONS'])
+@api.route('/api/upgrade/initiate', methods=['POST', 'OPTIONS'])
+@rate_limited('initiate')
 def initiate_upgrade():
     """Initiate upgrade payment to a higher package"""
     if request.method == 'OPTIONS':
         return jsonify({})
-    
     try:
-        data = request.get_json()
-        phone = data.get('phone')
-        target_package = data.get('targetPackage')
-        
-        if not phone or not target_package:
-            return jsonify({'success': False, 'error': 'Phone and target package required'}), 400
-        
-        formatted_phone = format_phone_number(phone)
-        if not formatted_phone:
-            return jsonify({'success': False, 'error': 'Invalid phone number'}), 400
-        
-        if target_package not in PACKAGES:
-            return jsonify({'success': False, 'error': 'Invalid package'}), 400
-        
-        current_package = get_user_package(formatted_phone)
-        target_pkg = PACKAGES[target_package]
-        
-        if current_package:
-            current_pkg = PACKAGES.get(current_package, PACKAGES['standard'])
-            amount = target_pkg['price'] - current_pkg['price']
-            if amount <= 0:
-                return jsonify({'success': False, 'error': 'Cannot downgrade package'}), 400
-        else:
-            amount = target_pkg['price']
-        
-        if not lipana_client:
-            return jsonify({
-                'success': False, 
-                'error': 'Payment service not configured.'
-            }), 500
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO payments (phone_number, amount, bundle_name, status)
-            VALUES (?, ?, ?, 'pending')
-        ''', (formatted_phone, amount, target_package))
-        payment_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        
-        phone_with_plus = f'+{formatted_phone}'
-        
-        try:
-            stk_response = lipana_client.transactions.initiate_stk_push(
-                phone=phone_with_plus,
-                amount=int(amount)
-            )
-            
-            checkout_id = stk_response.get('checkoutRequestID') or stk_response.get('checkoutRequestId')
-            transaction_id = stk_response.get('transactionId')
-            
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE payments 
-                SET checkout_request_id = ?, transaction_id = ?, status = 'processing', updated_at = ?
-                WHERE id = ?
-            ''', (checkout_id, transaction_id, datetime.now().isoformat(), payment_id))
-            conn.commit()
-            conn.close()
-            
-            return jsonify({
-                'success': True,
-                'message': f'Upgrade to {target_pkg["name"]} initiated. Check your phone to complete payment of KES {amount}.',
-                'paymentId': payment_id,
-                'checkoutRequestId': checkout_id,
-                'amount': amount,
-                'targetPackage': target_package
-            })
-            
-        except Exception as sdk_error:
-            error_msg = str(sdk_error)
-            print(f"Upgrade payment error: {error_msg}", file=sys.stderr)
-            
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute('''
-                UPDATE payments SET status = 'failed', result_description = ?, updated_at = ?
-                WHERE id = ?
-            ''', (error_msg, datetime.now().isoformat(), payment_id))
-            conn.commit()
-            conn.close()
-            
-            return jsonify({'success': False, 'error': error_msg}), 400
-            
+        body, status = payments.initiate(UPGRADE_PIPELINE, request.get_json())
+        return jsonify(body), status
     except Exception as e:
         print(f"Upgrade error: {str(e)}", file=sys.stderr)
         return jsonify({'success': False, 'error': str(e)}), 500
 
-@app.route('/assets/<path:filename>')
+@api.route('/assets/<path:filename>')
 def serve_assets(filename):
     return send_from_directory('assets', filename)
 
-@app.route('/api/stats/counter')
+@api.route('/api/stats/counter')
 def get_stats_counter():
     """
     Returns the dynamic Kenyans counter that:
@@ -1327,8 +1342,20 @@ def get_stats_counter():
     time_diff = now_kenya - last_sunday_midnight
     hours_elapsed = int(time_diff.total_seconds() / 3600)
     
-    # Calculate counter: starts at 10,000, increases by 100 every hour
-    counter = 10000 + (hours_elapsed * 100)
+    if os.environ.get('COUNTER_FROM_ROLLUPS') == '1':
+        # Real activity: reports generated this week, read from at most 7 day buckets
+        # (buckets are UTC days, so the week boundary is approximate)
+        week_days = [(last_sunday_midnight + timedelta(days=i)).strftime('%Y-%m-%d')
+                     for i in range(days_since_sunday + 1)]
+        counter = 10000
+        for conn in shard_connections():
+            try:
+                counter += counter_for_days(conn, 'reports_generated', week_days)
+            finally:
+                conn.close()
+    else:
+        # Calculate counter: starts at 10,000, increases by 100 every hour
+        counter = 10000 + (hours_elapsed * 100)
     
     return jsonify({
         'success': True,
@@ -1336,19 +1363,19 @@ def get_stats_counter():
         'formatted': f"{counter:,}+"
     })
 
-@app.route('/favicon.ico')
+@api.route('/favicon.ico')
 def serve_favicon():
     return send_file('favicon.ico')
 
-@app.route('/robots.txt')
+@api.route('/robots.txt')
 def serve_robots():
     return send_file('robots.txt')
 
-@app.route('/placeholder.svg')
+@api.route('/placeholder.svg')
 def serve_placeholder():
     return send_file('placeholder.svg')
 
-@app.route('/api/crb/download-report', methods=['POST'])
+@api.route('/api/crb/download-report', methods=['POST'])
 def download_crb_report():
     """Generate and download CRB report as PDF (Golden package only)"""
     try:
@@ -1366,7 +1393,15 @@ def download_crb_report():
         if package_type != 'golden':
             return jsonify({'success': False, 'error': 'Golden package required to download reports'}), 403
         
-        report_data = generate_crb_report(formatted_phone)
+        try:
+            loan_amount = requested_loan_amount(data)
+        except ValueError:
+            return jsonify({'success': False, 'error': 'Invalid loan amount'}), 400
+        
+        report_data = ready_report(formatted_phone)
+        if report_data is None:
+            return report_preparing()
+        report_data = report_data._replace(lender_recommendations=match_lenders(report_data.credit_score or 0, loan_amount))
         
         from io import BytesIO
         from datetime import datetime
@@ -1393,27 +1428,22 @@ def generate_pdf_report(phone, report_data):
     """Generate a simple PDF report"""
     from datetime import datetime
     
-    credit_score = report_data.get('credit_score', 'N/A')
-    crb_status = report_data.get('crb_status', 'N/A')
-    loan_eligibility = report_data.get('loan_eligibility', 'N/A')
-    credit_history_str = report_data.get('credit_history', '[]')
-    detailed_analysis_str = report_data.get('detailed_analysis', '{}')
-    lender_recs_str = report_data.get('lender_recommendations', '[]')
+    credit_score = report_data.credit_score
+    crb_status = report_data.crb_status
+    loan_eligibility = report_data.loan_eligibility
     
     try:
-        credit_history = json.loads(credit_history_str) if isinstance(credit_history_str, str) else credit_history_str
-    except:
+        credit_history = decode_credit_history(report_data.credit_history)
+    except ValueError:
         credit_history = []
     
     try:
-        detailed_analysis = json.loads(detailed_analysis_str) if isinstance(detailed_analysis_str, str) else detailed_analysis_str
-    except:
+        detailed_analysis = decode_analysis(report_data.detailed_analysis)
+    except ValueError:
         detailed_analysis = {}
     
-    try:
-        lender_recommendations = json.loads(lender_recs_str) if isinstance(lender_recs_str, str) else lender_recs_str
-    except:
-        lender_recommendations = []
+    # The caller matches lenders live for the requested loan amount
+    lender_recommendations = report_data.lender_recommendations or []
     
     pdf_lines = []
     pdf_lines.append("%PDF-1.4")
@@ -1492,7 +1522,7 @@ def generate_pdf_report(phone, report_data):
     
     return "\n".join(pdf_lines).encode('latin-1')
 
-@app.route('/api/lender/connect', methods=['POST'])
+@api.route('/api/lender/connect', methods=['POST'])
 def connect_to_lender():
     """Connect user to a direct lender (Golden package only)"""
     try:
@@ -1511,43 +1541,24 @@ def connect_to_lender():
         if package_type != 'golden':
             return jsonify({'success': False, 'error': 'Golden package required to connect with lenders'}), 403
         
-        if lender_id not in DIRECT_LENDERS:
+        lender = find_lender(lender_id)
+        if not lender:
             return jsonify({'success': False, 'error': 'Invalid lender ID'}), 400
         
-        lender = DIRECT_LENDERS[lender_id]
-        
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS lender_connections (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                phone_number TEXT NOT NULL,
-                lender_id TEXT NOT NULL,
-                lender_name TEXT NOT NULL,
-                status TEXT DEFAULT 'pending',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        cursor.execute('''
-            INSERT INTO lender_connections (phone_number, lender_id, lender_name)
-            VALUES (?, ?, ?)
-        ''', (formatted_phone, lender_id, lender['name']))
-        
-        conn.commit()
-        conn.close()
+        # Delivery happens in the background (leads.py); repeat clicks reuse the queued lead
+        lead_id, lead_status = store.lender_connections.enqueue(formatted_phone, lender_id, lender['name'])
         
-        print(f"Lender connection: {formatted_phone} -> {lender['name']}", file=sys.stderr)
+        print(f"Lender connection: {formatted_phone} -> {lender['name']} (lead {lead_id}, {lead_status})", file=sys.stderr)
         
         return jsonify({
             'success': True,
             'message': f"Successfully connected to {lender['name']}. You will receive contact within 24 hours.",
+            'leadStatus': lead_status,
             'lender': {
                 'name': lender['name'],
-                'type': lender['type'],
+                'type': lender.get('type', ''),
                 'maxAmount': lender['max_amount'],
-                'interestRate': lender['interest_rate']
+                'interestRate': lender.get('interest_rate', '')
             }
         })
         
@@ -1555,27 +1566,173 @@ def connect_to_lender():
         print(f"Lender connection error: {str(e)}", file=sys.stderr)
         return jsonify({'success': False, 'error': str(e)}), 500
 
-@app.route('/dashboard')
+LENDER_BATCH_MAX_PHONES = int(os.environ.get('LENDER_BATCH_MAX_PHONES', '10000'))
+ENTITLEMENT_QUERY_CHUNK = 900
+
+def lender_api_keys():
+    """{lender_id: key} parsed from LENDER_API_KEYS, e.g. mshwari:key1,tala:key2"""
+    keys = {}
+    for pair in os.environ.get('LENDER_API_KEYS', '').split(','):
+        lender_id, _, key = pair.strip().partition(':')
+        if lender_id and key:
+            keys[lender_id] = key
+    return keys
+
+def resolve_package_tiers(conn, phones):
+    """Latest unexpired package per phone, resolved with chunked IN (...) queries"""
+    now = utc_timestamp()
+    tiers = {}
+    cursor = conn.cursor()
+    for n in range(0, len(phones), ENTITLEMENT_QUERY_CHUNK):
+        chunk = phones[n:n + ENTITLEMENT_QUERY_CHUNK]
+        cursor.execute(f"""
+            SELECT phone_number, package_type FROM user_access
+            WHERE is_active = 1 AND phone_number IN ({','.join('?' * len(chunk))})
+              AND (expires_at IS NULL OR expires_at > ?)
+            ORDER BY created_at, id
+        """, chunk + [now])
+        # Rows come oldest first, so the last one seen per phone wins
+        for phone_number, package_type in cursor.fetchall():
+            tiers[phone_number] = package_type
+    return tiers
+
+@api.route('/api/lender/access/batch', methods=['POST', 'OPTIONS'])
+def lender_batch_access():
+    """Package tiers for a list of phones, for partner lender pre-screening"""
+    if request.method == 'OPTIONS':
+        return jsonify({})
+    try:
+        lender_id = request.headers.get('X-Lender-Id', '')
+        lender_key = request.headers.get('X-Lender-Key', '')
+        expected_key = lender_api_keys().get(lender_id)
+        if not find_lender(lender_id) or not expected_key or not hmac.compare_digest(expected_key, lender_key):
+            return jsonify({'success': False, 'error': 'Invalid lender credentials'}), 403
+        
+        data = request.get_json(silent=True) or {}
+        phones = data.get('phones')
+        
+        if not isinstance(phones, list) or not phones:
+            return jsonify({'success': False, 'error': 'phones must be a non-empty list'}), 400
+        
+        if len(phones) > LENDER_BATCH_MAX_PHONES:
+            return jsonify({
+                'success': False,
+                'error': f'Too many phones: at most {LENDER_BATCH_MAX_PHONES} per request'
+            }), 400
+        
+        normalized = normalize_phone_numbers(phones)
+        unique_phones = list({p for p in normalized if p})
+        
+        tiers = {}
+        for shard, shard_phones in group_by_shard(unique_phones).items():
+            conn = connect_shard(shard)
+            try:
+                tiers.update(resolve_package_tiers(conn, shard_phones))
+            finally:
+                conn.close()
+        
+        return jsonify({
+            'success': True,
+            'count': len(phones),
+            'tiers': [tiers.get(p) if p else None for p in normalized],
+            'invalid': [i for i, p in enumerate(normalized) if p is None]
+        })
+        
+    except Exception as e:
+        print(f"Lender batch access error: {str(e)}", file=sys.stderr)
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@api.route('/healthz')
+def healthz():
+    """Liveness: the process is up and serving requests, no I/O. Lists the background workers' freshness."""
+    return jsonify({'status': 'ok', 'workers': worker_status()})
+
+@api.route('/readyz')
+def readyz():
+    """Readiness: database and Lipana (cached briefly)"""
+    result = check_readiness()
+    return jsonify(result), 200 if result['ready'] else 503
+
+@api.route('/dashboard')
 def serve_dashboard():
     return send_file('dashboard.html')
 
-@app.route('/', defaults={'path': ''})
-@app.route('/<path:path>')
+@api.route('/', defaults={'path': ''})
+@api.route('/<path:path>')
 def serve_spa(path):
     return send_file('index.html')
 
-@app.after_request
+def default_headers(path):
+    headers = {
+        'Cache-Control': 'no-cache, no-store, must-revalidate',
+        'Pragma': 'no-cache',
+        'Expires': '0'
+    }
+    if path.startswith('/api/'):
+        headers['Access-Control-Allow-Origin'] = '*'
+        headers['Access-Control-Allow-Methods'] = 'POST, GET, OPTIONS'
+        headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
+    return headers
+
+@api.after_app_request
 def add_headers(response):
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
-    if request.path.startswith('/api/'):
-        response.headers['Access-Control-Allow-Origin'] = '*'
-        response.headers['Access-Control-Allow-Methods'] = 'POST, GET, OPTIONS'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization'
+    response.headers.update(default_headers(request.path))
     return response
 
-init_db()
+def start_background_jobs():
+    """
+    Start the periodic maintenance workers configured for this process. Called
+    once per serving process (gunicorn post_worker_init, ASGI lifespan,
+    __main__), never in a preloading master, whose threads would not survive
+    the fork. Each job runs in only one process at a time (see background.py).
+    """
+    archive_interval = float(os.environ.get('ARCHIVE_INTERVAL_SECONDS', '0'))
+    if archive_interval > 0:
+        start_periodic('archive', archive_old_rows, archive_interval)
+    sweep_interval = float(os.environ.get('SWEEP_INTERVAL_SECONDS', '300'))
+    if sweep_interval > 0:
+        start_periodic('sweeper', lambda: sweep_stuck_payments(on_completed=grant_access_for_payment), sweep_interval)
+        start_periodic('entitlements', expire_entitlements, sweep_interval)
+    request_interval = float(os.environ.get('REPORT_REQUEST_INTERVAL_SECONDS', '5'))
+    if request_interval > 0:
+        start_periodic('report-requests', prepare_requested_reports, request_interval)
+    report_interval = float(os.environ.get('REPORT_REFRESH_INTERVAL_SECONDS', '600'))
+    if report_interval > 0:
+        start_periodic('reports', refresh_stale_reports, report_interval)
+    lead_interval = float(os.environ.get('LEAD_DISPATCH_INTERVAL_SECONDS', '10'))
+    if lead_interval > 0:
+        start_periodic('leads', dispatch_leads, lead_interval)
+    if RATE_LIMITING:
+        start_periodic('ratelimit-prune', prune_buckets, 3600)
+    if SNAPSHOT_PATH:
+        snapshot_interval = float(os.environ.get('SNAPSHOT_REFRESH_SECONDS', '30'))
+        start_periodic('snapshot', lambda: refresh_snapshot(min_age=snapshot_interval / 2), snapshot_interval)
+
+def create_app(run_migrations=None):
+    """Build the Flask app.
+
+    Startup phases:
+    1. migrate  - idempotent schema setup, once per process. Under gunicorn
+                  this happens in the master (see gunicorn.conf.py), which sets
+                  SKIP_MIGRATIONS so workers skip it.
+    2. register - routes, request hooks, optional profiling and capture.
+    Per-worker resources (Lipana client, HTTP session, DB connections) are
+    created lazily on first use, after fork.
+    """
+    if run_migrations is None:
+        run_migrations = os.environ.get('SKIP_MIGRATIONS') != '1'
+    if run_migrations:
+        init_db()
+        init_shards()
+
+    app = Flask(__name__, static_folder='.')
+    app.register_blueprint(api)
+    init_profiling(app)
+    init_capture(app)
+    return app
+
+app = create_app()
 
 if __name__ == '__main__':
+    start_background_jobs()
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,24 @@
+"""
+Environment readers for optional tooling settings, where a mistyped value
+should fall back to the default rather than stop the app from starting.
+"""
+import os
+
+
+def env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def env_int(name, default):
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def env_flag(name):
+    """True when the variable is set to 1, true or yes"""
+    return os.environ.get(name, '').lower() in ('1', 'true', 'yes')
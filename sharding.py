@@ -0,0 +1,359 @@
+"""
+Optional sharded storage.
+
+With SHARD_COUNT > 1, payments, user_access and crb_reports (and the
+analytics rollups for their events) live in SHARD_COUNT SQLite files next to
+DATABASE_PATH, e.g. payments.4x0.db ... payments.4x3.db, picked by a CRC32 of
+the normalized phone number. Each shard has its own writer lock, so
+initiations, callbacks, access grants and report inserts for different
+phones stop serializing on one file.
+
+Payment ids are allocated in the shard itself and encode it (id %
+PAYMENT_ID_STRIDE), so an initiation never writes to the main database.
+Lookups by payment id go straight to that shard; lookups by checkout or
+transaction id, and ids from before a reshard, ask each shard in turn.
+Admin reads go through shard_read_connections() and merge_sorted().
+
+With SHARD_COUNT unset or 1 every helper returns the main database, so call
+sites look the same in both modes.
+
+Move existing data to a new layout, with writers stopped, then restart with
+the new SHARD_COUNT:
+    python sharding.py reshard --to 4 [--from 1] [--keep-source]
+"""
+import os
+import sys
+import zlib
+import heapq
+import argparse
+
+import database
+
+SHARD_COUNT = max(int(os.environ.get('SHARD_COUNT', '1')), 1)
+# Sharded payment ids are a multiple of this plus their shard; fixed, since
+# ids outlive layouts, and so the upper bound on SHARD_COUNT
+PAYMENT_ID_STRIDE = 1024
+# Id for a payment row in shard ? (NULL: AUTOINCREMENT), the next one above
+# every id this file has handed out
+NEXT_PAYMENT_ID = f'''(SELECT (COALESCE(MAX(seq), 0) / {PAYMENT_ID_STRIDE} + 1) * {PAYMENT_ID_STRIDE} + ?
+                      FROM sqlite_sequence WHERE name = 'payments')'''
+SHARDED_TABLES = ('payments', 'user_access', 'crb_reports')
+RESHARD_BATCH_SIZE = 1000
+
+
+def sharding_enabled():
+    return SHARD_COUNT > 1
+
+
+def shard_path(index, count=None):
+    root, ext = os.path.splitext(database.DATABASE_PATH)
+    return f'{root}.{count or SHARD_COUNT}x{index}{ext or ".db"}'
+
+
+def layout_paths(count):
+    """Database files of a layout; a layout of 1 is the main database"""
+    if count <= 1:
+        return [database.DATABASE_PATH]
+    return [shard_path(i, count) for i in range(count)]
+
+
+def shard_for_phone(phone, count=None):
+    return zlib.crc32(phone.encode('utf-8')) % (count or SHARD_COUNT)
+
+
+def connect_shard(index, check_same_thread=True):
+    """Connection to one shard; the main database when not sharded"""
+    if not sharding_enabled():
+        return database.get_db_connection(check_same_thread)
+    return database.get_db_connection(check_same_thread, path=shard_path(index))
+
+
+def connect_phone(phone, check_same_thread=True):
+    """Connection holding this phone's payments, entitlements and reports"""
+    if not sharding_enabled() or not phone:
+        return database.get_db_connection(check_same_thread)
+    return connect_shard(shard_for_phone(phone), check_same_thread)
+
+
+def group_by_shard(phones):
+    """{shard: [phones]}; everything in shard 0 when not sharded"""
+    if not sharding_enabled():
+        return {0: list(phones)}
+    groups = {}
+    for phone in phones:
+        groups.setdefault(shard_for_phone(phone), []).append(phone)
+    return groups
+
+
+def shard_connections(check_same_thread=True):
+    """One live connection per shard, or just the main database"""
+    return [connect_shard(i, check_same_thread) for i in range(SHARD_COUNT)]
+
+
+def shard_read_connections():
+    """Connections for admin reads. Unsharded this is the read snapshot; shards are read live."""
+    if not sharding_enabled():
+        return [database.get_read_connection()]
+    return shard_connections()
+
+
+def merge_sorted(iterables, key, reverse=False):
+    """Merge per-shard results that are each already sorted by key"""
+    return heapq.merge(*iterables, key=key, reverse=reverse)
+
+
+def shard_of_payment_id(payment_id):
+    """Shard encoded in a payment id, or None when it names no shard of this layout"""
+    try:
+        shard = int(payment_id) % PAYMENT_ID_STRIDE
+    except (TypeError, ValueError):
+        return None
+    return shard if shard < SHARD_COUNT else None
+
+
+def payment_id_shard(phone):
+    """Shard to encode in a new payment's id (see NEXT_PAYMENT_ID); None when not sharded"""
+    return shard_for_phone(phone) if sharding_enabled() else None
+
+
+def payment_sequence(conn):
+    """Highest payment id this file has ever handed out, archived ones included"""
+    return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'payments'").fetchone()[0]
+
+
+def align_payment_ids(conns, floor=0):
+    """
+    Raise every file's payment sequence to the highest in the layout (or
+    floor), so new ids cannot collide with ids allocated before they encoded
+    their shard or copied in from another layout. The caller commits.
+    """
+    seqs = [payment_sequence(conn) for conn in conns]
+    top = max(seqs + [floor])
+    for conn, seq in zip(conns, seqs):
+        if seq < top and not conn.execute("UPDATE sqlite_sequence SET seq = ? WHERE name = 'payments'", (top,)).rowcount:
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('payments', ?)", (top,))
+
+
+def init_shards():
+    """Migrate every shard and align their payment ids; a no-op when not sharded"""
+    if not sharding_enabled():
+        return
+    if SHARD_COUNT > PAYMENT_ID_STRIDE:
+        raise ValueError(f'SHARD_COUNT can be at most {PAYMENT_ID_STRIDE}')
+    for path in layout_paths(SHARD_COUNT):
+        database.init_db(path)
+    conns = shard_connections()
+    try:
+        align_payment_ids(conns)
+        for conn in conns:
+            conn.commit()
+    finally:
+        for conn in conns:
+            conn.close()
+    conn = database.connect()
+    # The directory that used to allocate ids on the main database
+    conn.execute('DROP TABLE IF EXISTS payment_directory')
+    conn.commit()
+    conn.close()
+
+
+def _find_shard(column, value, first=None):
+    """First shard with a payment whose column matches, trying shard first"""
+    order = [first] if first is not None else []
+    order += [i for i in range(SHARD_COUNT) if i != first]
+    for index in order:
+        conn = connect_shard(index)
+        try:
+            if conn.execute(f'SELECT 1 FROM payments WHERE {column} = ? LIMIT 1', (value,)).fetchone():
+                return index
+        finally:
+            conn.close()
+    return None
+
+
+def locate_payment(payment_id=None, checkout_id=None, transaction_id=None):
+    """
+    Shard holding a payment, trying each identifier in check-status order. A
+    payment id is looked for in the shard it encodes first; every other lookup
+    asks each shard in turn.
+    """
+    lookups = (
+        ('id', payment_id, shard_of_payment_id(payment_id)),
+        ('checkout_request_id', checkout_id, None),
+        ('transaction_id', transaction_id, None)
+    )
+    for column, value, first in lookups:
+        if value:
+            shard = _find_shard(column, value, first)
+            if shard is not None:
+                return shard
+    return None
+
+
+def latest_payment_shard():
+    newest = None
+    for index in range(SHARD_COUNT):
+        conn = connect_shard(index)
+        try:
+            row = conn.execute('SELECT created_at, id FROM payments ORDER BY created_at DESC, id DESC LIMIT 1').fetchone()
+        finally:
+            conn.close()
+        if row and (newest is None or tuple(row) > newest[0]):
+            newest = (tuple(row), index)
+    return newest[1] if newest else None
+
+
+def connect_payment(payment_id=None, checkout_id=None, transaction_id=None, phone=None, check_same_thread=True):
+    """
+    Connection to the shard holding a payment: by its identifiers, then by
+    phone. With no identifier at all, the shard of the newest payment. Falls
+    back to the main database.
+    """
+    if not sharding_enabled():
+        return database.get_db_connection(check_same_thread)
+    shard = locate_payment(payment_id, checkout_id, transaction_id)
+    if shard is None and phone:
+        shard = shard_for_phone(phone)
+    if shard is None and not (payment_id or checkout_id or transaction_id):
+        shard = latest_payment_shard()
+    if shard is None:
+        return database.get_db_connection(check_same_thread)
+    return connect_shard(shard, check_same_thread)
+
+
+def candidate_payment_connections(checkout_id=None, transaction_id=None):
+    """
+    Connections, one at a time, to the shards that may hold the payment with
+    these Lipana ids: the shard that has them, or every shard when none does
+    yet (a callback can arrive before the initiation has stored them). The
+    main database when not sharded.
+    """
+    if not sharding_enabled():
+        yield database.get_db_connection()
+        return
+    shard = locate_payment(checkout_id=checkout_id, transaction_id=transaction_id)
+    for index in ([shard] if shard is not None else range(SHARD_COUNT)):
+        yield connect_shard(index)
+
+
+def _copy_table(source, targets, table, target_count, keep_ids, query=None):
+    """
+    Stream a table from one source file into the target layout. Rows are routed
+    by phone_number, or by a _phone column the query adds for tables without one.
+    """
+    cursor = source.execute(query or f'SELECT * FROM {table}')
+    selected = [d[0] for d in cursor.description]
+    phone_key = '_phone' if '_phone' in selected else 'phone_number'
+    columns = [c for c in selected if c != '_phone' and (keep_ids or c != 'id')]
+    insert = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({','.join('?' * len(columns))})"
+    moved = 0
+    while True:
+        rows = cursor.fetchmany(RESHARD_BATCH_SIZE)
+        if not rows:
+            return moved
+        for row in rows:
+            shard = shard_for_phone(row[phone_key], target_count) if target_count > 1 else 0
+            targets[shard].execute(insert, [row[c] for c in columns])
+        moved += len(rows)
+
+
+def reshard(target_count, source_count=1, keep_source=False):
+    """
+    Copy payments, user_access, crb_reports, payment_events (including those
+    of already archived payments) and rollups from one layout to another.
+    Payment ids are kept, and found by asking each shard once they no longer
+    encode it; other rows get new ids in their target shard. Writers must be stopped.
+    """
+    # archive.py imports this module
+    from archive import attach_archive
+
+    if target_count == source_count:
+        raise ValueError('Source and target layouts are the same')
+    sources = layout_paths(source_count)
+    target_paths = layout_paths(target_count)
+    for path in target_paths:
+        if path != database.DATABASE_PATH and os.path.exists(path):
+            raise ValueError(f'{path} already exists; remove it or pick another shard count')
+    for path in target_paths:
+        database.init_db(path)
+
+    targets = [database.get_db_connection(path=p) for p in target_paths]
+    for target in targets:
+        # Copied rows bring their own history; init_db() recreates the trigger afterwards
+        target.execute('DROP TRIGGER IF EXISTS payments_insert_event')
+    main = database.get_db_connection()
+    counts = {}
+    floor = 0
+    try:
+        for source_path in sources:
+            source = database.get_db_connection(path=source_path)
+            try:
+                floor = max(floor, payment_sequence(source))
+                for table in SHARDED_TABLES:
+                    counts[table] = counts.get(table, 0) + _copy_table(
+                        source, targets, table, target_count, keep_ids=(table == 'payments'))
+                # Events of archived payments still in this file go with their
+                # payment's phone (or to one fixed shard if it cannot be found);
+                # the next archive run moves them out
+                archived = attach_archive(source)
+                try:
+                    counts['payment_events'] = counts.get('payment_events', 0) + _copy_table(
+                        source, targets, 'payment_events', target_count, keep_ids=False, query=f'''
+                            SELECT e.*, COALESCE(p.phone_number, {'a.phone_number' if archived else 'NULL'}, '') AS _phone
+                            FROM main.payment_events e
+                            LEFT JOIN main.payments p ON p.id = e.payment_id
+                            {'LEFT JOIN archive.payments a ON a.id = e.payment_id' if archived else ''}
+                            ORDER BY e.id
+                        ''')
+                finally:
+                    if archived:
+                        source.execute('DETACH DATABASE archive')
+                # Rollups are summed across shards, so they can all land in the first one
+                for row in source.execute('SELECT * FROM analytics_rollups'):
+                    targets[0].execute('''
+                        INSERT INTO analytics_rollups (granularity, bucket, metric, dimension, count, amount)
+                        VALUES (?, ?, ?, ?, ?, ?)
+                        ON CONFLICT (granularity, bucket, metric, dimension)
+                        DO UPDATE SET count = count + excluded.count, amount = amount + excluded.amount
+                    ''', tuple(row))
+            finally:
+                source.close()
+
+        align_payment_ids(targets, floor)
+        for target in targets:
+            target.commit()
+        main.commit()
+        for path in target_paths:
+            database.init_db(path)
+
+        if source_count == 1 and not keep_source:
+            # The main database's copies would otherwise shadow nothing but still take space
+            for table in SHARDED_TABLES + ('payment_events', 'analytics_rollups'):
+                main.execute(f'DELETE FROM {table}')
+            main.commit()
+    finally:
+        for target in targets:
+            target.close()
+        main.close()
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Sharded storage tools')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    reshard_parser = subparsers.add_parser('reshard', help='Move data to a new shard layout (stop writers first)')
+    reshard_parser.add_argument('--to', type=int, required=True, help='Target shard count (1 = main database)')
+    reshard_parser.add_argument('--from', dest='source', type=int, default=SHARD_COUNT,
+                                help='Current shard count (default SHARD_COUNT)')
+    reshard_parser.add_argument('--keep-source', action='store_true',
+                                help='Leave the rows in the main database when moving out of it')
+
+    args = parser.parse_args(argv)
+    if args.command == 'reshard':
+        database.init_db()
+        counts = reshard(args.to, args.source, args.keep_source)
+        print(f"Resharded {args.source} -> {args.to}: {counts}. Restart with SHARD_COUNT={args.to}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
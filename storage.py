@@ -0,0 +1,384 @@
+"""
+Storage repositories.
+
+The repositories hold the SQL for payments, entitlements, CRB reports and
+lender connections, so handlers can work with them without writing queries.
+They route through sharding.py, which opens connections through the engine
+configured in database.py (STORAGE_ENGINE=sqlite|memory). The same
+repositories therefore run on database files, on shards, or fully in memory.
+
+Every method that writes accepts an optional conn. Pass one to join the
+caller's transaction, in which case the caller commits. Without one the
+method opens, commits and closes its own connection.
+
+`python storage_contract.py` checks both engines against the behaviour the
+handlers rely on.
+"""
+import os
+import time
+import threading
+from datetime import datetime, timezone
+
+from analytics import record_event
+from database import get_db_connection
+from payment_states import transition, payment_history
+from records import PAYMENT_ROW, ENTITLEMENT_ROW, REPORT_ROW, record_cursor
+from sharding import NEXT_PAYMENT_ID, connect_phone, connect_payment, payment_id_shard
+
+
+class Repository:
+    def _run(self, conn, phone, work):
+        """
+        Run work(conn) on the caller's connection, or on a fresh connection for
+        phone (the main database when phone is None) that is then committed
+        """
+        if conn is not None:
+            return work(conn)
+        own = connect_phone(phone)
+        try:
+            result = work(own)
+            own.commit()
+            return result
+        finally:
+            own.close()
+
+
+class PaymentRepository(Repository):
+    COLUMNS = '''id, phone_number, amount, bundle_name, status, checkout_request_id, transaction_id,
+                 mpesa_receipt_number, result_description, created_at, updated_at'''
+
+    def create(self, phone, amount, bundle_name, conn=None):
+        """Insert a pending payment and return its id"""
+        def work(c):
+            cursor = c.execute(f'''
+                INSERT INTO payments (id, phone_number, amount, bundle_name, status, status_source)
+                VALUES ({NEXT_PAYMENT_ID}, ?, ?, ?, 'pending', 'initiate')
+            ''', (payment_id_shard(phone), phone, amount, bundle_name))
+            record_event(c, 'payments_initiated', bundle_name, amount)
+            return cursor.lastrowid
+        return self._run(conn, phone, work)
+
+    def get(self, payment_id=None, checkout_id=None, transaction_id=None):
+        """A Payment by the first identifier that matches, or None"""
+        conn = connect_payment(payment_id=payment_id, checkout_id=checkout_id, transaction_id=transaction_id)
+        try:
+            for column, value in (('id', payment_id), ('checkout_request_id', checkout_id),
+                                  ('transaction_id', transaction_id)):
+                if value:
+                    row = record_cursor(conn, PAYMENT_ROW).execute(
+                        f'SELECT {self.COLUMNS} FROM payments WHERE {column} = ?', (value,)).fetchone()
+                    if row:
+                        return row
+            return None
+        finally:
+            conn.close()
+
+    def latest_for_phone(self, phone):
+        conn = connect_phone(phone)
+        try:
+            return record_cursor(conn, PAYMENT_ROW).execute(f'''
+                SELECT {self.COLUMNS} FROM payments WHERE phone_number = ?
+                ORDER BY created_at DESC, id DESC LIMIT 1
+            ''', (phone,)).fetchone()
+        finally:
+            conn.close()
+
+    def set_status(self, payment, status, receipt=None, description=None, source='admin', conn=None):
+        """
+        Compare-and-set a payment (a Payment from get()) from its current status to
+        status. Returns False if the move is not allowed or the row changed first.
+        """
+        fields = {}
+        if receipt is not None:
+            fields['mpesa_receipt_number'] = receipt
+        if description is not None:
+            fields['result_description'] = description
+        return self._run(conn, payment.phone_number, lambda c: bool(
+            transition(c, status, source, 'id', payment.id, expected=payment.status, **fields)))
+
+    def history(self, payment):
+        """The payment's transitions from payment_events, oldest first"""
+        conn = connect_phone(payment.phone_number)
+        try:
+            return payment_history(conn, payment.id)
+        finally:
+            conn.close()
+
+
+def utc_timestamp(at=None):
+    """A datetime as stored by CURRENT_TIMESTAMP: UTC, 'YYYY-MM-DD HH:MM:SS'"""
+    return (at or datetime.now(timezone.utc)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class EntitlementRepository(Repository):
+    """
+    Entitlements expire at user_access.expires_at (NULL: never). Lookups skip
+    expired rows; sweeper.expire_entitlements() deactivates them in bulk.
+
+    active_package() answers from a per-process cache when it can. An entry
+    lives until the entitlement's expiry, capped at ENTITLEMENT_CACHE_SECONDS
+    so grants made by other workers (upgrades) show up. Grants in this
+    process invalidate their phone.
+    """
+    CACHE_SECONDS = float(os.environ.get('ENTITLEMENT_CACHE_SECONDS', '30'))
+    CACHE_SIZE = 10000
+
+    def __init__(self):
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _cached(self, phone):
+        entry = self._cache.get(phone)
+        if entry and entry[1] > time.monotonic():
+            return entry[0]
+        return None
+
+    def _remember(self, phone, package_type, expires_at):
+        ttl = self.CACHE_SECONDS
+        if expires_at:
+            expiry = datetime.strptime(expires_at, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+            ttl = min(ttl, (expiry - datetime.now(timezone.utc)).total_seconds())
+        if ttl <= 0:
+            return
+        with self._lock:
+            if len(self._cache) >= self.CACHE_SIZE:
+                self._cache.pop(next(iter(self._cache)))
+            self._cache[phone] = (package_type, time.monotonic() + ttl)
+
+    def forget(self, phone):
+        with self._lock:
+            self._cache.pop(phone, None)
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+
+    def active_package(self, phone, conn=None, cached=True):
+        """
+        Package type of the phone's latest unexpired entitlement, or None. The
+        cache is only used without a conn; cached=False forces a read.
+        """
+        use_cache = conn is None and cached and self.CACHE_SECONDS > 0
+        if use_cache:
+            package_type = self._cached(phone)
+            if package_type:
+                return package_type
+
+        owns_conn = conn is None
+        if owns_conn:
+            conn = connect_phone(phone)
+        try:
+            row = record_cursor(conn, ENTITLEMENT_ROW).execute('''
+                SELECT package_type, expires_at FROM user_access
+                WHERE phone_number = ? AND is_active = 1 AND (expires_at IS NULL OR expires_at > ?)
+                ORDER BY created_at DESC, id DESC LIMIT 1
+            ''', (phone, utc_timestamp())).fetchone()
+        finally:
+            if owns_conn:
+                conn.close()
+        if not row:
+            return None
+        if use_cache:
+            self._remember(phone, row.package_type, row.expires_at)
+        return row.package_type
+
+    def grant(self, phone, package_type, payment_id, amount=None, expires_at=None, conn=None):
+        """
+        Grant package_type until expires_at (a UTC datetime; None never
+        expires). Returns False if payment_id already granted something.
+        """
+        def work(c):
+            if payment_id is not None and c.execute(
+                    'SELECT id FROM user_access WHERE payment_id = ?', (payment_id,)).fetchone():
+                return False
+            c.execute('''
+                INSERT INTO user_access (phone_number, package_type, payment_id, is_active, expires_at)
+                VALUES (?, ?, ?, 1, ?)
+            ''', (phone, package_type, payment_id, utc_timestamp(expires_at) if expires_at else None))
+            record_event(c, 'entitlements_granted', package_type, amount)
+            return True
+        granted = self._run(conn, phone, work)
+        self.forget(phone)
+        return granted
+
+    def deactivate_expired(self, conn, limit):
+        """Deactivate up to limit expired entitlements on conn (one shard); the caller commits"""
+        return conn.execute('''
+            UPDATE user_access SET is_active = 0
+            WHERE id IN (
+                SELECT id FROM user_access
+                WHERE is_active = 1 AND expires_at <= ?
+                LIMIT ?
+            )
+        ''', (utc_timestamp(), limit)).rowcount
+
+
+class ReportRepository(Repository):
+    def latest(self, phone):
+        """The phone's newest report as a CrbReport, or None"""
+        conn = connect_phone(phone)
+        try:
+            return record_cursor(conn, REPORT_ROW).execute('''
+                SELECT * FROM crb_reports WHERE phone_number = ?
+                ORDER BY created_at DESC, id DESC LIMIT 1
+            ''', (phone,)).fetchone()
+        finally:
+            conn.close()
+
+    def save(self, phone, fields, conn=None):
+        """Insert a report from a dict of crb_reports columns; returns the stored CrbReport"""
+        return self._insert(phone, fields, None, conn)
+
+    def replace(self, phone, previous_id, fields, conn=None):
+        """
+        Insert fields as the phone's new report unless a report newer than
+        previous_id exists. Returns the stored CrbReport, or None if
+        another refresh got there first.
+        """
+        return self._insert(phone, fields, previous_id, conn)
+
+    def _insert(self, phone, fields, previous_id, conn):
+        columns = ['phone_number'] + list(fields)
+        values = [phone] + list(fields.values())
+        if previous_id is None:
+            sql = f"INSERT INTO crb_reports ({', '.join(columns)}) VALUES ({','.join('?' * len(columns))})"
+        else:
+            sql = f'''
+                INSERT INTO crb_reports ({', '.join(columns)}) SELECT {','.join('?' * len(columns))}
+                WHERE NOT EXISTS (SELECT 1 FROM crb_reports WHERE phone_number = ? AND id > ?)
+            '''
+            values += [phone, previous_id]
+
+        def work(c):
+            cursor = c.execute(sql, values)
+            if not cursor.rowcount:
+                return None
+            record_event(c, 'reports_generated')
+            return record_cursor(c, REPORT_ROW).execute(
+                'SELECT * FROM crb_reports WHERE id = ?', (cursor.lastrowid,)).fetchone()
+        return self._run(conn, phone, work)
+
+    def request(self, phone, conn=None):
+        """Queue the phone for a first report from the background worker; repeats are ignored"""
+        self._run(conn, phone, lambda c: c.execute(
+            'INSERT OR IGNORE INTO report_requests (phone_number) VALUES (?)', (phone,)))
+
+    def requested(self, conn, limit):
+        """Up to limit queued phones on conn (one shard), oldest request first"""
+        return [row[0] for row in conn.execute(
+            'SELECT phone_number FROM report_requests ORDER BY requested_at LIMIT ?', (limit,))]
+
+    def fulfil(self, phone, fields, conn):
+        """
+        Store fields as the phone's report unless it already has one, and drop
+        its request; the caller commits. Returns the stored CrbReport, or None
+        if the phone had a report.
+        """
+        conn.execute('DELETE FROM report_requests WHERE phone_number = ?', (phone,))
+        if conn.execute('SELECT 1 FROM crb_reports WHERE phone_number = ? LIMIT 1', (phone,)).fetchone():
+            return None
+        return self._insert(phone, fields, None, conn)
+
+
+class LenderConnectionRepository(Repository):
+    """
+    Lender leads, queued for leads.py to deliver; not sharded, they live in the
+    main database. status: pending -> sending -> delivered, or failed once
+    the attempts run out. next_attempt_at is when a pending lead is due, or
+    when a sending lead's claim lapses (the dispatcher died mid-delivery).
+    """
+    COLUMNS = 'id, phone_number, lender_id, lender_name, status, attempts, created_at'
+
+    def enqueue(self, phone, lender_id, lender_name, conn=None):
+        """
+        Queue a lead, once per (phone, lender_id). A repeat returns the existing
+        lead, and a failed one is queued again. Returns (id, status).
+        """
+        now = utc_timestamp()
+
+        def work(c):
+            row = c.execute('''
+                INSERT INTO lender_connections (phone_number, lender_id, lender_name, status, next_attempt_at)
+                VALUES (?, ?, ?, 'pending', ?)
+                ON CONFLICT (phone_number, lender_id) DO UPDATE SET
+                    status = 'pending', attempts = 0, last_error = NULL, next_attempt_at = excluded.next_attempt_at
+                WHERE status = 'failed'
+                RETURNING id, status
+            ''', (phone, lender_id, lender_name, now)).fetchone()
+            return row or c.execute(
+                'SELECT id, status FROM lender_connections WHERE phone_number = ? AND lender_id = ?',
+                (phone, lender_id)).fetchone()
+        row = self._run(conn, None, work)
+        return row['id'], row['status']
+
+    def claim_due(self, limit, lease_seconds, conn=None):
+        """Mark up to limit due leads as sending for lease_seconds and return them, oldest first"""
+        now = utc_timestamp()
+
+        def work(c):
+            rows = c.execute(f'''
+                UPDATE lender_connections SET status = 'sending', next_attempt_at = datetime(?, ?)
+                WHERE id IN (
+                    SELECT id FROM lender_connections
+                    WHERE status IN ('pending', 'sending') AND next_attempt_at <= ?
+                    ORDER BY next_attempt_at, id LIMIT ?
+                )
+                RETURNING {self.COLUMNS}
+            ''', (now, f'+{int(lease_seconds)} seconds', now, limit)).fetchall()
+            return sorted(rows, key=lambda r: r['id'])
+        return self._run(conn, None, work)
+
+    def mark_delivered(self, ids, conn=None):
+        placeholders = ','.join('?' * len(ids))
+        return self._run(conn, None, lambda c: c.execute(f'''
+            UPDATE lender_connections SET status = 'delivered', delivered_at = ?, last_error = NULL
+            WHERE id IN ({placeholders}) AND status = 'sending'
+        ''', [utc_timestamp()] + list(ids)).rowcount)
+
+    def release(self, ids, conn=None):
+        """Hand claimed leads back to the queue, due now, without counting an attempt"""
+        placeholders = ','.join('?' * len(ids))
+        return self._run(conn, None, lambda c: c.execute(f'''
+            UPDATE lender_connections SET status = 'pending', next_attempt_at = ?
+            WHERE id IN ({placeholders}) AND status = 'sending'
+        ''', [utc_timestamp()] + list(ids)).rowcount)
+
+    def mark_attempt_failed(self, ids, error, max_attempts, backoff_seconds, max_backoff_seconds, conn=None):
+        """
+        Count a failed delivery: retry after backoff_seconds * 2^attempts (at
+        most max_backoff_seconds), or fail the lead after max_attempts
+        """
+        placeholders = ','.join('?' * len(ids))
+        return self._run(conn, None, lambda c: c.execute(f'''
+            UPDATE lender_connections SET
+                attempts = attempts + 1,
+                last_error = ?,
+                status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END,
+                next_attempt_at = datetime(?, '+' || MIN(?, ? * (1 << attempts)) || ' seconds')
+            WHERE id IN ({placeholders}) AND status = 'sending'
+        ''', [str(error)[:500], max_attempts, utc_timestamp(), max_backoff_seconds, backoff_seconds]
+            + list(ids)).rowcount)
+
+    def for_phone(self, phone):
+        conn = get_db_connection()
+        try:
+            return conn.execute('''
+                SELECT id, phone_number, lender_id, lender_name, status, attempts, last_error,
+                       delivered_at, created_at
+                FROM lender_connections WHERE phone_number = ? ORDER BY id
+            ''', (phone,)).fetchall()
+        finally:
+            conn.close()
+
+
+class Storage:
+    """The repositories, as used by the handlers"""
+
+    def __init__(self):
+        self.payments = PaymentRepository()
+        self.entitlements = EntitlementRepository()
+        self.reports = ReportRepository()
+        self.lender_connections = LenderConnectionRepository()
+
+
+store = Storage()
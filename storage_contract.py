@@ -0,0 +1,186 @@
+"""
+Storage contract: the behaviour the handlers rely on from storage.store,
+checked against a storage engine.
+
+    python storage_contract.py [--engine sqlite|memory|all]
+
+Each engine runs on a fresh database (a temp file for sqlite), so this never
+touches the configured DATABASE_PATH. Exits non-zero if any check fails.
+"""
+import os
+import sys
+import argparse
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+import database
+from sharding import init_shards, connect_phone
+from storage import store
+
+
+class ContractError(Exception):
+    pass
+
+
+def expect(condition, message):
+    if not condition:
+        raise ContractError(message)
+
+
+def check_payments():
+    payment_id = store.payments.create('254700000001', 299, 'Silver Package')
+    payment = store.payments.get(payment_id=payment_id)
+    expect(payment is not None, 'created payment can be read back by id')
+    expect(payment.status == 'pending', 'new payments are pending')
+    expect(payment.amount == 299, 'amount is stored')
+
+    second_id = store.payments.create('254700000001', 99, 'Basic Package')
+    expect(second_id != payment_id, 'payment ids are unique')
+    expect(store.payments.latest_for_phone('254700000001').id == second_id,
+           'latest_for_phone returns the newest payment')
+
+    expect(store.payments.set_status(payment, 'completed', receipt='RCP123'), 'allowed transitions apply')
+    updated = store.payments.get(payment_id=payment_id)
+    expect(updated.status == 'completed', 'set_status updates the status')
+    expect(updated.mpesa_receipt_number == 'RCP123', 'set_status records the receipt')
+    expect(not store.payments.set_status(payment, 'failed'), 'a stale expected status is rejected')
+    expect(not store.payments.set_status(updated, 'pending'), 'completed is terminal')
+    expect([(e['from_status'], e['to_status']) for e in store.payments.history(updated)]
+           == [(None, 'pending'), ('pending', 'completed')], 'transitions are logged in order')
+    expect(store.payments.get(payment_id=10 ** 9) is None, 'unknown ids return None')
+
+
+def check_entitlements():
+    phone = '254700000002'
+    expect(store.entitlements.active_package(phone) is None, 'no package before a grant')
+    expect(store.entitlements.grant(phone, 'standard', 101, 99), 'first grant for a payment succeeds')
+    expect(not store.entitlements.grant(phone, 'standard', 101, 99), 'a payment grants at most once')
+    expect(store.entitlements.active_package(phone) == 'standard', 'granted package is active')
+    store.entitlements.grant(phone, 'golden', 102, 499)
+    expect(store.entitlements.active_package(phone) == 'golden', 'the newest grant is the active package')
+
+    lapsed = '254700000006'
+    now = datetime.now(timezone.utc)
+    store.entitlements.grant(lapsed, 'premium', 103, 299, expires_at=now + timedelta(days=1))
+    expect(store.entitlements.active_package(lapsed) == 'premium', 'unexpired packages are active')
+    store.entitlements.grant(lapsed, 'golden', 104, 499, expires_at=now - timedelta(days=1))
+    expect(store.entitlements.active_package(lapsed, cached=False) == 'premium', 'expired packages are skipped')
+    conn = connect_phone(lapsed)
+    try:
+        expect(store.entitlements.deactivate_expired(conn, 100) == 1, 'expired entitlements are deactivated')
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def check_reports():
+    phone = '254700000003'
+    expect(store.reports.latest(phone) is None, 'no report before one is saved')
+    saved = store.reports.save(phone, {'credit_score': 640, 'crb_status': 'Fair Standing'})
+    expect(saved.credit_score == 640 and saved.phone_number == phone, 'save returns the stored row')
+    expect(store.reports.latest(phone).id == saved.id, 'latest returns the saved report')
+    replaced = store.reports.replace(phone, saved.id, {'credit_score': 655})
+    expect(replaced and store.reports.latest(phone).id == replaced.id, 'a replacement becomes the latest report')
+    expect(store.reports.replace(phone, saved.id, {'credit_score': 660}) is None, 'a superseded report is not replaced again')
+
+    waiting = '254700000006'
+    store.reports.request(waiting)
+    store.reports.request(waiting)
+    store.reports.request(phone)
+    conn = connect_phone(waiting)
+    try:
+        expect(store.reports.requested(conn, 10).count(waiting) == 1, 'a phone is queued for a report once')
+        expect(store.reports.fulfil(waiting, {'credit_score': 600}, conn).credit_score == 600,
+               'fulfilling a request stores the report')
+        conn.commit()
+        expect(waiting not in store.reports.requested(conn, 10), 'a fulfilled request leaves the queue')
+    finally:
+        conn.close()
+    conn = connect_phone(phone)
+    try:
+        expect(store.reports.fulfil(phone, {'credit_score': 610}, conn) is None,
+               'a request for a phone that has a report stores nothing')
+        conn.commit()
+        expect(store.reports.latest(phone).credit_score == 655, 'the existing report is kept')
+    finally:
+        conn.close()
+
+
+def check_lender_connections():
+    phone = '254700000004'
+    first, status = store.lender_connections.enqueue(phone, 'tala', 'Tala')
+    store.lender_connections.enqueue(phone, 'branch', 'Branch')
+    expect(status == 'pending', 'new leads are pending')
+    expect(store.lender_connections.enqueue(phone, 'tala', 'Tala') == (first, 'pending'),
+           'a repeated lead returns the queued one')
+    rows = store.lender_connections.for_phone(phone)
+    expect([r['lender_id'] for r in rows] == ['tala', 'branch'], 'leads are listed in insertion order')
+
+    claimed = store.lender_connections.claim_due(10, 60)
+    expect([r['lender_id'] for r in claimed] == ['tala', 'branch'], 'due leads are claimed')
+    expect(store.lender_connections.claim_due(10, 60) == [], 'claimed leads are not handed out twice')
+    store.lender_connections.mark_delivered([first])
+    store.lender_connections.mark_attempt_failed([claimed[1]['id']], 'timeout', 1, 1, 60)
+    rows = store.lender_connections.for_phone(phone)
+    expect([r['status'] for r in rows] == ['delivered', 'failed'], 'delivery outcomes are written back')
+    expect(store.lender_connections.enqueue(phone, 'branch', 'Branch')[1] == 'pending', 'a failed lead can be queued again')
+    released = store.lender_connections.claim_due(10, 60)
+    expect(store.lender_connections.release([r['id'] for r in released]) == 1, 'claimed leads can be released')
+    expect([r['id'] for r in store.lender_connections.claim_due(10, 60)] == [r['id'] for r in released],
+           'released leads are due again at once')
+
+
+def check_transactions():
+    phone = '254700000005'
+    conn = connect_phone(phone)
+    try:
+        store.entitlements.grant(phone, 'premium', 201, 299, conn=conn)
+        conn.rollback()
+    finally:
+        conn.close()
+    expect(store.entitlements.active_package(phone) is None, "a write on the caller's connection rolls back with it")
+
+
+CHECKS = (check_payments, check_entitlements, check_reports, check_lender_connections, check_transactions)
+
+
+def run_contract(engine):
+    """Run every check on a fresh database under engine. Returns a list of failures."""
+    previous = database.set_engine(engine)
+    failures = []
+    try:
+        database.init_db()
+        init_shards()
+        store.entitlements.clear_cache()
+        for check in CHECKS:
+            try:
+                check()
+            except ContractError as e:
+                failures.append(f'{check.__name__}: {e}')
+    finally:
+        engine.reset()
+        database.set_engine(previous)
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check storage engines against the repository contract')
+    parser.add_argument('--engine', choices=list(database.ENGINES) + ['all'], default='all')
+    args = parser.parse_args(argv)
+
+    names = list(database.ENGINES) if args.engine == 'all' else [args.engine]
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        # Fresh files for the sqlite engine; the memory engine only uses the name
+        database.DATABASE_PATH = os.path.join(tmp, 'contract.db')
+        for name in names:
+            failures = run_contract(database.ENGINES[name]())
+            print(f"{name}: {'ok' if not failures else 'FAILED'}", file=sys.stderr)
+            for failure in failures:
+                print(f'  {failure}', file=sys.stderr)
+            failed = failed or bool(failures)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,203 @@
+"""
+Stuck-payment and entitlement expiry sweepers.
+
+A payment whose STK prompt is ignored never gets a callback, so it would stay
+pending/processing forever and be re-queried in Lipana on every check-status.
+sweep_stuck_payments() takes the active payments created more than
+STK_TIMEOUT_SECONDS ago (every shard, via the (status, created_at) index) in
+batches of SWEEP_BATCH_SIZE, and for each batch:
+1. pages through Lipana's transaction listing over the days the batch was
+   created in and applies any completed/failed outcome found there
+2. moves the payments Lipana lists as still not final (the prompt timed
+   out), and those that never reached Lipana, to expired in one conditional
+   update
+
+A payment Lipana does not list is left as it is for the next run, so a
+customer who paid is never expired because the listing missed them, but only
+until it is SWEEP_MAX_AGE_SECONDS old (default 24h). Past that it is left out
+of the listing window, so one leftover cannot stretch the listing over
+months, and is asked about on its own with query_transaction_status(); it
+is expired unless Lipana reports it final. The set of active payments
+therefore stays bounded however many checkouts are abandoned.
+
+expired is not an active state, so those payments drop out of Lipana polling
+and the check-status fallback. A late success callback can still complete
+them. If Lipana cannot be reached nothing is expired; the next run retries.
+
+expire_entitlements() deactivates entitlements past their expires_at, in
+batches through a partial index on active rows, so lookups only ever see a
+phone's live grants.
+
+Run them from cron with:
+    python sweeper.py run [--timeout-seconds N]
+    python sweeper.py entitlements
+or in-process every SWEEP_INTERVAL_SECONDS (see server.start_background_jobs).
+"""
+import os
+import sys
+import argparse
+from datetime import datetime, timedelta, timezone
+
+import database
+from lipana_gateway import get_api_key, list_transaction_statuses, query_transaction_status
+from payment_states import ACTIVE_STATES, transition
+from sharding import SHARD_COUNT, init_shards, connect_shard
+from storage import store
+
+STK_TIMEOUT_SECONDS = int(os.environ.get('STK_TIMEOUT_SECONDS', '600'))
+SWEEP_BATCH_SIZE = int(os.environ.get('SWEEP_BATCH_SIZE', '200'))
+# Past this age an unlisted payment is settled on its own Lipana answer
+SWEEP_MAX_AGE_SECONDS = int(os.environ.get('SWEEP_MAX_AGE_SECONDS', '86400'))
+
+EXPIRED_DESCRIPTION = 'Payment request expired before it was confirmed'
+
+
+def find_stuck_payments(conn, cutoff, after=('', 0)):
+    """Next batch of active payments created before cutoff, after the (created_at, id) key"""
+    return conn.execute(f'''
+        SELECT id, phone_number, amount, bundle_name, status, transaction_id, created_at
+        FROM payments
+        WHERE status IN ({','.join('?' * len(ACTIVE_STATES))})
+          AND created_at < ? AND (created_at, id) > (?, ?)
+        ORDER BY created_at, id
+        LIMIT ?
+    ''', ACTIVE_STATES + (cutoff,) + tuple(after) + (SWEEP_BATCH_SIZE,)).fetchall()
+
+
+def listing_window(payments):
+    """(start_date, end_date) of the Lipana listing covering the batch, a day wider on each side"""
+    days = [datetime.strptime(str(p['created_at'])[:10], '%Y-%m-%d') for p in payments]
+    return ((min(days) - timedelta(days=1)).strftime('%Y-%m-%d'),
+            (max(days) + timedelta(days=1)).strftime('%Y-%m-%d'))
+
+
+def confirm_with_lipana(payments, max_age_cutoff):
+    """
+    {transaction_id: (status, mpesa_receipt)} for the batch's transactions:
+    from the listing for payments newer than max_age_cutoff, and one query
+    each for older ones (status None when not final). None when Lipana is
+    not configured.
+    """
+    if not get_api_key():
+        return None
+    listed = [p for p in payments if p['transaction_id'] and str(p['created_at']) >= max_age_cutoff]
+    overdue = [p['transaction_id'] for p in payments if p['transaction_id'] and str(p['created_at']) < max_age_cutoff]
+    confirmed = {}
+    if listed:
+        confirmed.update(list_transaction_statuses([p['transaction_id'] for p in listed], *listing_window(listed)))
+    for transaction_id in overdue:
+        confirmed[transaction_id] = query_transaction_status(transaction_id)
+    return confirmed
+
+
+def sweep_batch(conn, payments, counts, max_age_cutoff=''):
+    """Settle one batch on conn and commit. Returns the payments that completed."""
+    confirmed = confirm_with_lipana(payments, max_age_cutoff)
+    completed = []
+    leftover = []
+    for payment in payments:
+        if not payment['transaction_id']:
+            # The STK push never reached Lipana; nothing can complete it
+            leftover.append(payment['id'])
+            continue
+        if confirmed is None or payment['transaction_id'] not in confirmed:
+            continue
+        status, receipt = confirmed[payment['transaction_id']]
+        if status not in ('completed', 'failed'):
+            leftover.append(payment['id'])
+            continue
+        fields = {'mpesa_receipt_number': receipt} if status == 'completed' else {}
+        if transition(conn, status, 'sweeper', 'id', payment['id'], expected=payment['status'], **fields):
+            counts[status] += 1
+            if status == 'completed':
+                completed.append(payment)
+
+    counts['expired'] += len(transition(conn, 'expired', 'sweeper', 'id', leftover,
+                                        result_description=EXPIRED_DESCRIPTION))
+    conn.commit()
+    return completed
+
+
+def sweep_stuck_payments(timeout_seconds=None, on_completed=None, max_age_seconds=None):
+    """
+    Confirm or expire active payments older than the STK timeout, on every
+    shard. on_completed(payment_id, phone, bundle_name, amount) runs for each
+    payment Lipana confirmed. A shard whose Lipana lookup fails is left for
+    the next run and the others are still swept. Returns counts.
+    """
+    timeout_seconds = STK_TIMEOUT_SECONDS if timeout_seconds is None else timeout_seconds
+    max_age_seconds = SWEEP_MAX_AGE_SECONDS if max_age_seconds is None else max_age_seconds
+    now = datetime.now(timezone.utc)
+    cutoff = (now - timedelta(seconds=timeout_seconds)).strftime('%Y-%m-%d %H:%M:%S')
+    max_age_cutoff = (now - timedelta(seconds=max_age_seconds)).strftime('%Y-%m-%d %H:%M:%S')
+
+    counts = {'completed': 0, 'failed': 0, 'expired': 0}
+    for shard in range(SHARD_COUNT):
+        conn = connect_shard(shard)
+        try:
+            after = ('', 0)
+            while True:
+                payments = find_stuck_payments(conn, cutoff, after)
+                if not payments:
+                    break
+                try:
+                    completed = sweep_batch(conn, payments, counts, max_age_cutoff)
+                except Exception as e:
+                    conn.rollback()
+                    print(f"Sweep of shard {shard} stopped, could not confirm with Lipana: {str(e)}", file=sys.stderr)
+                    break
+                for payment in completed:
+                    if on_completed:
+                        on_completed(payment['id'], payment['phone_number'], payment['bundle_name'], payment['amount'])
+                if len(payments) < SWEEP_BATCH_SIZE:
+                    break
+                after = (payments[-1]['created_at'], payments[-1]['id'])
+        finally:
+            conn.close()
+
+    if any(counts.values()):
+        print(f"Swept stuck payments: {counts['completed']} completed, {counts['failed']} failed, "
+              f"{counts['expired']} expired (cutoff {cutoff})", file=sys.stderr)
+    return dict(counts, cutoff=cutoff)
+
+
+def expire_entitlements():
+    """Deactivate expired entitlements on every shard. Returns the number deactivated."""
+    deactivated = 0
+    for shard in range(SHARD_COUNT):
+        conn = connect_shard(shard)
+        try:
+            while True:
+                count = store.entitlements.deactivate_expired(conn, SWEEP_BATCH_SIZE)
+                conn.commit()
+                deactivated += count
+                if count < SWEEP_BATCH_SIZE:
+                    break
+        finally:
+            conn.close()
+    if deactivated:
+        print(f"Deactivated {deactivated} expired entitlements", file=sys.stderr)
+    return deactivated
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Sweep stuck payments and expired entitlements')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run = subparsers.add_parser('run', help='Sweep pending/processing payments older than the timeout')
+    run.add_argument('--timeout-seconds', type=int, help=f'Default STK_TIMEOUT_SECONDS ({STK_TIMEOUT_SECONDS})')
+    subparsers.add_parser('entitlements', help='Deactivate entitlements past their expiry')
+
+    args = parser.parse_args(argv)
+    database.init_db()
+    init_shards()
+    if args.command == 'run':
+        # Granting access needs the package rules in server.py
+        from server import grant_access_for_payment
+        result = sweep_stuck_payments(args.timeout_seconds, on_completed=grant_access_for_payment)
+        print(f"Completed {result['completed']}, failed {result['failed']}, expired {result['expired']}", file=sys.stderr)
+    elif args.command == 'entitlements':
+        print(f"Deactivated {expire_entitlements()} entitlements", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()